@@ -2,7 +2,69 @@
 
 const nativeHostName = "mcp_native_host";
 let port = null;
-let processedCallIds = new Set();
+// call_ids already forwarded, keyed by tab, conversation and call_id (call_ids restart at 1 in every chat).
+// A Map keeps insertion order, so the oldest entries are dropped first once the cap is reached.
+let processedCallIds = new Map();
+const MAX_PROCESSED_CALL_IDS = 5000;
+// Large tool results arrive from the native host as TOOL_RESULT_CHUNK messages (each native messaging
+// frame is capped at 1 MB); they are reassembled here, keyed by transfer_id, before reaching the tab.
+const pendingResultTransfers = new Map();
+const RESULT_TRANSFER_TIMEOUT_MS = 60000;
+
+// Forwards a complete tool result (or other host message) payload to the content script of a tab
+function forwardNativePayloadToTab(tabId, payload) {
+  // Check if the tab still exists before sending the message
+  browser.tabs.get(tabId).then(tab => {
+    return browser.tabs.sendMessage(tabId, {
+      type: "FROM_NATIVE_HOST",
+      payload: payload
+    });
+  }).then(() => {
+    // console.log(`Background: FROM_NATIVE_HOST message sent to tab ${tabId}`);
+  }).catch(err => {
+    console.error(`Background: Error sending FROM_NATIVE_HOST message to tab ${tabId}:`, err);
+  });
+}
+
+// Collects one TOOL_RESULT_CHUNK; once every chunk has arrived the original payload is rebuilt and forwarded
+function handleToolResultChunk(tabId, chunk) {
+  let transfer = pendingResultTransfers.get(chunk.transfer_id);
+  if (!transfer) {
+    transfer = {
+      parts: new Array(chunk.chunk_count),
+      received: 0,
+      resultPayload: null,
+      timeoutId: setTimeout(() => {
+        console.error(`Background: Incomplete tool result transfer ${chunk.transfer_id} discarded.`);
+        pendingResultTransfers.delete(chunk.transfer_id);
+      }, RESULT_TRANSFER_TIMEOUT_MS)
+    };
+    pendingResultTransfers.set(chunk.transfer_id, transfer);
+  }
+  if (transfer.parts[chunk.chunk_index] === undefined) {
+    transfer.parts[chunk.chunk_index] = chunk.data;
+    transfer.received++;
+  }
+  if (chunk.result_payload) {
+    transfer.resultPayload = chunk.result_payload;
+  }
+  if (transfer.received === chunk.chunk_count && transfer.resultPayload) {
+    clearTimeout(transfer.timeoutId);
+    pendingResultTransfers.delete(chunk.transfer_id);
+    forwardNativePayloadToTab(tabId, { ...transfer.resultPayload, text_response: transfer.parts.join("") });
+  }
+}
+
+// Tells the native host that an API prompt never reached a Gemini tab, so its API request fails
+// straight away instead of waiting out the reply timeout
+function reportPromptFailure(requestId, tabId, err) {
+  if (!requestId) return;
+  sendToNativeHost({
+    type: "PROMPT_REPLY",
+    tabId: tabId,
+    payload: { request_id: requestId, done: true, error: `Prompt could not be delivered to Gemini: ${err && err.message ? err.message : err}` }
+  });
+}
 
 // Function to send a message to the native host
 function sendToNativeHost(message) {
@@ -137,23 +199,28 @@ function connectToNativeHost() {
             (response.payload && response.payload.type === "CUSTOM_PROMPT")) {
           // Get the prompt from the payload
           const promptToSend = response.payload.prompt;
+          // Prompts from the host API carry a request_id; the content script reports Gemini's reply under it
+          const requestId = response.payload.request_id || null;
+          const promptMessage = {
+            type: "PROMPT_FROM_NATIVE_HOST",
+            payload: { 
+              prompt: promptToSend,
+              isCustomPrompt: response.payload.type === "CUSTOM_PROMPT",
+              request_id: requestId
+            }
+          };
           
           if (response.tabId && promptToSend) {
             const tabId = response.tabId;
             
             // Check if the tab still exists before sending the message
             browser.tabs.get(tabId).then(tab => {
-              return browser.tabs.sendMessage(tabId, {
-                type: "PROMPT_FROM_NATIVE_HOST",
-                payload: { 
-                  prompt: promptToSend,
-                  isCustomPrompt: response.payload.type === "CUSTOM_PROMPT"
-                }
-              });
+              return browser.tabs.sendMessage(tabId, promptMessage);
             }).then(() => {
               // console.log(`Background: PROMPT_FROM_NATIVE_HOST message successfully sent to tab ${tabId}`);
             }).catch(err => {
               console.error(`Background: Error sending PROMPT_FROM_NATIVE_HOST message to tab ${tabId}:`, err);
+              reportPromptFailure(requestId, tabId, err);
             });
           } else if (!response.tabId && promptToSend) {
             // No tabId provided, find an active tab with Gemini
@@ -167,13 +234,7 @@ function connectToNativeHost() {
                   const activeTabId = geminiTabs[0].id;
                   console.log("Background: Found active Gemini tab:", activeTabId);
                   
-                  return browser.tabs.sendMessage(activeTabId, {
-                    type: "PROMPT_FROM_NATIVE_HOST",
-                    payload: { 
-                      prompt: promptToSend,
-                      isCustomPrompt: response.payload.type === "CUSTOM_PROMPT"
-                    }
-                  });
+                  return browser.tabs.sendMessage(activeTabId, promptMessage);
                 } else {
                   // Try any tab with Gemini
                   return browser.tabs.query({ url: "*://gemini.google.com/*" })
@@ -182,13 +243,7 @@ function connectToNativeHost() {
                         const tabId = allGeminiTabs[0].id;
                         console.log("Background: Found Gemini tab:", tabId);
                         
-                        return browser.tabs.sendMessage(tabId, {
-                          type: "PROMPT_FROM_NATIVE_HOST",
-                          payload: { 
-                            prompt: promptToSend,
-                            isCustomPrompt: response.payload.type === "CUSTOM_PROMPT"
-                          }
-                        });
+                        return browser.tabs.sendMessage(tabId, promptMessage);
                       } else {
                         throw new Error("No Gemini tabs found");
                       }
@@ -200,22 +255,15 @@ function connectToNativeHost() {
               })
               .catch(err => {
                 console.error("Background: Error sending PROMPT_FROM_NATIVE_HOST message:", err);
+                reportPromptFailure(requestId, null, err);
               });
           } else {
             console.warn("Background: Malformed PROMPT_RESPONSE from native host. Missing prompt.", response);
           }
+        } else if (response.tabId && response.payload && response.payload.type === "TOOL_RESULT_CHUNK") {
+          handleToolResultChunk(response.tabId, response.payload);
         } else if (response.tabId && response.payload) { // Existing handling for other messages like tool results
-          // Check if the tab still exists before sending the message
-          browser.tabs.get(response.tabId).then(tab => {
-            return browser.tabs.sendMessage(response.tabId, {
-              type: "FROM_NATIVE_HOST",
-              payload: response.payload
-            });
-          }).then(() => {
-            // console.log(`Background: FROM_NATIVE_HOST message sent to tab ${response.tabId}`);
-          }).catch(err => {
-            console.error(`Background: Error sending FROM_NATIVE_HOST message to tab ${response.tabId}:`, err);
-          });
+          forwardNativePayloadToTab(response.tabId, response.payload);
         } else {
           console.warn("Background: No tabId in response from native host or missing payload. Cannot forward to content script.", response);
         }
@@ -347,6 +395,31 @@ browser.runtime.onMessage.addListener((message, sender, sendResponse) => {
       });
     }
     
+    return true;
+  } else if (message.type === "PROMPT_REPLY") {
+    // Gemini's (partial or complete) reply to a prompt sent through the host API
+    if (port) {
+      sendToNativeHost({
+        type: "PROMPT_REPLY",
+        tabId: sender.tab ? sender.tab.id : null,
+        payload: message.payload
+      });
+    }
+    return false;
+  } else if (message.type === "CANCEL_TOOL_CALL") {
+    if (!port) {
+      connectToNativeHost();
+    }
+    if (port) {
+      sendToNativeHost({
+        type: "CANCEL_TOOL_CALL",
+        tabId: sender.tab ? sender.tab.id : null,
+        payload: message.payload
+      });
+      sendResponse({ status: "Cancel request sent to native host" });
+    } else {
+      sendResponse({ status: "Error: Native host not connected" });
+    }
     return true;
   } else if (message.type === "TOOL_CALL_DETECTED" || message.type === "REPROCESS_TOOL_CALL") {
     const callId = message.payload && message.payload.call_id;
@@ -359,13 +432,18 @@ browser.runtime.onMessage.addListener((message, sender, sendResponse) => {
 
     // Only check for duplicate call_id if not reprocessing
     if (callId && !isReprocessing) {
-      if (processedCallIds.has(callId)) {
+      const tabId = sender.tab ? sender.tab.id : null;
+      const callKey = `${tabId}|${message.payload.conversation_id || ""}|${callId}`;
+      if (processedCallIds.has(callKey)) {
         console.warn(`Duplicate call_id detected, skipping: ${callId}`);
         // Optionally send a response to the content script indicating a duplicate
         sendResponse({ status: "Duplicate call_id, message not forwarded." });
         return true; // We're sending a response
       }
-      processedCallIds.add(callId);
+      if (processedCallIds.size >= MAX_PROCESSED_CALL_IDS) {
+        processedCallIds.delete(processedCallIds.keys().next().value);
+      }
+      processedCallIds.set(callKey, Date.now());
       // console.log(`New call_id ${callId} added to processed set.`);
     }
 
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Microbenchmark for the native host's native messaging codec.
+
+Times encoding and framing a tool result message, and reading and decoding it back, for a range of payload
+sizes with each available JSON backend (json, and orjson when installed), next to the straightforward
+json.dumps / two writes / read(n) approach as a baseline. Reading is also measured through an OS pipe
+fed in small writes, which forces the short reads real stdin delivers for large frames.
+
+    python benchmarks/codec_benchmark.py --output codec.json
+"""
+
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import struct
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mcp_native_host as host # noqa: E402
+
+def make_message(payload_bytes):
+    """A TOOL_RESULT-shaped message whose text_response is about payload_bytes of UTF-8."""
+    line = 'Result line with "quotes", <tags>, tabs\tand non-ASCII: café ✓\n'
+    text = (line * (payload_bytes // len(line.encode("utf-8")) + 1))[:payload_bytes]
+    return {"tabId": 1, "payload": {"status": "tool_executed_and_result_ready", "tool_name": "bench", "call_id": "1",
+                                    "cache_hit": False, "text_response": f"<tool_result><result>{text}</result></tool_result>"}}
+
+def baseline_write(message, stream):
+    body = json.dumps(message).encode("utf-8")
+    stream.write(struct.pack("@I", len(body)))
+    stream.write(body)
+
+def baseline_read(stream):
+    length = struct.unpack("@I", stream.read(4))[0]
+    return json.loads(stream.read(length).decode("utf-8"))
+
+def host_write(message, stream):
+    stream.write(host.frame_message(host.encode_message(message)))
+
+def time_calls(function, iterations):
+    samples = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return samples
+
+def summarize(samples, frame_bytes):
+    return {"p50_us": round(statistics.median(samples) * 1e6, 1),
+            "p99_us": round(samples[min(len(samples) - 1, int(len(samples) * 0.99))] * 1e6, 1),
+            "mb_per_second": round(frame_bytes / statistics.median(samples) / 1e6, 1)}
+
+def bench_codec(name, message, iterations):
+    """Encode+frame into memory, then read+decode back from memory."""
+    if name == "baseline":
+        write, read = baseline_write, baseline_read
+    else:
+        host.set_json_backend(name)
+        write = host_write
+        reader = host.NativeMessageReader(None) # One reader (and buffer) for every read, as in the host
+        def read(stream):
+            reader.stream = stream
+            return host.decode_message(reader.read_frame())
+    sink = io.BytesIO()
+    write(message, sink)
+    frame = sink.getvalue()
+
+    def encode_once():
+        out = io.BytesIO()
+        write(message, out)
+    def decode_once():
+        read(io.BytesIO(frame))
+    return {"frame_bytes": len(frame),
+            "encode": summarize(time_calls(encode_once, iterations), len(frame)),
+            "decode": summarize(time_calls(decode_once, iterations), len(frame))}
+
+def bench_pipe(name, message, frames, chunk_bytes):
+    """Reads `frames` copies of the message through a pipe written in chunk_bytes pieces."""
+    host.set_json_backend("orjson" if name == "orjson" else "json")
+    body = host.encode_message(message)
+    frame = host.frame_message(body)
+    read_fd, write_fd = os.pipe()
+
+    def writer():
+        with os.fdopen(write_fd, "wb", buffering=0) as out:
+            for _ in range(frames):
+                for offset in range(0, len(frame), chunk_bytes):
+                    out.write(frame[offset:offset + chunk_bytes])
+    thread = threading.Thread(target=writer, daemon=True)
+    with os.fdopen(read_fd, "rb") as stream:
+        started = time.perf_counter()
+        thread.start()
+        if name == "baseline":
+            for _ in range(frames): baseline_read(stream)
+        else:
+            reader = host.NativeMessageReader(stream)
+            for _ in range(frames): host.decode_message(reader.read_frame())
+        elapsed = time.perf_counter() - started
+    thread.join()
+    return {"frames_per_second": round(frames / elapsed, 1), "mb_per_second": round(frames * len(frame) / elapsed / 1e6, 1)}
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmark the native messaging codec")
+    parser.add_argument('--sizes', default="1024,65536,524288,1000000", help='Comma-separated payload sizes in bytes')
+    parser.add_argument('--iterations', type=int, default=200, help='Timed repetitions per size and codec (default: 200)')
+    parser.add_argument('--pipe-frames', type=int, default=50, help='Frames sent through the pipe per size (default: 50)')
+    parser.add_argument('--pipe-chunk-bytes', type=int, default=65536, help='Size of each pipe write (default: 65536)')
+    parser.add_argument('--output', help='Write the JSON results to this file (default: stdout)')
+    args = parser.parse_args()
+
+    codecs = ["baseline", "json"] + (["orjson"] if host.orjson is not None else [])
+    results = {"python": platform.python_version(), "platform": platform.platform(),
+               "orjson": getattr(host.orjson, "__version__", None), "runs": []}
+    for size in (int(s) for s in args.sizes.split(",")):
+        message = make_message(size)
+        for name in codecs:
+            run = {"codec": name, "payload_bytes": size, **bench_codec(name, message, args.iterations)}
+            run["pipe"] = bench_pipe(name, message, args.pipe_frames, args.pipe_chunk_bytes)
+            results["runs"].append(run)
+            print(f"{name:>8} {size:>8} B  encode p50 {run['encode']['p50_us']:>9} us  decode p50 {run['decode']['p50_us']:>9} us"
+                  f"  pipe {run['pipe']['mb_per_second']:>7} MB/s", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f: f.write(output + "\n")
+    else:
+        print(output)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Fake MCP server for benchmarking mcp_native_host.py.
+
+Serves a configurable number of tools over stdio or streamable-http. Every tool sleeps for
+the injected latency, then either fails (with probability --failure-rate) or returns a text
+payload of --payload-bytes, so the host's own overhead can be measured against a known baseline.
+"""
+
+import argparse
+import asyncio
+import random
+import sys
+import time
+
+from fastmcp import FastMCP
+from fastmcp.exceptions import ToolError
+
+def build_server(args):
+    mcp = FastMCP(args.name)
+    rng = random.Random(args.seed)
+    payload = ("x" * 63 + "\n") * (args.payload_bytes // 64) + "x" * (args.payload_bytes % 64)
+
+    def make_tool(index):
+        async def mock_tool(text: str = "", delay_ms: float = -1) -> str:
+            # A call can override the server's latency, e.g. to simulate one slow tool
+            latency_ms = args.latency_ms if delay_ms < 0 else delay_ms
+            if args.jitter_ms:
+                latency_ms += rng.uniform(0, args.jitter_ms)
+            if latency_ms > 0:
+                await asyncio.sleep(latency_ms / 1000)
+            if args.failure_rate and rng.random() < args.failure_rate:
+                raise ToolError(f"Injected failure in {args.name}.tool_{index}")
+            return text + payload if text else payload
+        return mock_tool
+
+    for index in range(args.tools):
+        mcp.tool(make_tool(index), name=f"tool_{index}",
+                 description=f"Benchmark tool {index} of {args.name}. Returns a fixed payload after a delay.")
+    return mcp
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake MCP server for benchmarking the native host")
+    parser.add_argument('--name', default="mock", help='Server name reported to clients (default: mock)')
+    parser.add_argument('--transport', choices=['stdio', 'http'], default='stdio', help='Transport to serve (default: stdio)')
+    parser.add_argument('--port', type=int, default=0, help='Port for --transport http')
+    parser.add_argument('--tools', type=int, default=10, help='Number of tools to expose (default: 10)')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='Delay before each tool call returns (default: 0)')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra delay, uniform in [0, jitter] (default: 0)')
+    parser.add_argument('--payload-bytes', type=int, default=256, help='Size of each successful result (default: 256)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of calls that fail with a tool error (default: 0)')
+    parser.add_argument('--startup-delay-ms', type=float, default=0.0, help='Delay before the server starts answering (default: 0)')
+    parser.add_argument('--seed', type=int, default=None, help='Seed for jitter and failures, for repeatable runs')
+    args = parser.parse_args()
+
+    mcp = build_server(args)
+    if args.startup_delay_ms > 0:
+        time.sleep(args.startup_delay_ms / 1000) # Simulates a slow-starting server (e.g. loading a model)
+    if args.transport == 'http':
+        if not args.port:
+            print("Error: --port is required with --transport http", file=sys.stderr)
+            sys.exit(2)
+        mcp.run(transport="http", host="127.0.0.1", port=args.port, show_banner=False, log_level="warning")
+    else:
+        mcp.run(transport="stdio", show_banner=False)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+"""
+Benchmark harness for mcp_native_host.py.
+
+Starts a fleet of fake MCP servers (mock_mcp_server.py, over stdio and streamable-http), writes a
+config for them into a scratch directory, and drives the host exactly as Firefox does: length-prefixed
+JSON over its stdin/stdout. Reports startup time, discovery time, per-call latency percentiles,
+throughput with several tabs calling at once, and peak RSS, as JSON so runs can be compared.
+
+    python benchmarks/run_benchmark.py --stdio-servers 2 --http-servers 2 --calls 500 --tabs 8 --output before.json
+    python benchmarks/run_benchmark.py ... --output after.json --baseline before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import statistics
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+HOST_SCRIPT = os.path.join(os.path.dirname(BENCHMARK_DIR), "mcp_native_host.py")
+MOCK_SERVER_SCRIPT = os.path.join(BENCHMARK_DIR, "mock_mcp_server.py")
+
+# Result statuses that mean the host answered a call (as opposed to failing to route it)
+CALL_RESULT_STATUSES = {"tool_executed_and_result_ready", "error_executing_tool", "tool_not_found",
+                        "error_invalid_parameters", "error_server_unavailable", "tool_call_cancelled",
+                        "error_parsing_xml", "error_processing_tool_data", "error_internal", "skipped_duplicate"}
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def wait_for_port(port, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=0.2):
+                return True
+        except OSError:
+            time.sleep(0.05)
+    return False
+
+def mock_server_args(args, name, index):
+    server_args = [MOCK_SERVER_SCRIPT, "--name", name, "--tools", str(args.tools_per_server),
+                   "--latency-ms", str(args.latency_ms), "--jitter-ms", str(args.jitter_ms),
+                   "--payload-bytes", str(args.payload_bytes), "--failure-rate", str(args.failure_rate),
+                   "--startup-delay-ms", str(args.server_startup_delay_ms)]
+    if args.seed is not None:
+        server_args += ["--seed", str(args.seed + index)] # Servers fail independently of each other
+    return server_args
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(fraction * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+# --- Peak RSS ---
+# Sampled from /proc (Linux only) for the host and its descendants, i.e. the stdio servers it spawned.
+
+def _read_status_kb(pid, field):
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+def _descendants(pid):
+    children = []
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                children += [int(c) for c in f.read().split()]
+    except OSError:
+        return []
+    result = list(children)
+    for child in children:
+        result += _descendants(child)
+    return result
+
+class RssSampler(threading.Thread):
+    def __init__(self, pid, interval=0.05):
+        super().__init__(daemon=True)
+        self.pid = pid
+        self.interval = interval
+        self.peak_tree_bytes = None
+        self.host_peak_bytes = None
+        self.stop_event = threading.Event()
+
+    def run(self):
+        if not os.path.exists(f"/proc/{self.pid}/status"):
+            return # Not Linux
+        while not self.stop_event.is_set():
+            total = 0
+            for pid in [self.pid] + _descendants(self.pid):
+                total += _read_status_kb(pid, "VmRSS") or 0
+            self.peak_tree_bytes = max(self.peak_tree_bytes or 0, total)
+            self.host_peak_bytes = _read_status_kb(self.pid, "VmHWM") or self.host_peak_bytes # Kernel-tracked high-water mark
+            self.stop_event.wait(self.interval)
+
+# --- Native messaging client ---
+
+class HostProcess:
+    """Talks to a running native host the way background.js does, matching replies to waiting calls."""
+    def __init__(self, popen):
+        self.popen = popen
+        self.write_lock = threading.Lock()
+        self.waiters = {} # (tab_id, call_id) or (tab_id, message type) -> Future
+        self.waiters_lock = threading.Lock()
+        self.chunks = {} # transfer_id -> [result header, pieces]
+        self.unmatched = 0
+        self.reader = threading.Thread(target=self._read_loop, daemon=True)
+        self.reader.start()
+
+    def send(self, message):
+        body = json.dumps(message).encode("utf-8")
+        with self.write_lock:
+            self.popen.stdin.write(struct.pack("@I", len(body)) + body)
+            self.popen.stdin.flush()
+
+    def expect(self, key):
+        future = Future()
+        with self.waiters_lock:
+            self.waiters[key] = future
+        return future
+
+    def _resolve(self, key, payload):
+        with self.waiters_lock:
+            future = self.waiters.pop(key, None)
+        if future is None:
+            self.unmatched += 1
+        else:
+            future.set_result((time.perf_counter(), payload))
+
+    def _read_loop(self):
+        stdout = self.popen.stdout
+        while True:
+            header = stdout.read(4)
+            if len(header) < 4:
+                break
+            message = json.loads(stdout.read(struct.unpack("@I", header)[0]))
+            tab_id, payload = message.get("tabId"), message.get("payload") or {}
+            if payload.get("type") == "TOOL_RESULT_CHUNK":
+                # Reassemble chunked results as background.js does
+                transfer = self.chunks.setdefault(payload["transfer_id"], [None, [None] * payload["chunk_count"]])
+                if "result_payload" in payload:
+                    transfer[0] = payload["result_payload"]
+                transfer[1][payload["chunk_index"]] = payload["data"]
+                if all(piece is not None for piece in transfer[1]):
+                    del self.chunks[payload["transfer_id"]]
+                    payload = dict(transfer[0], text_response="".join(transfer[1]))
+                else:
+                    continue
+            if payload.get("type") in ("PONG", "PROMPT_RESPONSE"):
+                self._resolve((tab_id, payload["type"]), payload)
+            elif payload.get("status") in CALL_RESULT_STATUSES and payload.get("call_id") is not None:
+                self._resolve((tab_id, str(payload["call_id"])), payload)
+            else:
+                self.unmatched += 1
+        with self.waiters_lock:
+            for future in self.waiters.values():
+                if not future.done(): future.set_exception(EOFError("Host closed stdout"))
+            self.waiters.clear()
+
+def tool_call_message(tab_id, call_id, tool_name, text):
+    raw_xml = (f'<function_calls>\n<invoke name="{tool_name}" call_id="{call_id}">\n'
+               f'<parameter name="text">{text}</parameter>\n</invoke>\n</function_calls>')
+    return {"type": "TOOL_CALL_DETECTED", "tabId": tab_id, "payload": {"call_id": str(call_id), "raw_xml": raw_xml}}
+
+# --- Benchmark phases ---
+
+def build_config(args, scratch_dir):
+    servers, http_processes = [], []
+    for index in range(args.stdio_servers):
+        servers.append({"id": f"stdio_{index}", "type": "stdio", "command": sys.executable,
+                        "args": mock_server_args(args, f"stdio_{index}", index)})
+    for index in range(args.http_servers):
+        port = free_port()
+        log = open(os.path.join(scratch_dir, f"http_{index}.log"), "w")
+        http_processes.append(subprocess.Popen([sys.executable, *mock_server_args(args, f"http_{index}", args.stdio_servers + index),
+                                                "--transport", "http", "--port", str(port)],
+                                               stdout=log, stderr=subprocess.STDOUT))
+        servers.append({"id": f"http_{index}", "type": "streamable-http", "url": f"http://127.0.0.1:{port}/mcp"})
+    config = {"mcpServers": servers, "hostSettings": {"logLevel": args.log_level, "metricsLogIntervalSeconds": 0,
+                                                      "configHotReload": False,
+                                                      "promptDiscoveryWaitSeconds": 0, # So discovery_seconds covers every server
+                                                      **args.host_setting}}
+    return config, http_processes
+
+def run_calls(host, args, tool_names, phase="call"):
+    """Each tab issues calls one after another (as Gemini does); tabs run concurrently."""
+    latencies, statuses, lock = [], {}, threading.Lock()
+    calls_per_tab = [args.calls // args.tabs + (1 if i < args.calls % args.tabs else 0) for i in range(args.tabs)]
+
+    def tab_worker(tab_index):
+        tab_id = 1000 + tab_index
+        for call_index in range(calls_per_tab[tab_index]):
+            call_id = f"{phase}-{tab_index}-{call_index}" # Unique per run, or the host skips it as a duplicate
+            tool_name = tool_names[(tab_index + call_index) % len(tool_names)]
+            future = host.expect((tab_id, call_id))
+            started = time.perf_counter()
+            host.send(tool_call_message(tab_id, call_id, tool_name, f"tab {tab_index} call {call_index}"))
+            try:
+                finished, payload = future.result(timeout=args.call_timeout)
+                status = payload.get("status")
+            except Exception as e:
+                finished, status = time.perf_counter(), f"harness_{type(e).__name__}"
+            with lock:
+                latencies.append(finished - started)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    threads = [threading.Thread(target=tab_worker, args=(i,)) for i in range(args.tabs)]
+    started = time.perf_counter()
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    to_ms = lambda seconds: round(seconds * 1000, 3) if seconds is not None else None
+    return {
+        "total": len(latencies),
+        "ok": statuses.get("tool_executed_and_result_ready", 0),
+        "by_status": statuses,
+        "duration_seconds": round(elapsed, 4),
+        "throughput_per_second": round(len(latencies) / elapsed, 2) if elapsed else None,
+        "latency_ms": {
+            "mean": to_ms(statistics.fmean(latencies)) if latencies else None,
+            "p50": to_ms(percentile(latencies, 0.50)),
+            "p90": to_ms(percentile(latencies, 0.90)),
+            "p99": to_ms(percentile(latencies, 0.99)),
+            "max": to_ms(latencies[-1] if latencies else None),
+        },
+    }
+
+def run_benchmark(args):
+    scratch_dir = tempfile.mkdtemp(prefix="mcp-host-bench-")
+    config, http_processes = build_config(args, scratch_dir)
+    config_path = os.path.join(scratch_dir, "mcp_servers_config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=2)
+    result = {"label": args.label, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+              "python": platform.python_version(), "platform": platform.platform(),
+              "parameters": {k: v for k, v in vars(args).items() if k not in ("output", "baseline", "label")}}
+    host_stderr = open(os.path.join(scratch_dir, "host.log"), "w")
+    popen = None
+    try:
+        for index, process in enumerate(http_processes):
+            port = int(config["mcpServers"][args.stdio_servers + index]["url"].rsplit(":", 1)[1].split("/")[0])
+            if not wait_for_port(port, 30):
+                raise RuntimeError(f"Mock HTTP server http_{index} did not start; see {scratch_dir}")
+
+        started = time.perf_counter()
+        popen = subprocess.Popen([sys.executable, HOST_SCRIPT, "--config", config_path],
+                                 stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=host_stderr)
+        sampler = RssSampler(popen.pid)
+        sampler.start()
+        host = HostProcess(popen)
+
+        # Startup: until the host answers its first message
+        pong = host.expect((1, "PONG"))
+        host.send({"type": "PING", "tabId": 1})
+        result["startup_seconds"] = round(pong.result(timeout=60)[0] - started, 4)
+
+        # Discovery: with a cold catalog cache, REQUEST_PROMPT is answered once every server has been discovered
+        prompt = host.expect((1, "PROMPT_RESPONSE"))
+        host.send({"type": "REQUEST_PROMPT", "tabId": 1})
+        answered, payload = prompt.result(timeout=120)
+        result["discovery_seconds"] = round(answered - started, 4)
+        result["tool_count"] = payload.get("tool_count")
+
+        tool_names = [f"tool_{i}" if args.stdio_servers + args.http_servers == 1 else f"{sid}__tool_{i}"
+                      for sid in (s["id"] for s in config["mcpServers"]) for i in range(args.tools_per_server)]
+        if args.warmup:
+            # Connections are pooled after discovery; warm-up calls exclude any remaining first-call costs
+            run_calls(host, argparse.Namespace(**{**vars(args), "calls": args.warmup}), tool_names, phase="warmup")
+        result["calls"] = run_calls(host, args, tool_names)
+        result["unmatched_messages"] = host.unmatched
+
+        popen.stdin.close()
+        popen.wait(timeout=60)
+        result["shutdown_exit_code"] = popen.returncode
+        sampler.stop_event.set()
+        sampler.join()
+        result["peak_rss_bytes"] = {"host": sampler.host_peak_bytes, "host_and_stdio_servers": sampler.peak_tree_bytes}
+    finally:
+        if popen is not None and popen.poll() is None:
+            popen.kill()
+        for process in http_processes:
+            process.terminate()
+        for process in http_processes:
+            try: process.wait(timeout=10)
+            except subprocess.TimeoutExpired: process.kill()
+        host_stderr.close()
+    result["scratch_dir"] = scratch_dir # Holds the generated config and the host and server logs
+    return result
+
+# --- Comparison ---
+
+COMPARED_METRICS = [("startup_seconds",), ("discovery_seconds",), ("calls", "latency_ms", "p50"), ("calls", "latency_ms", "p99"),
+                    ("calls", "throughput_per_second"), ("peak_rss_bytes", "host"), ("peak_rss_bytes", "host_and_stdio_servers")]
+
+def compare(result, baseline):
+    """Prints each headline metric next to the baseline run's, with the relative change."""
+    print(f"{'metric':<40} {'baseline':>14} {'current':>14} {'change':>9}", file=sys.stderr)
+    for path in COMPARED_METRICS:
+        values = []
+        for run in (baseline, result):
+            value = run
+            for key in path: value = value.get(key) if isinstance(value, dict) else None
+            values.append(value)
+        change = f"{(values[1] - values[0]) / values[0] * 100:+.1f}%" if None not in values and values[0] else "n/a"
+        print(f"{'.'.join(path):<40} {str(values[0]):>14} {str(values[1]):>14} {change:>9}", file=sys.stderr)
+
+def parse_host_setting(text):
+    key, _, value = text.partition("=")
+    try: value = json.loads(value)
+    except json.JSONDecodeError: pass # Plain strings need no quoting
+    return key, value
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark mcp_native_host.py against a fleet of fake MCP servers")
+    parser.add_argument('--stdio-servers', type=int, default=2, help='Fake stdio servers to start (default: 2)')
+    parser.add_argument('--http-servers', type=int, default=1, help='Fake streamable-http servers to start (default: 1)')
+    parser.add_argument('--tools-per-server', type=int, default=10, help='Tools exposed by each server (default: 10)')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='Injected latency of every tool call (default: 5)')
+    parser.add_argument('--jitter-ms', type=float, default=0.0, help='Random extra latency per call (default: 0)')
+    parser.add_argument('--payload-bytes', type=int, default=1024, help='Size of each tool result (default: 1024)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='Fraction of tool calls that fail (default: 0)')
+    parser.add_argument('--server-startup-delay-ms', type=float, default=0.0, help='Delay before each fake server answers (default: 0)')
+    parser.add_argument('--calls', type=int, default=200, help='Measured tool calls in total (default: 200)')
+    parser.add_argument('--tabs', type=int, default=4, help='Tabs issuing calls concurrently (default: 4)')
+    parser.add_argument('--warmup', type=int, default=20, help='Unmeasured calls made first (default: 20)')
+    parser.add_argument('--call-timeout', type=float, default=60.0, help='Seconds to wait for any one call (default: 60)')
+    parser.add_argument('--seed', type=int, default=1, help='Seed for injected jitter and failures (default: 1)')
+    parser.add_argument('--log-level', default="WARNING", help="Host logLevel during the run (default: WARNING)")
+    parser.add_argument('--host-setting', action='append', type=parse_host_setting, default=[], metavar='KEY=VALUE',
+                        help='Extra hostSettings entry, e.g. maxConcurrentCalls=8 (repeatable)')
+    parser.add_argument('--label', default="", help='Free-form label stored in the results')
+    parser.add_argument('--output', help='Write the JSON results to this file (default: stdout)')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    args = parser.parse_args()
+    args.host_setting = dict(args.host_setting)
+    if args.stdio_servers + args.http_servers < 1 or args.tabs < 1:
+        parser.error("need at least one server and one tab")
+
+    result = run_benchmark(args)
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, "w") as f: f.write(output + "\n")
+    else:
+        print(output)
+    if args.baseline:
+        with open(args.baseline) as f: compare(result, json.load(f))
+
+if __name__ == "__main__":
+    main()
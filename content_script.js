@@ -22,6 +22,9 @@ function escapeHTML(str) {
     });
 }
 
+// A result block ends with </tool_result>, or with </tool_results> for a multi-call batch
+const TOOL_RESULT_END_RE = /<\/tool_results?>$/;
+
 // Function to unescape HTML entities (should be defined before first use)
 function unescapeHtmlEntities(htmlStringWithEntities) {
     if (typeof htmlStringWithEntities !== 'string') return '';
@@ -132,6 +135,12 @@ async function injectAndSendMessage(textToInject, isToolResult = false) {
     });
 }
 
+// Identifies the current Gemini conversation (e.g. "/app/1a2b3c"). Gemini numbers call_ids from 1 in
+// every chat, so call_ids are de-duplicated per tab and conversation rather than globally.
+function getConversationId() {
+  return window.location.pathname;
+}
+
 // Function to send tool call to background script
 function sendToolCallToBackground(toolCallData) {
   // console.log("Gemini MCP Client [TOOL-DETECT]: Sending to background:", toolCallData);
@@ -168,7 +177,7 @@ function processPotentialMessageContainer(containerElement) {
             
             // Check if it's a tool result, using the same logic as v0.3 but with extra whitespace handling
             if (unescapedDirectXml.trim().replace(/^\s+/, "").startsWith("<tool_result") && 
-                unescapedDirectXml.trim().endsWith("</tool_result>")) {
+                TOOL_RESULT_END_RE.test(unescapedDirectXml.trim())) {
                 handleFoundCodeElement(containerElement, "directContainerText", true, unescapedDirectXml);
             }
         }
@@ -186,7 +195,7 @@ function processPotentialMessageContainer(containerElement) {
     const unescapedXml = unescapeHtmlEntities(reconstructedXml);
 
     // Check if it's a tool result, using trim() on the unescaped XML - with extra whitespace handling
-    if (unescapedXml.trim().replace(/^\s+/, "").startsWith("<tool_result") && unescapedXml.trim().endsWith("</tool_result>")) {
+    if (unescapedXml.trim().replace(/^\s+/, "").startsWith("<tool_result") && TOOL_RESULT_END_RE.test(unescapedXml.trim())) {
         handleFoundCodeElement(containerElement, "messageContainerResult", true, unescapedXml);
     } 
     // Check if it's a tool result response that has been stripped of its XML tags
@@ -264,8 +273,8 @@ function handleFoundCodeElement(passedElement, sourceType, isResultBlockFromCall
             
             // Update actualXml to use the normalized version
             actualXml = normalizedXml;
-        } else if (normalizedXml.startsWith("<tool_result") && normalizedXml.endsWith("</tool_result>") ||
-                 actualXml.startsWith("<tool_result") && actualXml.endsWith("</tool_result>")) {
+        } else if (normalizedXml.startsWith("<tool_result") && TOOL_RESULT_END_RE.test(normalizedXml) ||
+                 actualXml.startsWith("<tool_result") && TOOL_RESULT_END_RE.test(actualXml)) {
             // This case (finding a tool_result directly in a code tag not from processPotentialMessageContainer)
             // means Gemini rendered it inside a single code block.
             isResultBlock = true;
@@ -322,7 +331,7 @@ function handleFoundCodeElement(passedElement, sourceType, isResultBlockFromCall
     // console.log(`Gemini MCP Client [DEBUG]: handleFoundCodeElement determined type. Source: ${sourceType}, isResultBlock: ${isResultBlock}, isFunctionCall: ${isFunctionCall}, Call ID (parsed/extracted): ${parsedCallId}, XML starts with: ${actualXml.substring(0,70)}...`, passedElement);
 
     if (isFunctionCall) {
-        sendToolCallToBackground({ raw_xml: actualXml, call_id: parsedCallId });
+        sendToolCallToBackground({ raw_xml: actualXml, call_id: parsedCallId, conversation_id: getConversationId() });
     }
 
     // --- Common UI Setup ---
@@ -383,6 +392,7 @@ function handleFoundCodeElement(passedElement, sourceType, isResultBlockFromCall
                 payload: {
                     raw_xml: actualXml,
                     call_id: parsedCallId,
+                    conversation_id: getConversationId(),
                     force_reprocess: true
                 }
             })
@@ -436,6 +446,24 @@ function handleFoundCodeElement(passedElement, sourceType, isResultBlockFromCall
         });
         
         dropdownMenu.appendChild(reprocessItem);
+
+        // "Cancel" Menu Item (Only for outgoing tool calls): stops a call that is still running
+        const cancelItem = document.createElement('div');
+        cancelItem.classList.add('mcp-dropdown-item');
+        cancelItem.textContent = 'Cancel';
+        cancelItem.addEventListener('click', (event) => {
+            event.stopPropagation();
+            browser.runtime.sendMessage({
+                type: "CANCEL_TOOL_CALL",
+                payload: { call_id: parsedCallId }
+            }).catch(error => {
+                console.error("Error cancelling tool call:", error);
+            });
+            dropdownMenu.style.display = 'none';
+            dropdownMenu.classList.remove('mcp-active');
+        });
+
+        dropdownMenu.appendChild(cancelItem);
     }
 
     dropdownMenu.appendChild(collapseItem); // Collapse is always present, usually last.
@@ -679,6 +707,62 @@ document.addEventListener('click', function(event) {
     });
 });
 
+// --- Replies to API prompts ---
+// Prompts sent through the native host's /api/send_prompt carry a request_id. Gemini's reply is watched
+// here and reported back as PROMPT_REPLY messages: the text so far while Gemini is still writing, then
+// done once it has stopped changing.
+const PROMPT_REPLY_POLL_MS = 500;
+const PROMPT_REPLY_SETTLE_MS = 2000; // Reply text unchanged this long (and no Stop button) counts as complete
+const PROMPT_REPLY_TIMEOUT_MS = 600000;
+
+function countModelResponses() {
+  return document.querySelectorAll('.model-response-text').length;
+}
+
+function sendPromptReply(requestId, text, done, error = null) {
+  browser.runtime.sendMessage({
+    type: "PROMPT_REPLY",
+    payload: { request_id: requestId, text: text, done: done, error: error }
+  }).catch(err => {
+    console.error("Gemini MCP Client [ERROR]: Error sending PROMPT_REPLY to background:", err);
+  });
+}
+
+function watchPromptReply(requestId, baselineResponseCount) {
+  const started = Date.now();
+  let lastText = null;
+  let lastChange = started;
+
+  const intervalId = setInterval(() => {
+    const responses = document.querySelectorAll('.model-response-text');
+    const timedOut = Date.now() - started > PROMPT_REPLY_TIMEOUT_MS;
+    if (responses.length <= baselineResponseCount) {
+      if (timedOut) {
+        clearInterval(intervalId);
+        sendPromptReply(requestId, "", true, "Gemini did not start replying");
+      }
+      return;
+    }
+
+    const text = (responses[responses.length - 1].innerText || "").trim();
+    if (text !== lastText) {
+      lastText = text;
+      lastChange = Date.now();
+      sendPromptReply(requestId, text, false);
+      return;
+    }
+
+    const stillGenerating = !!document.querySelector('button[aria-label*="Stop" i]');
+    if (text && !stillGenerating && Date.now() - lastChange >= PROMPT_REPLY_SETTLE_MS) {
+      clearInterval(intervalId);
+      sendPromptReply(requestId, text, true);
+    } else if (timedOut) {
+      clearInterval(intervalId);
+      sendPromptReply(requestId, text, true, "Gemini's reply did not finish");
+    }
+  }, PROMPT_REPLY_POLL_MS);
+}
+
 // Function to handle responses from the background script (coming from native host or for prompts)
 function handleBackgroundMessages(message) {
   if (message.type === "FROM_NATIVE_HOST" && message.payload && message.payload.text_response) {
@@ -692,15 +776,23 @@ function handleBackgroundMessages(message) {
   } else if (message.type === "PROMPT_FROM_NATIVE_HOST" && message.payload && message.payload.prompt) {
     const promptToInject = message.payload.prompt;
     const isCustomPrompt = message.payload.isCustomPrompt === true;
+    const requestId = message.payload.request_id || null;
+    // Responses already on the page; the reply to this prompt is the first one after them
+    const baselineResponseCount = countModelResponses();
     
     try {
       injectAndSendMessage(promptToInject, false) // isToolResult is false for prompts
+          .then(() => {
+              if (requestId) watchPromptReply(requestId, baselineResponseCount);
+          })
           .catch(error => {
               console.error(`Gemini MCP Client [ERROR]: Error injecting ${isCustomPrompt ? 'custom' : 'system'} prompt:`, 
-                           error.message);
+                           error.message || error);
+              if (requestId) sendPromptReply(requestId, "", true, `Prompt could not be sent: ${error.message || error}`);
           });
     } catch (e) {
       console.error("Gemini MCP Client [ERROR]: Synchronous error during prompt injection:", e.message);
+      if (requestId) sendPromptReply(requestId, "", true, `Prompt could not be sent: ${e.message}`);
     }
   } else if (message.type === "FROM_NATIVE_HOST") {
     console.warn("Gemini MCP Client: Received FROM_NATIVE_HOST message but no text_response found.");
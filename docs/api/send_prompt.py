@@ -1,39 +1,83 @@
 #!/usr/bin/env python3
 
+import argparse
 import requests
 import json
 import sys
 
-def send_prompt(prompt, api_url="http://localhost:8765/api/send_prompt"):
+DEFAULT_API_URL = "http://localhost:8765/api/send_prompt"
+
+def api_error_exit(e):
+    print(f"Error: {e}", file=sys.stderr)
+    print("Make sure the MCP Native Host is running with the API enabled:", file=sys.stderr)
+    print("  Linux/macOS: ./run_native_host.sh --enable-api", file=sys.stderr)
+    print("  Windows: run_native_host.bat --enable-api", file=sys.stderr)
+    sys.exit(1)
+
+def send_prompt(prompt, api_url=DEFAULT_API_URL, timeout=None):
     """
-    Sends a prompt to the MCP Native Host API and returns the response.
-    
+    Sends a prompt to the MCP Native Host API and waits for Gemini's complete reply.
+
     Args:
         prompt (str): The prompt text to send to the API
         api_url (str): The URL of the API endpoint (default: http://localhost:8765/api/send_prompt)
-        
+        timeout (float): Seconds the host should wait for the reply (default: the host's apiPromptTimeoutSeconds)
+
     Returns:
-        dict: The JSON response from the API
+        dict: The JSON response from the API; the reply text is in 'response'
     """
     headers = {'Content-Type': 'application/json'}
     data = {'prompt': prompt}
-    
+    if timeout:
+        data['timeout'] = timeout
+
     try:
         response = requests.post(api_url, headers=headers, data=json.dumps(data))
-        response.raise_for_status()  # Raise an exception for HTTP errors
+        # Timeouts (504) and delivery failures (502) still carry a JSON body describing the problem
         return response.json()
     except requests.exceptions.RequestException as e:
-        print(f"Error: {e}", file=sys.stderr)
-        print("Make sure the MCP Native Host is running with the API enabled:", file=sys.stderr)
-        print("  Linux/macOS: ./run_native_host.sh --enable-api", file=sys.stderr)
-        print("  Windows: run_native_host.bat --enable-api", file=sys.stderr)
-        sys.exit(1)
+        api_error_exit(e)
     except json.JSONDecodeError:
         print(f"Error: Failed to parse API response as JSON", file=sys.stderr)
         print(f"Response content: {response.text}", file=sys.stderr)
         sys.exit(1)
 
+def stream_prompt(prompt, api_url=DEFAULT_API_URL, timeout=None):
+    """
+    Sends a prompt and yields (event, data) pairs from the server-sent event stream as Gemini writes
+    its reply: "accepted", then "delta" / "replace" with text, then a final "done" or "error".
+    """
+    headers = {'Content-Type': 'application/json', 'Accept': 'text/event-stream'}
+    data = {'prompt': prompt, 'stream': True}
+    if timeout:
+        data['timeout'] = timeout
+
+    try:
+        with requests.post(api_url, headers=headers, data=json.dumps(data), stream=True) as response:
+            response.raise_for_status()  # Raise an exception for HTTP errors
+            event, data_lines = "message", []
+            for line in response.iter_lines(decode_unicode=True):
+                if line:
+                    field, _, value = line.partition(":")
+                    if field == "event":
+                        event = value.strip()
+                    elif field == "data":
+                        data_lines.append(value[1:] if value.startswith(" ") else value)
+                    continue
+                # A blank line ends the event
+                if data_lines:
+                    yield event, json.loads("\n".join(data_lines))
+                event, data_lines = "message", []
+    except requests.exceptions.RequestException as e:
+        api_error_exit(e)
+
 def main():
+    parser = argparse.ArgumentParser(description="Send a prompt to Gemini through the MCP Native Host API")
+    parser.add_argument('--url', default=DEFAULT_API_URL, help=f'API endpoint (default: {DEFAULT_API_URL})')
+    parser.add_argument('--timeout', type=float, help="Seconds to wait for Gemini's reply (default: set by the host)")
+    parser.add_argument('--no-stream', action='store_true', help='Print the reply once it is complete instead of as it is written')
+    args = parser.parse_args()
+
     # Check if there's any input from stdin
     if sys.stdin.isatty():
         print("Enter your prompt (Ctrl+D to submit):")
@@ -48,23 +92,37 @@ def main():
     else:
         # Read from piped input
         prompt = sys.stdin.read()
-    
+
     # Strip any trailing whitespace
     prompt = prompt.strip()
-    
+
     if not prompt:
         print("Error: Empty prompt", file=sys.stderr)
         sys.exit(1)
-    
-    # Send the prompt to the API
-    result = send_prompt(prompt)
-    
-    # Print the response
-    if result.get('status') == 'success':
-        print(result.get('response', 'No response received'))
-    else:
-        print(f"Error: {result.get('message', 'Unknown error')}", file=sys.stderr)
-        sys.exit(1)
+
+    if args.no_stream:
+        # Send the prompt to the API and print the complete reply
+        result = send_prompt(prompt, args.url, args.timeout)
+        if result.get('status') == 'success':
+            print(result.get('response') or 'No response received')
+        else:
+            print(f"Error: {result.get('message', 'Unknown error')}", file=sys.stderr)
+            sys.exit(1)
+        return
+
+    # Print the reply as Gemini writes it
+    for event, data in stream_prompt(prompt, args.url, args.timeout):
+        if event == "delta":
+            print(data.get('text', ''), end='', flush=True)
+        elif event == "replace":
+            # Gemini rewrote text already printed; start the reply again on a new line
+            print("\n" + data.get('text', ''), end='', flush=True)
+        elif event == "done":
+            print()
+            return
+        elif event == "error":
+            print(f"\nError: {data.get('message', 'Unknown error')}", file=sys.stderr)
+            sys.exit(1)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,30 +1,152 @@
 #!/usr/bin/env python3
 
+import time
+HOST_STARTED = time.perf_counter() # Before every other import, so --startup-profile can time them
+
 import asyncio
-import fastmcp
+import base64
 import sys
 import json
+import logging
+import logging.handlers
+import queue
 import struct
 import os
-import xml.etree.ElementTree as ET
+import hashlib
+import re
 import argparse
 import threading
-from http.server import HTTPServer, BaseHTTPRequestHandler
-from urllib.parse import parse_qs, urlparse
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from urllib.parse import parse_qs, unquote, urlparse
+try:
+    import orjson # Optional: faster JSON for native messaging frames
+except ImportError:
+    orjson = None
+try:
+    import resource # POSIX only: resource limits for stdio server processes
+except ImportError:
+    resource = None
+# fastmcp (and the mcp, httpx and pydantic stack beneath it) is most of the host's import time, so it is
+# imported by import_fastmcp() when the first server is contacted rather than here.
+fastmcp = None
+HOST_IMPORTS_DONE = time.perf_counter()
+
+STDIN_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mcp-stdin") # Blocking stdin reads only
 
-# Helper function to run asyncio tasks
-def run_async_task(task):
+def print_debug(message):
+    # Debug-level output; shown only when the log level is DEBUG (hostSettings.logLevel or POST /api/log_level).
+    LOGGER.debug(str(message))
+
+# --- Logging ---
+# Everything the host reports goes through LOGGER. Records are handed to a queue and written (as one JSON
+# object per line) by a background listener thread, so a slow stderr pipe or log file never stalls the
+# message loop. stdout is reserved for native messaging and must never be logged to.
+LOGGER = logging.getLogger("mcp_native_host")
+LOGGER.setLevel(logging.INFO)
+LOGGER.propagate = False
+LOG_LISTENER = None # logging.handlers.QueueListener draining LOG_QUEUE; replaced by configure_logging()
+LOG_QUEUE = queue.SimpleQueue()
+LOG_MAX_FIELD_CHARS = 2000 # Updated from hostSettings.logMaxFieldChars
+_LOG_RECORD_ATTRS = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+def truncate_log_value(value, max_chars=None):
+    """Shortens long strings (tool parameters, results, raw XML) so one record cannot flood the log."""
+    max_chars = LOG_MAX_FIELD_CHARS if max_chars is None else max_chars
+    if isinstance(value, str):
+        if max_chars and len(value) > max_chars:
+            return f"{value[:max_chars]}... [{len(value) - max_chars} more chars]"
+        return value
+    if isinstance(value, dict):
+        return {str(k): truncate_log_value(v, max_chars) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [truncate_log_value(v, max_chars) for v in value]
+    if value is None or isinstance(value, (bool, int, float)):
+        return value
+    return truncate_log_value(str(value), max_chars)
+
+class JsonLogFormatter(logging.Formatter):
     """
-    Runs an awaitable task using asyncio.run().
-    This is a placeholder for integrating async calls, e.g., with fastmcp.Client.
+    Formats a record as a single JSON line: ts, level, logger, msg, plus any structured fields passed
+    with extra={...} (e.g. tab_id, call_id, tool, server_id, duration_ms). Long values are truncated.
     """
-    return asyncio.run(task)
-
-def print_debug(message):
-    # Pass - this will be a no-op unless selectively re-enabled for specific debugging needs.
-    # sys.stderr.write(str(message) + '\n')
-    # sys.stderr.flush()
-    pass
+    def format(self, record):
+        entry = {
+            "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(record.created)) + f".{int(record.msecs):03d}Z",
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": truncate_log_value(record.getMessage()),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _LOG_RECORD_ATTRS and not key.startswith("_"):
+                entry[key] = truncate_log_value(value)
+        if record.exc_info:
+            entry["exc"] = truncate_log_value(self.formatException(record.exc_info))
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+def parse_log_level(level):
+    """Accepts a level name ("debug", "WARNING") or number; raises ValueError for anything else."""
+    if isinstance(level, int) and not isinstance(level, bool):
+        return level
+    if isinstance(level, str) and isinstance(logging.getLevelName(level.strip().upper()), int):
+        return logging.getLevelName(level.strip().upper())
+    raise ValueError(f"Unknown log level: {level!r}")
+
+def set_log_level(level):
+    """Changes the host's log level at runtime. Returns the new level name."""
+    LOGGER.setLevel(parse_log_level(level))
+    return logging.getLevelName(LOGGER.level)
+
+def configure_logging(settings=None):
+    """
+    (Re)builds the log pipeline from host settings: stderr always, plus a size-rotated file when
+    logFile is set. Safe to call again after the config is loaded; the old listener is flushed first.
+    """
+    global LOG_LISTENER, LOG_MAX_FIELD_CHARS
+    settings = settings or DEFAULT_HOST_SETTINGS
+    LOG_MAX_FIELD_CHARS = int(settings.get("logMaxFieldChars") or 0)
+    formatter = JsonLogFormatter()
+    handlers = []
+    stderr_handler = logging.StreamHandler(sys.stderr)
+    stderr_handler.setFormatter(formatter)
+    handlers.append(stderr_handler)
+
+    log_file = settings.get("logFile")
+    file_error = None
+    if log_file:
+        if not os.path.isabs(log_file):
+            base_dir = os.path.dirname(CONFIG_PATH) if CONFIG_PATH else os.path.dirname(os.path.abspath(__file__))
+            log_file = os.path.join(base_dir, log_file)
+        try:
+            file_handler = logging.handlers.RotatingFileHandler(log_file, maxBytes=int(settings.get("logFileMaxBytes") or 0),
+                                                                backupCount=int(settings.get("logFileBackupCount") or 0),
+                                                                encoding="utf-8")
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
+        except OSError as e:
+            file_error = e
+
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop() # Flushes everything queued so far through the old handlers
+        for handler in LOG_LISTENER.handlers: handler.close()
+    LOG_LISTENER = logging.handlers.QueueListener(LOG_QUEUE, *handlers, respect_handler_level=False)
+    LOG_LISTENER.start()
+    if not LOGGER.handlers:
+        LOGGER.addHandler(logging.handlers.QueueHandler(LOG_QUEUE))
+
+    try: set_log_level(settings.get("logLevel") or "INFO")
+    except ValueError as e: LOGGER.warning(f"Warning: {e} in hostSettings.logLevel. Using INFO."); LOGGER.setLevel(logging.INFO)
+    if file_error is not None:
+        LOGGER.error(f"Could not open log file {log_file}: {file_error}. Logging to stderr only.")
+
+def shutdown_logging():
+    """Writes out any queued records. Called as the host exits."""
+    global LOG_LISTENER
+    if LOG_LISTENER is not None:
+        LOG_LISTENER.stop()
+        for handler in LOG_LISTENER.handlers: handler.close()
+        LOG_LISTENER = None
 
 # Base system prompt including a placeholder for the dynamic tool list
 BASE_SYSTEM_PROMPT = r"""
@@ -61,7 +183,7 @@ The instructions regarding 'call_id="$CALL_ID">
 - It is a unique identifier for the function call.
 - It is a number that is incremented by 1 for each new function call, starting from 1.
 
-You can invoke one or more functions by writing a "<function_calls>" block like the following as part of your reply to the user, MAKE SURE TO INVOKE ONLY ONE FUNCTION AT A TIME, meaning only one '<function_calls>' tag in your output :
+You can invoke one or more functions by writing a "<function_calls>" block like the following as part of your reply to the user, {call_count_instruction} :
 
 <Example>
 ```xml
@@ -83,7 +205,7 @@ When a user makes a request:
 4. NEVER invent functions that arent available to you
 5. ALWAYS wait for function call execution results before continuing
 6. After invoking a function, wait for the output in <function_results> tag and then continue with your response
-7. NEVER invoke multiple functions in a single response
+7. {call_count_rule}
 8. NEVER mock or form <function_results> on your own, it will be provided to you after the execution
 
 
@@ -143,29 +265,456 @@ User Interaction Starts here:
 Please confirm that you are able to harness the power of the tooling provided and re-iterate that you are ready for further instruction from the user and awaiting their direction.
 """
 
+# Substituted into BASE_SYSTEM_PROMPT; the multi-call variants are used when hostSettings.multiToolCalls is on
+SINGLE_CALL_PROMPT_TEXT = {
+    "{call_count_instruction}": "MAKE SURE TO INVOKE ONLY ONE FUNCTION AT A TIME, meaning only one '<function_calls>' tag in your output",
+    "{call_count_rule}": "NEVER invoke multiple functions in a single response",
+}
+MULTI_CALL_PROMPT_TEXT = {
+    "{call_count_instruction}": (
+        "you MAY put several 'invoke' tags in ONE '<function_calls>' block when you need several independent results, "
+        "but still write only one '<function_calls>' tag in your output. Give every invoke its own call_id. "
+        "The calls run in parallel and all results come back together in one <tool_results> block. "
+        "If a call must only run after others (for example it reads something they write), add depends_on=\"$CALL_ID\" "
+        "(several call_ids separated by commas) to its 'invoke' tag; it is skipped if one of those calls fails. "
+        "A call that needs another call's output as a parameter value must wait for a later response instead"),
+    "{call_count_rule}": "NEVER write more than one '<function_calls>' block in a single response, and never invoke functions whose parameters depend on results you have not seen yet",
+}
+
+DEFAULT_HOST_SETTINGS = {
+    "sessionIdleTimeoutSeconds": 300, # Close pooled MCP sessions unused for this long (0 disables); "eager" servers are exempt
+    "startup": "lazy", # "eager" (started at launch, supervised, never idle-closed), "lazy" or "on-demand" (not started until needed)
+    "healthCheckIntervalSeconds": 30, # How often a supervised ("eager") server is pinged (0 only watches for it exiting)
+    "healthCheckTimeoutSeconds": 5, # A ping slower than this counts as a failed health check
+    "restartBackoffSeconds": 1, # Delay before restarting a failed supervised server; doubles with each consecutive failure
+    "restartMaxBackoffSeconds": 60, # Upper bound for that backoff
+    "processMaxMemoryMB": 0, # Address space limit for a stdio server process (RLIMIT_AS; 0 is unlimited, POSIX only)
+    "processMaxCpuSeconds": 0, # CPU time limit for a stdio server process (RLIMIT_CPU; 0 is unlimited, POSIX only)
+    "discoveryTimeoutSeconds": 15, # Give up on a server's tools/list after this long (0 waits forever)
+    "maxConcurrentToolCalls": 16, # Tool calls executing at once across all servers
+    "maxConcurrentCalls": 4, # Tool calls executing at once on a single server
+    "callIdTtlSeconds": 3600, # Forget a dispatched call_id this long after it was last seen (0 disables)
+    "maxTrackedCallIds": 10000, # Hard cap on remembered call_ids; the least recently seen are evicted first
+    "resultCacheTtlSeconds": 0, # How long a cacheable tool's result is reused for identical calls in a conversation (0 disables)
+    "resultCacheMaxEntryBytes": 262144, # Results larger than this are never cached
+    "resultCacheMaxBytes": 16777216, # Total size of all cached results; least recently used are evicted first
+    "maxResultChars": 200000, # Longest tool result pasted into Gemini; longer ones follow oversizeResultPolicy
+    "oversizeResultPolicy": "truncate", # "truncate" (keep the start), "head_and_tail" (keep both ends) or "none"
+    "blobStoreDir": "mcp_blob_store", # Where images and binary resources from results are stored (relative to the config)
+    "toolCallTimeoutSeconds": 120, # Give up on a tool call after this long, including connecting (0 waits forever)
+    "circuitBreakerFailureThreshold": 5, # Consecutive connection failures/timeouts before calls fail fast (0 disables)
+    "circuitBreakerResetSeconds": 30, # How long the circuit stays open before a probe call; doubles after a failed probe
+    "circuitBreakerMaxResetSeconds": 300, # Upper bound for that backoff
+    "metricsLogIntervalSeconds": 300, # Write a JSON metrics summary to the log this often (0 disables)
+    "logLevel": "INFO", # DEBUG, INFO, WARNING, ERROR or CRITICAL; can be changed at runtime via POST /api/log_level
+    "logFile": "", # Also write the log to this file (relative to the config); empty logs to stderr only
+    "logFileMaxBytes": 5242880, # Rotate the log file when it reaches this size
+    "logFileBackupCount": 3, # Rotated log files kept alongside the current one
+    "logMaxFieldChars": 2000, # Longer strings in a log record (parameters, results, XML) are truncated
+    "promptDiscoveryWaitSeconds": 5, # With a partly cached catalog, how long a prompt request waits for discovery before using the tools found so far (0 waits for all)
+    "apiPromptTimeoutSeconds": 300, # How long /api/send_prompt waits for Gemini's complete reply (0 waits forever)
+    "apiAllowedOrigins": [], # Web page origins (e.g. "http://localhost:3000") allowed to call the API from a browser; others are refused
+    "jsonBackend": "auto", # Native messaging JSON codec: "auto" (orjson when installed), "orjson" or "json"
+    "multiToolCalls": False, # Let Gemini put several invokes in one block; they run concurrently and are answered together
+    "httpMaxConnections": 100, # Shared HTTP pool: connections across all streamable-http/SSE servers
+    "httpMaxKeepaliveConnections": 20, # Idle connections kept open for reuse
+    "httpKeepaliveExpirySeconds": 30, # How long an idle connection is kept
+    "httpEnableHttp2": False, # Multiplex requests to a server over one HTTP/2 connection (needs the 'h2' package)
+    "configHotReload": True, # Apply edits to mcp_servers_config.json while the host runs
+    "configReloadPollSeconds": 2, # How often the config file is checked when file system notifications are unavailable
+}
+
 SERVER_CONFIGURATIONS = []
-DISCOVERED_TOOLS = []
-PROCESSED_CALL_IDS = set()
+HOST_SETTINGS = dict(DEFAULT_HOST_SETTINGS) # Overridden by the optional "hostSettings" object in mcp_servers_config.json
+TOOL_REGISTRY = None # Current ToolRegistry; replaced wholesale (never mutated) when tools change
+TOOL_NAMESPACE_SEPARATOR = "__" # Conflicting tool names are exposed as '<server_id>__<tool_name>'
+PROCESSED_CALL_IDS = None # CallIdDedupStore of dispatched call_ids; created by main_async()
+RESULT_CACHE = None # ToolResultCache for idempotent tools; created by main_async()
+ACTIVE_TASKS = set() # Message-handler tasks still running (tool calls, prompt requests)
+TOOL_CALL_SEMAPHORE = None # Global concurrent tool call limit; created by main_async()
+SERVER_SEMAPHORES = {} # server_id -> asyncio.Semaphore for that server's concurrent call limit
+CIRCUIT_BREAKERS = {} # server_id -> CircuitBreaker
+IN_FLIGHT_TOOL_CALLS = {} # (tab_id, call_id) -> task running that call, for CANCEL_TOOL_CALL
+BATCHED_TOOL_CALLS = set() # (tab_id, call_id) of in-flight calls whose result goes out in a tool_batch_results message
+STDOUT_LOCK = threading.Lock() # Serializes native-messaging frames written to stdout
 FORMATTED_TOOL_LIST_MD = "" # Global variable to store the formatted tool list
+DISCOVERY_TASK = None
+DISCOVERY_COMPLETE = asyncio.Event() # Set once every enabled server has answered discovery or timed out
+DISCOVERY_PROGRESS = asyncio.Event() # Set (and replaced) each time a server's tools are registered
+CATALOG_READY = asyncio.Event() # Set once the tool list is complete, from the cache or from discovery
+CATALOG_PARTLY_CACHED = False # True if the catalog cache supplied some, but not all, servers' tools at startup
+TOOL_REFRESH_TASKS = {} # server_id -> task rediscovering that server after tools/list_changed
+CONFIG_FILENAME = "mcp_servers_config.json" # Relative to this script unless absolute; set by --config
+CONFIG_PATH = None # Absolute path of the loaded mcp_servers_config.json
+CATALOG_CACHE_FILENAME = "mcp_tool_catalog_cache.json"
+CATALOG_CACHE_VERSION = 1
+CATALOG_CACHE = {"version": CATALOG_CACHE_VERSION, "servers": {}}
+PROMPT_CACHE = {} # (registry version, prompt filter, multi-call mode) -> (rendered prompt, tool count)
+PROMPT_CACHE_MAX_ENTRIES = 32
+TOOL_LIST_FRAGMENT_CACHE = {} # (server_id, tools digest, exposed names) -> rendered markdown fragment
+BLOB_STORE = None # ContentBlobStore for binary tool result content; created on first use
+NATIVE_MESSAGE_MAX_BYTES = 1024 * 1024 # Firefox rejects host -> extension frames larger than 1 MB
+TOOL_RESULT_CHUNK_BYTES = 512 * 1024 # Encoded size of each TOOL_RESULT_CHUNK frame, well under the cap
 API_ENABLED = False
 API_PORT = 8765
 API_SERVER = None
 
 # print_debug is now defined much earlier in the script.
 
+# --- Metrics ---
+# Counters and latency histograms for each stage of a message's trip through the host, labelled by server
+# and tool where that applies. Scraped from the API's /metrics endpoint (Prometheus text format) and
+# summarized to stderr every 'metricsLogIntervalSeconds'. Updated from the loop, the stdin thread and
+# the API thread alike, hence the lock.
+
+METRIC_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+class MetricsRegistry:
+    """Minimal in-process metrics: labelled counters, gauges and fixed-bucket latency histograms."""
+    def __init__(self, buckets=METRIC_LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.help = {} # metric name -> (type, help text)
+        self._counters = {} # (name, labels) -> value
+        self._histograms = {} # (name, labels) -> [bucket counts..., +Inf count, sum]
+        self._gauge_callbacks = [] # Functions returning [(name, labels, value)] at scrape time
+        self._lock = threading.Lock()
+
+    def describe(self, name, metric_type, help_text):
+        self.help[name] = (metric_type, help_text)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[i] += 1
+                    break
+            else:
+                histogram[len(self.buckets)] += 1
+            histogram[-1] += seconds
+
+    def add_gauge_callback(self, callback):
+        self._gauge_callbacks.append(callback)
+
+    def _gauges(self):
+        gauges = []
+        for callback in self._gauge_callbacks:
+            try: gauges.extend(callback())
+            except Exception as e: LOGGER.error(f"Metrics: Gauge callback failed: {e}")
+        return gauges
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        escaped = (k + '="' + str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"' for k, v in pairs)
+        return "{" + ",".join(escaped) + "}"
+
+    def render_prometheus(self):
+        """Renders every metric in the Prometheus text exposition format (version 0.0.4)."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        series_by_name = {}
+        for (name, labels), value in counters.items():
+            series_by_name.setdefault(name, []).append(f"{name}{self._format_labels(labels)} {value}")
+        gauge_names = set()
+        for name, labels, value in self._gauges():
+            gauge_names.add(name)
+            series_by_name.setdefault(name, []).append(f"{name}{self._format_labels(tuple(sorted(labels.items())))} {value}")
+        for (name, labels), values in histograms.items():
+            lines = series_by_name.setdefault(name, [])
+            cumulative = 0
+            for bound, count in zip(self.buckets, values):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._format_labels(labels, [('le', repr(bound))])} {cumulative}")
+            cumulative += values[len(self.buckets)]
+            lines.append(f"{name}_bucket{self._format_labels(labels, [('le', '+Inf')])} {cumulative}")
+            lines.append(f"{name}_sum{self._format_labels(labels)} {values[-1]:.6f}")
+            lines.append(f"{name}_count{self._format_labels(labels)} {cumulative}")
+        output = []
+        for name in sorted(series_by_name):
+            metric_type, help_text = self.help.get(name, ("gauge" if name in gauge_names else "untyped", ""))
+            if help_text: output.append(f"# HELP {name} {help_text}")
+            output.append(f"# TYPE {name} {metric_type}")
+            output.extend(series_by_name[name])
+        return "\n".join(output) + "\n"
+
+    def _quantile(self, values, quantile):
+        total = sum(values[:-1])
+        if not total:
+            return 0.0
+        rank = quantile * total
+        cumulative = 0
+        for bound, count in zip(self.buckets, values):
+            cumulative += count
+            if cumulative >= rank:
+                return bound # Upper bound of the bucket holding the quantile
+        return float('inf')
+
+    def summary(self):
+        """Returns a JSON-serializable snapshot: counters, gauges, and count/mean/p50/p99 per histogram series."""
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: list(values) for key, values in self._histograms.items()}
+        def series_name(name, labels):
+            return name + ("{" + ",".join(f"{k}={v}" for k, v in labels) + "}" if labels else "")
+        result = {"counters": {series_name(n, l): v for (n, l), v in sorted(counters.items())},
+                  "gauges": {series_name(n, tuple(sorted(l.items()))): v for n, l, v in self._gauges()},
+                  "latency_seconds": {}}
+        for (name, labels), values in sorted(histograms.items()):
+            count = sum(values[:-1])
+            result["latency_seconds"][series_name(name, labels)] = {
+                "count": count, "mean": round(values[-1] / count, 6) if count else 0.0,
+                "p50": self._quantile(values, 0.5), "p99": self._quantile(values, 0.99)}
+        return result
+
+METRICS = MetricsRegistry()
+METRICS.describe("mcp_host_messages_received_total", "counter", "Native messaging messages received from the extension, by type.")
+METRICS.describe("mcp_host_messages_sent_total", "counter", "Native messaging messages sent to the extension.")
+METRICS.describe("mcp_host_bytes_sent_total", "counter", "Bytes sent to the extension, excluding length prefixes.")
+METRICS.describe("mcp_host_tool_calls_total", "counter", "Tool calls completed, by server, tool and outcome status.")
+METRICS.describe("mcp_host_message_decode_seconds", "histogram", "Time to decode an incoming native messaging frame.")
+METRICS.describe("mcp_host_xml_parse_seconds", "histogram", "Time to parse a TOOL_CALL_DETECTED function_calls block.")
+METRICS.describe("mcp_host_registry_lookup_seconds", "histogram", "Time to resolve a tool name in the tool registry.")
+METRICS.describe("mcp_host_server_connect_seconds", "histogram", "Time to connect and initialize an MCP session, by server.")
+METRICS.describe("mcp_host_call_tool_seconds", "histogram", "Time spent in call_tool, by server, tool and outcome.")
+METRICS.describe("mcp_host_result_format_seconds", "histogram", "Time to render a tool result for Gemini, by server and tool.")
+METRICS.describe("mcp_host_send_message_seconds", "histogram", "Time to encode and write a message to the extension.")
+METRICS.describe("mcp_host_tool_batches_total", "counter", "Multi-call function_calls blocks answered with one tool_batch_results message.")
+METRICS.describe("mcp_host_tool_batch_calls_total", "counter", "Calls in those blocks, including rejected and skipped ones.")
+METRICS.describe("mcp_host_tool_batch_seconds", "histogram", "Time from starting a multi-call block to having every result.")
+METRICS.describe("mcp_host_config_reloads_total", "counter", "Reloads of mcp_servers_config.json, by outcome (applied or error).")
+
+# --- Startup profile ---
+# Firefox starts a fresh host for every connectNative, so startup time is time the user waits. Startup
+# phases are timed from the first line of this script. Startup is over once initial discovery has finished
+# and the extension has had its first response; the profile is then logged, and with --startup-profile
+# also printed to stderr as a table.
+
+STARTUP_PROFILE_REQUESTED = False # Set by --startup-profile
+
+class StartupProfile:
+    """Offsets and durations of the host's startup phases, and its time to first response."""
+    def __init__(self, started):
+        self.started = started
+        self.phases = [] # (phase, seconds from start, duration in seconds)
+        self.first_response_seconds = None
+        self.discovery_seconds = None
+        self.finished = False
+
+    def record(self, phase, phase_started, phase_finished=None):
+        if self.finished: return # e.g. rediscovery after a config reload is not startup
+        phase_finished = time.perf_counter() if phase_finished is None else phase_finished
+        self.phases.append((phase, phase_started - self.started, phase_finished - phase_started))
+
+    def record_first_response(self):
+        if self.first_response_seconds is not None: return
+        self.first_response_seconds = time.perf_counter() - self.started
+        self._finish_if_complete()
+
+    def record_discovery_finished(self):
+        self.discovery_seconds = time.perf_counter() - self.started
+        self._finish_if_complete()
+
+    def _finish_if_complete(self):
+        if self.first_response_seconds is not None and self.discovery_seconds is not None:
+            self.finish()
+
+    def finish(self):
+        """Ends startup and reports it. Also called at shutdown, for a host that never got that far."""
+        if self.finished: return
+        self.finished = True
+        LOGGER.info(f"Startup: first response after {self._format(self.first_response_seconds)}, "
+                    f"discovery finished after {self._format(self.discovery_seconds)}.",
+                    extra={"startup_profile": [{"phase": name, "offset_s": round(offset, 4), "duration_s": round(duration, 4)}
+                                               for name, offset, duration in self.phases]})
+        if STARTUP_PROFILE_REQUESTED:
+            sys.stderr.write(self.report())
+            sys.stderr.flush()
+
+    @staticmethod
+    def _format(seconds):
+        return "n/a" if seconds is None else f"{seconds:.3f}s"
+
+    def report(self):
+        lines = ["Startup profile (seconds since the host script started):", f"{'start':>8} {'duration':>9}  phase"]
+        for name, offset, duration in sorted(self.phases, key=lambda phase: phase[1]):
+            lines.append(f"{offset:8.3f} {duration:9.3f}  {name}")
+        lines.append(f"First response: {self._format(self.first_response_seconds)}; discovery finished: {self._format(self.discovery_seconds)}")
+        return "\n".join(lines) + "\n"
+
+STARTUP_PROFILE = StartupProfile(HOST_STARTED)
+STARTUP_PROFILE.record("imports", HOST_STARTED, HOST_IMPORTS_DONE)
+
+# --- Native messaging framing ---
+# Frames are a 4-byte native-endian length followed by that many bytes of UTF-8 JSON. Incoming frames are
+# read in full (however many short reads that takes) into a reused buffer; outgoing frames are written with
+# a single write. Both directions check the size limits before any body bytes are read or written.
+
+NATIVE_MESSAGE_MAX_INCOMING_BYTES = 64 * 1024 * 1024 # Anything larger means the stream is out of sync
+NATIVE_READ_BUFFER_KEEP_BYTES = 1024 * 1024 # Larger frames get a one-off buffer rather than growing the reused one
+_FRAME_HEADER = struct.Struct('@I')
+JSON_BACKEND = "orjson" if orjson is not None else "json" # Changed by hostSettings.jsonBackend via set_json_backend()
+
+class NativeMessagingError(ValueError):
+    """The native messaging stream is corrupt (e.g. an impossible length prefix); it cannot be resynchronized."""
+
+class NativeMessageReader:
+    """Reads length-prefixed frames from a binary stream, reusing one buffer for frames up to 1 MB."""
+    def __init__(self, stream, max_frame_bytes=NATIVE_MESSAGE_MAX_INCOMING_BYTES):
+        self.stream = stream
+        self.max_frame_bytes = max_frame_bytes
+        self._buffer = bytearray(64 * 1024)
+
+    def _read_exact(self, size, buffer):
+        """Fills buffer[:size] from the stream. Returns the number of bytes read, short only at EOF."""
+        view = memoryview(buffer)
+        filled = 0
+        while filled < size:
+            count = self.stream.readinto(view[filled:size])
+            if not count: # 0 at EOF (None only comes from non-blocking streams, which stdin is not)
+                break
+            filled += count
+        return filled
+
+    def read_frame(self):
+        """Returns the next frame's body as a memoryview (valid until the next call), or None at a clean EOF."""
+        header = bytearray(_FRAME_HEADER.size)
+        got = self._read_exact(_FRAME_HEADER.size, header)
+        if got == 0:
+            return None
+        if got < _FRAME_HEADER.size:
+            raise EOFError(f"Stream closed inside a message length prefix ({got} of {_FRAME_HEADER.size} bytes)")
+        (size,) = _FRAME_HEADER.unpack(header)
+        if size > self.max_frame_bytes:
+            raise NativeMessagingError(f"Message length {size} exceeds the {self.max_frame_bytes} byte limit")
+        if size <= NATIVE_READ_BUFFER_KEEP_BYTES:
+            if len(self._buffer) < size:
+                self._buffer = bytearray(min(NATIVE_READ_BUFFER_KEEP_BYTES, max(size, 2 * len(self._buffer))))
+            buffer = self._buffer
+        else:
+            buffer = bytearray(size)
+        got = self._read_exact(size, buffer)
+        if got < size:
+            raise EOFError(f"Stream closed inside a message ({got} of {size} bytes)")
+        return memoryview(buffer)[:size]
+
+STDIN_READER = None # NativeMessageReader over sys.stdin.buffer; created on first read
+
+def set_json_backend(name):
+    """Selects the JSON codec for native messaging: "orjson" (if installed), "json", or "auto". Returns the one in use."""
+    global JSON_BACKEND
+    if name == "orjson" and orjson is None:
+        LOGGER.warning("Warning: hostSettings.jsonBackend is 'orjson' but orjson is not installed. Using json.")
+    JSON_BACKEND = "orjson" if orjson is not None and name in ("orjson", "auto", None) else "json"
+    return JSON_BACKEND
+
+def decode_message(frame):
+    if JSON_BACKEND == "orjson":
+        return orjson.loads(frame)
+    return json.loads(str(frame, 'utf-8')) # Decodes straight from the buffer, without a bytes copy
+
 def get_message():
-    raw_length = sys.stdin.buffer.read(4)
-    if not raw_length: return None
-    message_length = struct.unpack('@I', raw_length)[0]
-    message_content = sys.stdin.buffer.read(message_length).decode('utf-8')
-    return json.loads(message_content)
+    global STDIN_READER
+    if STDIN_READER is None:
+        STDIN_READER = NativeMessageReader(sys.stdin.buffer)
+    frame = STDIN_READER.read_frame()
+    if frame is None: return None
+    started = time.perf_counter()
+    message = decode_message(frame)
+    METRICS.observe("mcp_host_message_decode_seconds", time.perf_counter() - started)
+    return message
+
+async def read_message():
+    """
+    Reads the next native-messaging message without blocking the host event loop.
+    Stdin is read on a dedicated thread so tool calls and API work keep running meanwhile.
+    """
+    return await asyncio.get_running_loop().run_in_executor(STDIN_EXECUTOR, get_message)
+
+def encode_message(message_content):
+    if JSON_BACKEND == "orjson":
+        try:
+            return orjson.dumps(message_content, option=orjson.OPT_NON_STR_KEYS)
+        except TypeError:
+            pass # Lone surrogates, integers over 64 bits or unknown types: json copes with (or reports) these
+    # UTF-8 rather than \u escapes: one encoding pass, and non-ASCII text stays compact
+    return json.dumps(message_content, ensure_ascii=False).encode('utf-8', 'replace')
 
 def send_message(message_content):
-    encoded_content = json.dumps(message_content).encode('utf-8')
-    message_length = struct.pack('@I', len(encoded_content))
-    sys.stdout.buffer.write(message_length)
-    sys.stdout.buffer.write(encoded_content)
-    sys.stdout.buffer.flush()
+    started = time.perf_counter()
+    send_encoded_message(encode_message(message_content))
+    METRICS.observe("mcp_host_send_message_seconds", time.perf_counter() - started)
+
+def frame_message(encoded_content):
+    """Prefixes an encoded message with its length, as one bytes object written in a single call."""
+    return _FRAME_HEADER.pack(len(encoded_content)) + encoded_content
+
+def send_encoded_message(encoded_content):
+    if len(encoded_content) > NATIVE_MESSAGE_MAX_BYTES:
+        # Firefox would drop the connection; large tool results go through send_tool_result() instead
+        LOGGER.error(f"Error: Message of {len(encoded_content)} bytes exceeds the {NATIVE_MESSAGE_MAX_BYTES} byte native messaging limit. Not sent.")
+        return False
+    frame = frame_message(encoded_content)
+    # One write per frame, under the lock, so frames from different tasks or threads never interleave
+    with STDOUT_LOCK:
+        sys.stdout.buffer.write(frame)
+        sys.stdout.buffer.flush()
+    if STARTUP_PROFILE.first_response_seconds is None: STARTUP_PROFILE.record_first_response()
+    METRICS.inc("mcp_host_messages_sent_total")
+    METRICS.inc("mcp_host_bytes_sent_total", len(encoded_content))
+    return True
+
+def split_text_for_frames(text, max_chunk_bytes):
+    """Splits text into pieces whose JSON-encoded form stays within max_chunk_bytes."""
+    pieces = []
+    pos = 0
+    while pos < len(text):
+        size = max_chunk_bytes # Start optimistic (one byte per character) and shrink for wider text
+        while True:
+            piece = text[pos:pos + size]
+            encoded_size = len(json.dumps(piece, ensure_ascii=False).encode('utf-8', 'replace'))
+            if encoded_size <= max_chunk_bytes or size == 1:
+                break
+            size = max(1, int(size * max_chunk_bytes / encoded_size * 0.95))
+        pieces.append(piece)
+        pos += len(piece)
+    return pieces
+
+def send_tool_result(tab_id, payload):
+    """
+    Sends a tool result payload to the extension. A payload too large for one native messaging
+    frame is sent as a sequence of TOOL_RESULT_CHUNK messages carrying slices of text_response,
+    which background.js reassembles before forwarding the complete payload to the tab.
+    """
+    started = time.perf_counter()
+    encoded_content = encode_message({"tabId": tab_id, "payload": payload})
+    if len(encoded_content) <= TOOL_RESULT_CHUNK_BYTES:
+        send_encoded_message(encoded_content)
+        METRICS.observe("mcp_host_send_message_seconds", time.perf_counter() - started)
+        return
+    text_response = payload.get("text_response", "")
+    header_payload = {key: value for key, value in payload.items() if key != "text_response"}
+    pieces = split_text_for_frames(text_response, TOOL_RESULT_CHUNK_BYTES - 1024) # Leave room for the envelope
+    result_id = payload.get('call_id') or payload.get('batch_id') # tool_batch_results carry a batch_id instead
+    transfer_id = f"{result_id}-{os.urandom(4).hex()}"
+    LOGGER.info(f"Sending {len(encoded_content)} byte result for call_id '{result_id}' in {len(pieces)} chunks.")
+    for chunk_index, piece in enumerate(pieces):
+        chunk_payload = {"type": "TOOL_RESULT_CHUNK", "transfer_id": transfer_id,
+                         "chunk_index": chunk_index, "chunk_count": len(pieces), "data": piece}
+        if chunk_index == 0:
+            chunk_payload["result_payload"] = header_payload # Everything but text_response, sent once
+        send_message({"tabId": tab_id, "payload": chunk_payload})
 
 def send_example_response(original_message_tab_id, received_payload):
     response_payload = {
@@ -176,91 +725,466 @@ def send_example_response(original_message_tab_id, received_payload):
     message_to_send = {"tabId": original_message_tab_id, "payload": response_payload}
     # print_debug(f"If uncommented, would send to extension: {json.dumps(message_to_send)}")
 
-def load_server_configurations(config_filename="mcp_servers_config.json"):
-    global SERVER_CONFIGURATIONS; SERVER_CONFIGURATIONS = []
-    script_dir = os.path.dirname(os.path.abspath(__file__)); config_path = os.path.join(script_dir, config_filename)
-    sys.stderr.write(f"Attempting to load MCP server configurations from: {config_path}\n"); sys.stderr.flush() # Keep critical
-    if not os.path.exists(config_path): sys.stderr.write(f"Error: Server configuration file not found at {config_path}\n"); sys.stderr.flush(); return False # Keep critical
+def get_server_setting(server_config, key):
+    """
+    Returns a per-server setting, falling back to the host-wide value in HOST_SETTINGS.
+    """
+    value = server_config.get(key) if server_config else None
+    return value if value is not None else HOST_SETTINGS.get(key, DEFAULT_HOST_SETTINGS.get(key))
+
+def get_tool_setting(server_config, tool_name, key):
+    """
+    Returns a per-tool setting from the server's optional "toolSettings" object, falling back
+    to the per-server and then the host-wide value.
+    """
+    tool_settings = server_config.get('toolSettings') if server_config else None
+    tool_entry = tool_settings.get(tool_name) if isinstance(tool_settings, dict) else None
+    value = tool_entry.get(key) if isinstance(tool_entry, dict) else None
+    return value if value is not None else get_server_setting(server_config, key)
+
+def read_server_configurations(config_path):
+    """
+    Reads and validates mcp_servers_config.json without touching the running configuration.
+    Returns (server configs, host settings), or None if the file is missing or unusable.
+    """
+    if not os.path.exists(config_path): LOGGER.error(f"Error: Server configuration file not found at {config_path}"); return None
+    host_settings = dict(DEFAULT_HOST_SETTINGS)
     try:
         with open(config_path, 'r') as f: data = json.load(f)
+        if not isinstance(data, dict): LOGGER.error(f"Error: {config_path} does not contain a JSON object."); return None
+        host_settings_from_file = data.get("hostSettings", {})
+        if isinstance(host_settings_from_file, dict): host_settings.update(host_settings_from_file)
+        else: LOGGER.warning(f"Warning: 'hostSettings' field in {config_path} is not an object. Using defaults.")
+        if not (isinstance(host_settings["apiAllowedOrigins"], list) and all(isinstance(o, str) for o in host_settings["apiAllowedOrigins"])): LOGGER.warning("Warning: hostSettings.apiAllowedOrigins is not a list of strings. Allowing no origins."); host_settings["apiAllowedOrigins"] = []
         server_list_from_file = data.get("mcpServers")
-        if not isinstance(server_list_from_file, list): sys.stderr.write(f"Error: 'mcpServers' field in {config_path} is not a list or is missing.\n"); sys.stderr.flush(); return False # Keep critical
+        if not isinstance(server_list_from_file, list): LOGGER.error(f"Error: 'mcpServers' field in {config_path} is not a list or is missing."); return None
         valid_servers = []
         for i, server_def in enumerate(server_list_from_file):
-            if not isinstance(server_def, dict): sys.stderr.write(f"Warning: Server definition at index {i} is not a dict. Skipping.\n"); sys.stderr.flush(); continue # Keep warning
+            if not isinstance(server_def, dict): LOGGER.warning(f"Warning: Server definition at index {i} is not a dict. Skipping."); continue
             server_id = server_def.get("id"); server_type = server_def.get("type")
-            if not server_id or not isinstance(server_id, str): sys.stderr.write(f"Warning: Server def at index {i} missing 'id'. Skipping: {str(server_def)[:100]}\n"); sys.stderr.flush(); continue # Keep warning
-            if not server_type or not isinstance(server_type, str): sys.stderr.write(f"Warning: Server '{server_id}' missing 'type'. Skipping.\n"); sys.stderr.flush(); continue # Keep warning
+            if not server_id or not isinstance(server_id, str): LOGGER.warning(f"Warning: Server def at index {i} missing 'id'. Skipping: {str(server_def)[:100]}"); continue
+            if not server_type or not isinstance(server_type, str): LOGGER.warning(f"Warning: Server '{server_id}' missing 'type'. Skipping."); continue
             is_valid_type = True
             if server_type == "stdio":
-                if not server_def.get("command") or not isinstance(server_def.get("command"), str): sys.stderr.write(f"Warning: Stdio server '{server_id}' missing 'command'. Skipping.\n"); sys.stderr.flush(); is_valid_type = False # Keep warning
+                if not server_def.get("command") or not isinstance(server_def.get("command"), str): LOGGER.warning(f"Warning: Stdio server '{server_id}' missing 'command'. Skipping."); is_valid_type = False
             elif server_type in ["streamable-http", "sse"]:
-                if not server_def.get("url") or not isinstance(server_def.get("url"), str): sys.stderr.write(f"Warning: Server '{server_id}' ({server_type}) missing 'url'. Skipping.\n"); sys.stderr.flush(); is_valid_type = False # Keep warning
-            else: sys.stderr.write(f"Warning: Server '{server_id}' unknown type '{server_type}'. Skipping.\n"); sys.stderr.flush(); is_valid_type = False # Keep warning
+                if not server_def.get("url") or not isinstance(server_def.get("url"), str): LOGGER.warning(f"Warning: Server '{server_id}' ({server_type}) missing 'url'. Skipping."); is_valid_type = False
+            else: LOGGER.warning(f"Warning: Server '{server_id}' unknown type '{server_type}'. Skipping."); is_valid_type = False
+            if server_def.get("startup") is not None and server_def.get("startup") not in SERVER_STARTUP_POLICIES: LOGGER.warning(f"Warning: Server '{server_id}' has an unknown 'startup' policy '{server_def.get('startup')}'. Using the host default."); server_def.pop("startup")
+            for field in ("headers", "env"):
+                value = server_def.get(field)
+                if value is not None and not (isinstance(value, dict) and all(isinstance(v, str) for v in value.values())): LOGGER.warning(f"Warning: Server '{server_id}' has an invalid '{field}' (expected an object of strings). Skipping."); is_valid_type = False
             if is_valid_type:
                 if not isinstance(server_def.get("enabled"), bool): server_def["enabled"] = True
                 valid_servers.append(server_def)
-        SERVER_CONFIGURATIONS = valid_servers; return True
-    except json.JSONDecodeError as e: sys.stderr.write(f"Error parsing JSON from {config_path}: {e}\n"); sys.stderr.flush() # Keep critical
-    except Exception as e: sys.stderr.write(f"Unexpected error loading server config: {e}\n"); sys.stderr.flush() # Keep critical
-    return False
+        return valid_servers, host_settings
+    except json.JSONDecodeError as e: LOGGER.error(f"Error parsing JSON from {config_path}: {e}")
+    except Exception as e: LOGGER.error(f"Unexpected error loading server config: {e}")
+    return None
+
+def load_server_configurations(config_filename="mcp_servers_config.json"):
+    global SERVER_CONFIGURATIONS, HOST_SETTINGS, CONFIG_PATH; SERVER_CONFIGURATIONS = []; HOST_SETTINGS = dict(DEFAULT_HOST_SETTINGS)
+    script_dir = os.path.dirname(os.path.abspath(__file__)); config_path = os.path.join(script_dir, config_filename)
+    CONFIG_PATH = config_path
+    LOGGER.info(f"Attempting to load MCP server configurations from: {config_path}")
+    loaded = read_server_configurations(config_path)
+    if loaded is None: return False
+    SERVER_CONFIGURATIONS, HOST_SETTINGS = loaded
+    return True
 
 # Removed discover_tools_http function (now handled by fastmcp clients)
 
-async def _discover_tools_for_server_async(server_config, current_fastmcp_module):
-    # This function will encapsulate the logic for discovering tools from a single server.
-    # It should return a list of tool definitions from this server.
-    server_id = server_config.get('id')
-    server_type = server_config.get('type')
-    tools_from_this_server = []
-    client = None # Ensure client is defined
+FASTMCP_IMPORT = None # Future for the one background import of fastmcp
 
-    # print_debug(f"Async Discover: Processing server '{server_id}' (Type: {server_type})")
+def _import_fastmcp_blocking():
+    global fastmcp
+    started = time.perf_counter()
+    import fastmcp as fastmcp_module
+    STARTUP_PROFILE.record("import fastmcp", started)
+    fastmcp = fastmcp_module
+    return fastmcp_module
 
-    client_target = None
+async def import_fastmcp():
+    """
+    Returns the fastmcp module, importing it on first use. The import runs in a worker thread, so the
+    message loop keeps answering PINGs and prompt requests while it takes its fraction of a second.
+    """
+    global FASTMCP_IMPORT
+    if fastmcp is not None:
+        return fastmcp
+    if FASTMCP_IMPORT is None:
+        FASTMCP_IMPORT = asyncio.ensure_future(asyncio.to_thread(_import_fastmcp_blocking))
+    return await asyncio.shield(FASTMCP_IMPORT) # One caller being cancelled must not cancel the import for the rest
+
+def build_client_target(server_config):
+    """
+    Builds a JSON-serializable description of how to reach a server: the URL, transport and headers
+    for HTTP/SSE servers, or an MCPConfig dict (with the server's env) for stdio servers. Returns None
+    if no target can be built. create_client_transport() turns it into what fastmcp.Client takes.
+    """
+    server_id = server_config.get('id')
+    server_type = server_config.get('type')
     if server_type == "streamable-http" or server_type == "sse":
-        client_target = server_config.get('url')
+        url = server_config.get('url')
+        if url:
+            return {"url": url, "transport": server_type, "headers": dict(server_config.get('headers') or {})}
     elif server_type == "stdio":
         # For stdio, fastmcp needs MCPConfig format
         command = server_config.get('command')
         args = server_config.get('args', [])
         if command:
-            client_target = {
-                "mcpServers": {
-                    server_id: {
-                        "command": command,
-                        "args": args if args else []
-                    }
-                }
-            }
+            stdio_server = {"command": command, "args": args if args else []}
+            memory_mb = int(get_server_setting(server_config, "processMaxMemoryMB") or 0)
+            cpu_seconds = int(get_server_setting(server_config, "processMaxCpuSeconds") or 0)
+            if (memory_mb or cpu_seconds) and resource is not None:
+                # Started through RLIMIT_LAUNCHER, which applies the limits and then execs the real command
+                stdio_server = {"command": sys.executable,
+                                "args": ["-I", "-S", "-c", RLIMIT_LAUNCHER, str(memory_mb * 1024 * 1024), str(cpu_seconds), command, *(args or [])]}
+            if server_config.get('env'):
+                stdio_server["env"] = dict(server_config['env']) # Added to the minimal environment MCP gives servers
+            return {"mcpServers": {server_id: stdio_server}}
+    return None
+
+# Run as `python -I -S -c RLIMIT_LAUNCHER <max bytes> <max cpu seconds> <command> <args...>`: sets the limits
+# (0 leaves one unset), then replaces itself with the server, which inherits them. fastmcp has no hook to run
+# code in the child before exec, and a bare interpreter (-S skips site-packages) starts in milliseconds.
+RLIMIT_LAUNCHER = """import os, resource, sys
+memory, cpu = int(sys.argv[1]), int(sys.argv[2])
+if memory: resource.setrlimit(resource.RLIMIT_AS, (memory, memory))
+if cpu: resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu))
+os.execvp(sys.argv[3], sys.argv[3:])
+"""
+
+def create_client_transport(client_target):
+    """Returns the fastmcp.Client argument for a target: an HTTP/SSE transport on the shared connection pool, or the MCPConfig."""
+    if "url" not in client_target:
+        return client_target
+    from fastmcp.client.transports import SSETransport, StreamableHttpTransport
+    transport_class = SSETransport if client_target["transport"] == "sse" else StreamableHttpTransport
+    return transport_class(client_target["url"], headers=client_target["headers"] or None,
+                           httpx_client_factory=HTTP_CONNECTION_POOL.client_factory)
+
+# --- Shared HTTP connection pool ---
+# fastmcp builds a new HTTP client for every session it opens. Each of those clients borrows one shared
+# keep-alive transport, so connections to a server outlive sessions (reconnects and new sessions skip the
+# TCP and TLS handshakes) and the total across all servers is capped by the httpMax* host settings.
+
+class _BorrowedHTTPTransport:
+    """Lends the pool's transport to one client. Closing the client leaves the pool open."""
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def handle_async_request(self, request):
+        self.pool.requests += 1
+        METRICS.inc("mcp_host_http_pool_requests_total")
+        return await self.pool.transport.handle_async_request(request)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type=None, exc_value=None, traceback=None):
+        pass
+
+    async def aclose(self):
+        pass
+
+class SharedHTTPConnectionPool:
+    """The keep-alive connection pool behind every streamable-http and SSE session."""
+    DEFAULT_TIMEOUT_SECONDS = 30.0 # MCP's own defaults: connect/write/pool, and reads (SSE streams stay open between events)
+    DEFAULT_READ_TIMEOUT_SECONDS = 300.0
+
+    def __init__(self):
+        self.httpx = None
+        self.transport = None
+        self.http2 = False
+        self.limits = {}
+        self.clients = 0 # Clients that have borrowed the pool, i.e. HTTP/SSE sessions opened
+        self.requests = 0
+
+    def _open(self):
+        # fastmcp's clients come from the MCP SDK's HTTP library: httpx2 for MCP SDK 2.x, httpx before it
+        from mcp.shared import _httpx_utils
+        self.httpx = getattr(_httpx_utils, "httpx2", None) or getattr(_httpx_utils, "httpx")
+        self.limits = {"max_connections": int(HOST_SETTINGS.get("httpMaxConnections")),
+                       "max_keepalive_connections": int(HOST_SETTINGS.get("httpMaxKeepaliveConnections")),
+                       "keepalive_expiry": float(HOST_SETTINGS.get("httpKeepaliveExpirySeconds"))}
+        self.http2 = bool(HOST_SETTINGS.get("httpEnableHttp2"))
+        if self.http2:
+            try: import h2 # noqa: F401 (HTTP/2 support is an optional extra of httpx)
+            except ImportError:
+                LOGGER.warning("Warning: hostSettings.httpEnableHttp2 is set but the 'h2' package is not installed. Using HTTP/1.1.")
+                self.http2 = False
+        self.transport = self.httpx.AsyncHTTPTransport(http2=self.http2, limits=self.httpx.Limits(**self.limits))
+        LOGGER.info(f"HTTP connection pool: {'HTTP/2 and HTTP/1.1' if self.http2 else 'HTTP/1.1'}, "
+                    f"{self.limits['max_connections']} connections max, {self.limits['keepalive_expiry']}s keep-alive.")
+
+    def client_factory(self, headers=None, timeout=None, auth=None, **kwargs):
+        """An McpHttpClientFactory: the client fastmcp would have built, sending through the shared pool."""
+        if self.transport is None:
+            self._open()
+        self.clients += 1
+        METRICS.inc("mcp_host_http_pool_clients_total")
+        if timeout is None:
+            timeout = self.httpx.Timeout(self.DEFAULT_TIMEOUT_SECONDS, read=self.DEFAULT_READ_TIMEOUT_SECONDS)
+        return self.httpx.AsyncClient(transport=_BorrowedHTTPTransport(self), headers=headers, timeout=timeout, auth=auth, **kwargs)
+
+    def stats(self):
+        """Pool limits, counters, and the current connections by state (open, idle, HTTP/2)."""
+        stats = {"open": self.transport is not None, "http2_enabled": self.http2, **self.limits,
+                 "clients_total": self.clients, "requests_total": self.requests}
+        # The connection list belongs to the HTTP library's internals; leave it out if they change shape
+        connections = getattr(getattr(self.transport, "_pool", None), "connections", None)
+        if connections is not None:
+            stats["connections"] = len(connections)
+            stats["idle_connections"] = sum(1 for c in connections if c.is_idle())
+            stats["http2_connections"] = sum(1 for c in connections if "HTTP/2" in c.info())
+        return stats
+
+    async def close(self):
+        transport, self.transport = self.transport, None
+        if transport is not None:
+            await transport.aclose()
+
+HTTP_CONNECTION_POOL = SharedHTTPConnectionPool()
+METRICS.describe("mcp_host_http_pool_clients_total", "counter", "HTTP clients (one per HTTP/SSE session) sending through the shared pool.")
+METRICS.describe("mcp_host_http_pool_requests_total", "counter", "HTTP requests sent through the shared pool.")
+
+class _PooledSession:
+    """Book-keeping for one long-lived fastmcp.Client owned by MCPSessionPool."""
+    def __init__(self, server_id, client_target):
+        self.server_id = server_id
+        self.client_target = client_target
+        self.config_key = json.dumps(client_target, sort_keys=True)
+        self.client = None
+        self.ready = asyncio.get_running_loop().create_future() # Resolves to the connected client
+        self.closing = asyncio.Event()
+        self.runner_task = None
+        self.leases = 0
+        self.last_used = time.monotonic()
+
+    def is_alive(self):
+        if self.closing.is_set() or self.runner_task is None or self.runner_task.done():
+            return False
+        if self.ready.done() and (self.ready.cancelled() or self.ready.exception() is not None):
+            return False
+        if self.client is not None and hasattr(self.client, 'is_connected'):
+            try: return bool(self.client.is_connected())
+            except Exception: return False
+        return True
+
+class MCPSessionPool:
+    """
+    Keeps one initialized fastmcp.Client per MCP server id so that stdio servers are not
+    respawned and HTTP/SSE servers are not re-handshaked for every call.
+    Sessions reconnect lazily when they die and are closed after sitting idle for
+    the server's 'sessionIdleTimeoutSeconds'.
+    """
+    def __init__(self):
+        self._sessions = {} # server_id -> _PooledSession
+        self._draining = set() # Replaced _PooledSessions kept open until their leased calls finish
+        self._locks = {} # server_id -> asyncio.Lock guarding (re)connection
+        self._reaper_task = None
+        self.tool_list_changed_callback = None # Called with the server_id on notifications/tools/list_changed
+
+    def _message_handler_for(self, server_id):
+        async def handle_server_message(message):
+            notification = getattr(message, 'root', message) # Older MCP SDKs wrap notifications in a RootModel
+            if getattr(notification, 'method', None) == "notifications/tools/list_changed" and self.tool_list_changed_callback:
+                self.tool_list_changed_callback(server_id)
+        return handle_server_message
+
+    async def _run_session(self, entry, current_fastmcp_module):
+        # The client is entered and exited inside this one task, as fastmcp/anyio require.
+        client = None
+        try:
+            client = current_fastmcp_module.Client(create_client_transport(entry.client_target),
+                                                   message_handler=self._message_handler_for(entry.server_id))
+            async with client:
+                entry.client = client
+                if not entry.ready.done(): entry.ready.set_result(client)
+                await entry.closing.wait()
+        except Exception as e:
+            if not entry.ready.done(): entry.ready.set_exception(e)
+            else: LOGGER.error(f"Session Pool: Session for server '{entry.server_id}' ended with error: {e}")
+        finally:
+            entry.client = None
+            if not entry.ready.done(): entry.ready.cancel()
+            # Stdio transports keep their server process alive past the client context (keep_alive); stop
+            # it here rather than whenever the client happens to be garbage collected
+            if client is not None:
+                try: await client.close()
+                except Exception as e: LOGGER.debug(f"Session Pool: Error closing transport for server '{entry.server_id}': {e}")
+
+    async def _connect(self, server_config, client_target, current_fastmcp_module):
+        server_id = server_config.get('id')
+        entry = _PooledSession(server_id, client_target)
+        entry.runner_task = asyncio.create_task(self._run_session(entry, current_fastmcp_module), name=f"mcp-session-{server_id}")
+        started = time.perf_counter()
+        try:
+            await entry.ready
+            METRICS.observe("mcp_host_server_connect_seconds", time.perf_counter() - started, server=server_id)
+        except BaseException:
+            entry.closing.set()
+            entry.runner_task.cancel() # Do not leave a hung connect attempt behind (e.g. on discovery timeout)
+            raise
+        self._ensure_reaper()
+        return entry
+
+    async def acquire(self, server_config, current_fastmcp_module):
+        """
+        Returns a connected client for the server, connecting or reconnecting if needed.
+        Every acquire() must be paired with release().
+        """
+        server_id = server_config.get('id')
+        client_target = build_client_target(server_config)
+        if not client_target:
+            raise ValueError(f"Cannot determine client target for server {server_id}")
+        config_key = json.dumps(client_target, sort_keys=True)
+        lock = self._locks.setdefault(server_id, asyncio.Lock())
+        async with lock:
+            entry = self._sessions.get(server_id)
+            if entry is not None and (not entry.is_alive() or entry.config_key != config_key):
+                # A session for an edited server config is replaced, but calls still using it finish first
+                self._retire(entry, drain=entry.is_alive())
+                entry = None
+            if entry is None:
+                entry = await self._connect(server_config, client_target, current_fastmcp_module)
+                self._sessions[server_id] = entry
+            entry.leases += 1
+            entry.last_used = time.monotonic()
+            return entry.client
+
+    def release(self, server_id, client, discard=False):
+        entry = self._sessions.get(server_id)
+        if entry is None or entry.client is not client:
+            entry = next((e for e in self._draining if e.client is client), None)
+            if entry is None:
+                return # Session was already replaced or closed
+        entry.leases = max(0, entry.leases - 1)
+        entry.last_used = time.monotonic()
+        if discard or not entry.is_alive() or (entry in self._draining and entry.leases == 0):
+            self._retire(entry)
+
+    @asynccontextmanager
+    async def session(self, server_config, current_fastmcp_module):
+        """Leases a pooled client; the session is dropped if it died while in use."""
+        server_id = server_config.get('id')
+        client = await self.acquire(server_config, current_fastmcp_module)
+        try:
+            yield client
+        finally:
+            self.release(server_id, client)
+
+    def _retire(self, entry, drain=False):
+        """Drops a session from the pool; with drain=True it is only closed once its last lease is released."""
+        if self._sessions.get(entry.server_id) is entry:
+            del self._sessions[entry.server_id]
+        if drain and entry.leases > 0:
+            self._draining.add(entry)
+            return
+        self._draining.discard(entry)
+        entry.closing.set()
+
+    async def close(self, server_id):
+        entry = self._sessions.get(server_id)
+        if entry is not None:
+            self._retire(entry)
+            if entry.runner_task: await asyncio.gather(entry.runner_task, return_exceptions=True)
+
+    async def wait_ended(self, server_id, timeout=None):
+        """Waits up to timeout seconds for a server's current session to end (closed, or its client failed). True if it has."""
+        entry = self._sessions.get(server_id)
+        if entry is None or entry.runner_task is None:
+            return True
+        done, _ = await asyncio.wait({entry.runner_task}, timeout=timeout)
+        return bool(done)
+
+    def retire(self, server_id):
+        """Stops handing out a server's session (e.g. it was removed from the config) without cutting off calls using it."""
+        entry = self._sessions.get(server_id)
+        if entry is not None:
+            self._retire(entry, drain=True)
+
+    async def close_all(self):
+        if self._reaper_task: self._reaper_task.cancel()
+        for server_id in list(self._sessions): await self.close(server_id)
+        draining = list(self._draining)
+        for entry in draining: self._retire(entry)
+        await asyncio.gather(*(e.runner_task for e in draining if e.runner_task), return_exceptions=True)
+
+    def _ensure_reaper(self):
+        if self._reaper_task is None or self._reaper_task.done():
+            self._reaper_task = asyncio.create_task(self._reap_idle_sessions(), name="mcp-session-reaper")
+
+    async def _reap_idle_sessions(self):
+        while self._sessions:
+            await asyncio.sleep(5)
+            now = time.monotonic()
+            for entry in list(self._sessions.values()):
+                server_config = next((sc for sc in SERVER_CONFIGURATIONS if sc.get('id') == entry.server_id), None)
+                idle_timeout = get_server_setting(server_config, "sessionIdleTimeoutSeconds")
+                if server_config is not None and get_server_setting(server_config, "startup") == "eager":
+                    continue # Kept running by its supervisor
+                if entry.leases == 0 and idle_timeout and now - entry.last_used > idle_timeout:
+                    LOGGER.info(f"Session Pool: Closing idle session for server '{entry.server_id}'.")
+                    await self.close(entry.server_id)
+
+SESSION_POOL = MCPSessionPool()
+SESSION_POOL.tool_list_changed_callback = lambda server_id: schedule_tool_list_refresh(server_id)
 
-    if not client_target:
-        sys.stderr.write(f"Async Discover: No valid client target for server '{server_id}' (type: {server_type}). Skipping.\n"); sys.stderr.flush() # Keep warning
+async def _discover_tools_for_server_async(server_config, current_fastmcp_module):
+    # This function will encapsulate the logic for discovering tools from a single server.
+    # It should return a list of tool definitions from this server.
+    # Discovery goes through SESSION_POOL, so the session it opens is reused by later tool calls.
+    server_id = server_config.get('id')
+    server_type = server_config.get('type')
+    tools_from_this_server = []
+
+    # print_debug(f"Async Discover: Processing server '{server_id}' (Type: {server_type})")
+
+    if not build_client_target(server_config):
+        LOGGER.warning(f"Async Discover: No valid client target for server '{server_id}' (type: {server_type}). Skipping.")
         return tools_from_this_server
 
     try:
-        # server_id for Client constructor is not yet defined in fastmcp.Client API
-        # Pass only target for now. Context might be passed via methods if needed by the library.
-        async with current_fastmcp_module.Client(client_target) as client:
+        async with SESSION_POOL.session(server_config, current_fastmcp_module) as client:
             # print_debug(f"Async Discover: [{server_id}] Calling 'tools/list'...")
             raw_tools_data = await client.list_tools()
 
             for tool in raw_tools_data:
-                tool_def = {}
-                tool_def['name'] = tool.name
-                tool_def['tool'] = tool
-                tool_def['mcp_server_id'] = server_id
-                tool_def['mcp_server_url'] = server_config.get("url")
-                tool_def['mcp_server_command'] = server_config.get("command")
-                tool_def['mcp_server_type'] = server_type
-                tools_from_this_server.append(tool_def)
+                tools_from_this_server.append(tool_to_definition(tool, server_config))
             # print_debug(f"Async Discover: Successfully discovered {len(tools_from_this_server)} tools from '{server_id}'.")
     except Exception as e:
-        sys.stderr.write(f"Async Discover: Error during async tool discovery for server '{server_id}': {e}\n"); sys.stderr.flush() # Keep error
-        # tools_from_this_server will be empty or partially filled, and returned.
+        LOGGER.error(f"Async Discover: Error during async tool discovery for server '{server_id}': {e}")
+        # Re-raise so callers can tell a failed discovery apart from a server with no tools
+        raise
 
     return tools_from_this_server
 
+def tool_to_definition(tool, server_config):
+    """
+    Converts an MCP Tool object into the plain, JSON-serializable tool definition the host
+    registers and caches. Handles both the camelCase and snake_case Tool field names.
+    """
+    input_schema = getattr(tool, 'input_schema', None)
+    if input_schema is None: input_schema = getattr(tool, 'inputSchema', None)
+    annotations = getattr(tool, 'annotations', None)
+    if annotations is not None and hasattr(annotations, 'model_dump'):
+        annotations = annotations.model_dump(by_alias=True, exclude_none=True)
+    meta = getattr(tool, 'meta', None) or getattr(tool, '_meta', None) or {}
+    tags = (meta.get('fastmcp') or {}).get('tags') if isinstance(meta, dict) else None # FastMCP servers publish tool tags here
+    return {
+        'name': tool.name,
+        'description': getattr(tool, 'description', None),
+        'inputSchema': input_schema if isinstance(input_schema, dict) else {},
+        'annotations': annotations if isinstance(annotations, dict) else {},
+        'tags': sorted(tags) if isinstance(tags, (list, tuple, set)) else [],
+        'mcp_server_id': server_config.get('id'),
+        'mcp_server_url': server_config.get("url"),
+        'mcp_server_command': server_config.get("command"),
+        'mcp_server_type': server_config.get('type'),
+    }
+
 async def _execute_tool_call_async(tool_name, parameters, server_config, current_fastmcp_module, parsed_call_id_for_logging):
     # This function will execute a single tool call.
     # It should return the result from the tool.
@@ -270,490 +1194,2069 @@ async def _execute_tool_call_async(tool_name, parameters, server_config, current
 
     # print_debug(f"Async Execute: Preparing tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) on server '{mcp_server_id}' (Type: {server_type})")
 
-    client_target = None
-    if server_type == "streamable-http" or server_type == "sse":
-        client_target = server_config.get('url')
-    elif server_type == "stdio":
-        # For stdio, fastmcp needs MCPConfig format
-        command = server_config.get('command')
-        args = server_config.get('args', [])
-        if command:
-            client_target = {
-                "mcpServers": {
-                    mcp_server_id: {
-                        "command": command,
-                        "args": args if args else []
-                    }
-                }
-            }
-
-    if not client_target:
-        sys.stderr.write(f"Async Execute: No valid client target for server '{mcp_server_id}' (type: {server_type}) for tool '{tool_name}'.\n"); sys.stderr.flush() # Keep error
+    if not build_client_target(server_config):
+        LOGGER.error(f"Async Execute: No valid client target for server '{mcp_server_id}' (type: {server_type}) for tool '{tool_name}'.")
         # Consider raising an exception or returning an error structure
         raise ValueError(f"Cannot determine client target for server {mcp_server_id} to execute {tool_name}")
 
-    try:
-        async with current_fastmcp_module.Client(client_target) as client:
+    for attempt in range(2):
+        client = None
+        try:
+            client = await SESSION_POOL.acquire(server_config, current_fastmcp_module)
             # print_debug(f"Async Execute: Executing tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) async with params: {parameters} via MCP client for server '{mcp_server_id}'.")
-            tool_result = await client.call_tool(tool_name, parameters)
+            started = time.perf_counter()
+            try:
+                tool_result = await client.call_tool(tool_name, parameters)
+            except Exception:
+                METRICS.observe("mcp_host_call_tool_seconds", time.perf_counter() - started, server=mcp_server_id, tool=tool_name, outcome="error")
+                raise
+            METRICS.observe("mcp_host_call_tool_seconds", time.perf_counter() - started, server=mcp_server_id, tool=tool_name, outcome="ok")
             # print_debug(f"Async Execute: Tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) async executed successfully. Raw Result: {str(tool_result)[:200]}...")
-            
-            # Create a default result structure if tool_result is None or empty
-            if tool_result is None:
-                sys.stderr.write(f"Async Execute: Tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) returned None. Creating default result structure.\n"); sys.stderr.flush()
-                # Create a simple object with a text attribute to maintain compatibility
-                class DefaultResult:
-                    def __init__(self):
-                        self.text = "(No data returned by tool)"
-                tool_result = [DefaultResult()]
-    except Exception as e:
-        sys.stderr.write(f"Async Execute: Error during async execution of tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) on server '{mcp_server_id}': {e}\n"); sys.stderr.flush() # Keep error
-        # Propagate the exception to be handled by the caller in the message loop
-        raise
+            SESSION_POOL.release(mcp_server_id, client)
+            break
+        except asyncio.CancelledError:
+            # Timed out or cancelled by the user: hand the session back; the breaker decides if it is wedged
+            if client is not None: SESSION_POOL.release(mcp_server_id, client)
+            raise
+        except Exception as e:
+            # A pooled session may have died since it was last used (server restarted, connection dropped).
+            # Drop it and retry once on a fresh session; errors on a healthy session are the tool's own.
+            session_died = (client is None or is_connection_closed(e)
+                            or not (client.is_connected() if hasattr(client, 'is_connected') else True))
+            if client is not None: SESSION_POOL.release(mcp_server_id, client, discard=session_died)
+            if session_died and attempt == 0:
+                LOGGER.warning(f"Async Execute: Session for server '{mcp_server_id}' is no longer connected. Reconnecting to retry tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}).")
+                continue
+            LOGGER.error(f"Async Execute: Error during async execution of tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) on server '{mcp_server_id}': {e}")
+            # Propagate the exception to be handled by the caller in the message loop
+            raise
+
+    # Create a default result structure if tool_result is None or empty
+    if tool_result is None:
+        LOGGER.info(f"Async Execute: Tool '{tool_name}' (Call ID: {parsed_call_id_for_logging}) returned None. Creating default result structure.")
+        # Create a simple object with a text attribute to maintain compatibility
+        class DefaultResult:
+            def __init__(self):
+                self.text = "(No data returned by tool)"
+        tool_result = [DefaultResult()]
 
     return tool_result
 
-def parse_tool_call_xml(xml_string, received_call_id_attr=None):
+def format_tool_list_markdown(tools):
+    """Formats discovered tool definitions into the markdown list injected into the system prompt."""
+    md_parts = []
+    if not tools:
+        return "No tools available." # Placeholder if no tools are discovered
+    # print_debug(f"Formatting {len(tools)} discovered tools for system prompt...")
+    for tool_info in tools:
+        tool_md = []
+        tool_md.append(f" - {tool_info.get('exposed_name') or tool_info.get('name', 'Unnamed Tool')}")
+        tool_md.append(f"   **Description**: {tool_info.get('description')}")
+        tool_md.append(f"   **Parameters**:")
+
+        params_schema = tool_info.get('inputSchema')
+        properties = None
+        if isinstance(params_schema, dict):
+            properties = params_schema.get('properties')
+
+        if properties and isinstance(properties, dict) and len(properties) > 0:
+            required_params = params_schema.get('required', [])
+            for param_name, param_details in properties.items():
+                if not isinstance(param_details, dict):
+                    LOGGER.warning(f"Warning: Parameter '{param_name}' for tool '{tool_info.get('name')}' has invalid details format. Skipping.")
+                    continue
+                param_desc = param_details.get('description', '')
+                param_type = param_details.get('type', 'any')
+                is_req = 'required' if param_name in required_params else 'optional'
+                tool_md.append(f"     - `{param_name}`: {param_desc} ({param_type}) ({is_req})")
+        else:
+            tool_md.append(f"     - No parameters defined.")
+
+        md_parts.append("\n".join(tool_md) + "\n") # Add extra newline after each tool block
+
+    formatted = "\n".join(md_parts) # Join all tool blocks
+    # Remove last extra newline if string is not empty, to avoid triple newline before </SYSTEM>
+    if formatted.endswith("\n\n"):
+        formatted = formatted[:-1]
+    return formatted
+
+def refresh_formatted_tool_list():
+    global FORMATTED_TOOL_LIST_MD
+    FORMATTED_TOOL_LIST_MD = render_tool_list(TOOL_REGISTRY)
+    # print_debug(f"Formatted tool list MD:\n{FORMATTED_TOOL_LIST_MD}") # Can be very verbose
+
+# --- System prompt rendering ---
+# The tool list is rendered per server and cached by the server's tool digest, so when one server's
+# tools change only its fragment is re-rendered. Full prompts are cached per (registry version, filter).
+
+def normalize_prompt_filter(payload):
     """
-    Parses an XML string containing tool calls.
-    Returns a list of dictionaries, each representing a tool call.
+    Builds a hashable filter from optional REQUEST_PROMPT payload fields 'servers' (server ids)
+    and 'tags' (server or tool tags). Returns (None, None) when the full tool list is wanted.
+    """
+    payload = payload if isinstance(payload, dict) else {}
+    def as_key(value):
+        if isinstance(value, str): value = [value]
+        return tuple(sorted(set(str(v) for v in value))) if isinstance(value, (list, tuple)) and value else None
+    return as_key(payload.get("servers")), as_key(payload.get("tags"))
+
+def _tool_matches_tags(tool_entry, server_config, tags):
+    server_tags = server_config.get("tags", []) if server_config else []
+    return any(tag in server_tags or tag in tool_entry.get("tags", ()) for tag in tags)
+
+def get_tool_list_fragment(registry, server_id, tool_entries):
+    fragment_key = (server_id, registry.server_digests.get(server_id), tuple(t['exposed_name'] for t in tool_entries))
+    fragment = TOOL_LIST_FRAGMENT_CACHE.get(fragment_key)
+    if fragment is None:
+        fragment = format_tool_list_markdown(tool_entries)
+        TOOL_LIST_FRAGMENT_CACHE[fragment_key] = fragment
+    return fragment
+
+def render_tool_list(registry, prompt_filter=(None, None)):
+    """Renders the markdown tool list for the registry, optionally limited to some servers or tags."""
+    server_ids, tags = prompt_filter
+    fragments = []
+    for server_id in registry.server_order:
+        if server_ids and server_id not in server_ids:
+            continue
+        tool_entries = registry.entries_by_server.get(server_id, [])
+        if tags:
+            server_config = registry.servers.get(server_id)
+            tool_entries = [t for t in tool_entries if _tool_matches_tags(t, server_config, tags)]
+        if tool_entries:
+            fragments.append(get_tool_list_fragment(registry, server_id, tool_entries))
+    return "\n".join(fragments) if fragments else "No tools available."
+
+def render_system_prompt(prompt_filter=(None, None)):
+    """
+    Returns (prompt, tool_count, from_cache) for the current registry and filter, rendering it
+    only if this registry version, filter and call mode have not been rendered before.
+    """
+    registry = TOOL_REGISTRY
+    multi_call = bool(HOST_SETTINGS.get("multiToolCalls"))
+    cache_key = (registry.version, prompt_filter, multi_call)
+    cached = PROMPT_CACHE.get(cache_key)
+    if cached is not None:
+        return cached[0], cached[1], True
+
+    if any(key[0] != registry.version for key in PROMPT_CACHE):
+        # Tools changed: drop prompts for old versions and fragments for tool sets no longer registered
+        PROMPT_CACHE.clear()
+        live_digests = set(registry.server_digests.items())
+        for fragment_key in [k for k in TOOL_LIST_FRAGMENT_CACHE if (k[0], k[1]) not in live_digests]:
+            del TOOL_LIST_FRAGMENT_CACHE[fragment_key]
+
+    if prompt_filter == (None, None):
+        # FORMATTED_TOOL_LIST_MD is kept in step with the registry (and may come straight from the catalog cache)
+        tool_list_for_prompt = FORMATTED_TOOL_LIST_MD if FORMATTED_TOOL_LIST_MD else ""
+        tool_count = len(registry.tools)
+    else:
+        tool_list_for_prompt = render_tool_list(registry, prompt_filter)
+        server_ids, tags = prompt_filter
+        tool_count = sum(1 for t in registry.tools
+                         if (not server_ids or t['mcp_server_id'] in server_ids)
+                         and (not tags or _tool_matches_tags(t, registry.servers.get(t['mcp_server_id']), tags)))
+
+    final_prompt = BASE_SYSTEM_PROMPT
+    for placeholder, text in (MULTI_CALL_PROMPT_TEXT if multi_call else SINGLE_CALL_PROMPT_TEXT).items():
+        final_prompt = final_prompt.replace(placeholder, text)
+    final_prompt = final_prompt.replace("{dynamic_tool_list_placeholder}", tool_list_for_prompt)
+    if len(PROMPT_CACHE) >= PROMPT_CACHE_MAX_ENTRIES:
+        PROMPT_CACHE.pop(next(iter(PROMPT_CACHE))) # Evict the oldest filter combination
+    PROMPT_CACHE[cache_key] = (final_prompt, tool_count)
+    return final_prompt, tool_count, False
+
+# --- Parameter coercion ---
+# Parameters parsed from Gemini's XML are always strings. Each tool's inputSchema is compiled once, when
+# its server's tools are registered, into a ParameterCoercer that converts them to the declared JSON types
+# and checks required parameters locally, so a malformed call is answered without a server round-trip.
+
+_BOOLEAN_STRINGS = {'true': True, 'false': False, '1': True, '0': False, 'yes': True, 'no': False}
+_INTEGER_RE = re.compile(r'[+-]?\d+')
+
+def _coerce_integer(value):
+    text = value.strip()
+    if _INTEGER_RE.fullmatch(text):
+        return int(text)
+    number = float(text) # Raises ValueError for non-numbers
+    if not number.is_integer():
+        raise ValueError(f"expected an integer, got '{value}'")
+    return int(number)
+
+def _coerce_number(value):
+    text = value.strip()
+    return int(text) if _INTEGER_RE.fullmatch(text) else float(text)
+
+def _coerce_boolean(value):
+    try: return _BOOLEAN_STRINGS[value.strip().lower()]
+    except KeyError: raise ValueError(f"expected true or false, got '{value}'") from None
+
+def _coerce_json(json_type, python_type):
+    def _coerce(value):
+        try: parsed = json.loads(value)
+        except json.JSONDecodeError as e: raise ValueError(f"expected a JSON {json_type}: {e.msg} at position {e.pos}") from None
+        if not isinstance(parsed, python_type):
+            raise ValueError(f"expected a JSON {json_type}, got {type(parsed).__name__}")
+        return parsed
+    return _coerce
+
+def _coerce_null(value):
+    if value.strip() not in ('', 'null', 'None'):
+        raise ValueError(f"expected null, got '{value}'")
+    return None
+
+_TYPE_COERCERS = { # JSON Schema type -> converter from the XML string (tried in this order)
+    'null': _coerce_null,
+    'integer': _coerce_integer,
+    'number': _coerce_number,
+    'boolean': _coerce_boolean, # After the numbers, so "1" for ["integer", "boolean"] stays 1 rather than True
+    'array': _coerce_json('array', list),
+    'object': _coerce_json('object', dict),
+}
+
+def _json_type_name(value):
+    if value is None: return 'null'
+    if isinstance(value, bool): return 'boolean'
+    if isinstance(value, (int, float)): return 'number'
+    if isinstance(value, list): return 'array'
+    if isinstance(value, dict): return 'object'
+    return 'string'
+
+def _schema_types(schema, root_schema, depth=0):
+    """Collects the JSON types a property schema allows, following local $refs and anyOf/oneOf/allOf."""
+    if not isinstance(schema, dict) or depth > 8:
+        return set()
+    ref = schema.get('$ref')
+    if isinstance(ref, str) and ref.startswith('#/'):
+        target = root_schema
+        for part in ref[2:].split('/'):
+            target = target.get(part) if isinstance(target, dict) else None
+        return _schema_types(target, root_schema, depth + 1)
+    declared = schema.get('type')
+    types = {declared} if isinstance(declared, str) else set(declared or ())
+    for keyword in ('anyOf', 'oneOf', 'allOf'):
+        for sub_schema in schema.get(keyword) or ():
+            types |= _schema_types(sub_schema, root_schema, depth + 1)
+    if not types and isinstance(schema.get('enum'), list):
+        types = {_json_type_name(v) for v in schema['enum']}
+    return types
+
+class ParameterCoercer:
+    """
+    Converts a tool call's string parameters to the types declared in the tool's inputSchema.
+
+    Only strings are converted; a property that allows 'string' is left as text. Parameters the
+    schema does not describe are passed through unchanged and left for the server to judge.
+    """
+    def __init__(self, input_schema):
+        input_schema = input_schema if isinstance(input_schema, dict) else {}
+        properties = input_schema.get('properties') if isinstance(input_schema.get('properties'), dict) else {}
+        required = input_schema.get('required')
+        self.required = tuple(name for name in required if isinstance(name, str)) if isinstance(required, list) else ()
+        self.converters = {} # parameter name -> (converters to try in order, allowed type names)
+        self.enums = {} # parameter name -> allowed values
+        for name, property_schema in properties.items():
+            types = _schema_types(property_schema, input_schema)
+            if isinstance(property_schema, dict) and isinstance(property_schema.get('enum'), list):
+                self.enums[name] = property_schema['enum']
+            if not types or 'string' in types:
+                continue # Untyped or text: nothing to convert
+            converters = tuple(_TYPE_COERCERS[t] for t in _TYPE_COERCERS if t in types)
+            if converters:
+                self.converters[name] = (converters, " or ".join(sorted(types)))
+
+    def coerce(self, parameters):
+        """Returns (coerced parameters, list of error strings)."""
+        coerced, errors, invalid = {}, [], set()
+        for name, value in (parameters or {}).items():
+            entry = self.converters.get(name)
+            if entry is not None and isinstance(value, str):
+                converters, type_names = entry
+                for converter in converters:
+                    try:
+                        value = converter(value)
+                        break
+                    except (ValueError, OverflowError):
+                        continue
+                else:
+                    errors.append(f"Parameter '{name}' must be {type_names}, got '{value[:100]}'.")
+                    invalid.add(name)
+                    continue
+            allowed = self.enums.get(name)
+            if allowed is not None and value not in allowed:
+                errors.append(f"Parameter '{name}' must be one of {json.dumps(allowed)}, got {json.dumps(value, default=str)[:100]}.")
+                invalid.add(name)
+                continue
+            coerced[name] = value
+        missing = [name for name in self.required if name not in coerced and name not in invalid]
+        if missing:
+            errors.append(f"Missing required parameter(s): {', '.join(missing)}.")
+        return coerced, errors
+
+class ToolRegistry:
+    """
+    Immutable index of discovered tools, built once per change and swapped into TOOL_REGISTRY in
+    a single assignment, so a call in flight always sees one consistent snapshot.
+
+    Tools are ordered by server configuration order (not by which server answered first), and
+    looked up by exposed name or by (server_id, tool_name) in constant time. A tool name offered
+    by several servers is exposed only as '<server_id>__<tool_name>' for each of them; the bare
+    name still routes deterministically to the first server in configuration order. Each tool's
+    ParameterCoercer is compiled here, and reused by later registries while its server is unchanged.
     """
-    tool_calls = []
+    _versions = iter(range(1, sys.maxsize))
+
+    def __init__(self, tools_by_server=None, server_configs=(), server_digests=None, coercers=None):
+        self.version = next(ToolRegistry._versions)
+        self.tools_by_server = dict(tools_by_server or {}) # server_id -> tuple of raw tool definitions
+        self.servers = {sc.get('id'): sc for sc in server_configs} # server_id -> server config
+        self.by_name = {} # exposed name -> tool definition
+        self.by_server_tool = {} # (server_id, tool_name) -> tool definition
+        self.conflicts = {} # bare tool name -> [server_id, ...] when offered by several servers
+        self.tools = [] # Tool definitions listed in the prompt, in configuration order
+        self.entries_by_server = {} # server_id -> that server's entries from self.tools
+        self.coercers = dict(coercers or {}) # (server_id, tool_name) -> ParameterCoercer
+
+        server_order = [sc.get('id') for sc in server_configs]
+        server_order += [sid for sid in self.tools_by_server if sid not in self.servers]
+        self.server_order = server_order
+        # Digest of each server's tool definitions; only servers whose tools changed are re-hashed
+        self.server_digests = {sid: digest for sid, digest in (server_digests or {}).items() if sid in self.tools_by_server}
+        for server_id, tools in self.tools_by_server.items():
+            if server_id not in self.server_digests:
+                self.server_digests[server_id] = hashlib.sha256(json.dumps(tools, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+        owners_by_name = {}
+        for server_id in server_order:
+            for tool_def in self.tools_by_server.get(server_id, ()):
+                owners_by_name.setdefault(tool_def['name'], []).append(tool_def)
+
+        for server_id in server_order:
+            for tool_def in self.tools_by_server.get(server_id, ()):
+                tool_name = tool_def['name']
+                owners = owners_by_name[tool_name]
+                if len(owners) == 1:
+                    exposed_name = tool_name
+                else:
+                    exposed_name = f"{server_id}{TOOL_NAMESPACE_SEPARATOR}{tool_name}"
+                    self.conflicts[tool_name] = [t['mcp_server_id'] for t in owners]
+                entry = dict(tool_def, exposed_name=exposed_name)
+                self.by_name[exposed_name] = entry
+                self.by_server_tool[(server_id, tool_name)] = entry
+                self.tools.append(entry)
+                self.entries_by_server.setdefault(server_id, []).append(entry)
+                if (server_id, tool_name) not in self.coercers:
+                    self.coercers[(server_id, tool_name)] = ParameterCoercer(tool_def.get('inputSchema'))
+                if exposed_name != tool_name and owners[0] is tool_def:
+                    self.by_name.setdefault(tool_name, entry) # Bare-name fallback: first server in config order
+
+    def resolve(self, name):
+        """Returns the tool definition for an exposed or '<server_id>__<tool_name>' name, or None."""
+        tool_def = self.by_name.get(name)
+        if tool_def is None and TOOL_NAMESPACE_SEPARATOR in name:
+            server_id, _, tool_name = name.partition(TOOL_NAMESPACE_SEPARATOR)
+            tool_def = self.by_server_tool.get((server_id, tool_name))
+        return tool_def
+
+    def with_server_tools(self, server_id, tools_from_server, server_configs):
+        """Returns a new registry with one server's tools replaced."""
+        tools_by_server = dict(self.tools_by_server)
+        tools_by_server[server_id] = tuple(tools_from_server)
+        server_digests = {sid: digest for sid, digest in self.server_digests.items() if sid != server_id}
+        coercers = {key: coercer for key, coercer in self.coercers.items() if key[0] != server_id}
+        return ToolRegistry(tools_by_server, server_configs, server_digests, coercers)
+
+    def with_servers(self, server_configs):
+        """Returns a new registry for a reloaded server list, keeping only the tools of servers still enabled in it."""
+        enabled_ids = {sc.get('id') for sc in server_configs if sc.get('enabled', True)}
+        tools_by_server = {sid: tools for sid, tools in self.tools_by_server.items() if sid in enabled_ids}
+        coercers = {key: coercer for key, coercer in self.coercers.items() if key[0] in enabled_ids}
+        return ToolRegistry(tools_by_server, server_configs, self.server_digests, coercers)
+
+def register_discovered_tools(server_id, tools_from_server, refresh_prompt=True):
+    """
+    Replaces the tools registered for one server by building a new ToolRegistry and swapping
+    it in atomically.
+    """
+    global TOOL_REGISTRY
+    if not any(sc.get('id') == server_id and sc.get('enabled', True) for sc in SERVER_CONFIGURATIONS):
+        LOGGER.info(f"Ignoring tools from server '{server_id}': it is no longer enabled in the configuration.")
+        return # Discovery finished after a config reload removed or disabled the server
+    TOOL_REGISTRY = TOOL_REGISTRY.with_server_tools(server_id, tools_from_server, SERVER_CONFIGURATIONS)
+    if refresh_prompt: refresh_formatted_tool_list()
+    _signal_discovery_progress()
+
+# --- Tool catalog cache ---
+# Discovered tools are persisted next to mcp_servers_config.json so a freshly spawned host can answer
+# REQUEST_PROMPT immediately from the last known catalog while discovery revalidates it in the background.
+
+def compute_server_config_hash(server_config):
+    """Hashes everything in a server definition that can affect its tools ('notes' is ignored)."""
+    relevant = {k: v for k, v in server_config.items() if k != 'notes'}
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def get_catalog_cache_path():
+    config_dir = os.path.dirname(CONFIG_PATH) if CONFIG_PATH else os.path.dirname(os.path.abspath(__file__))
+    return os.path.join(config_dir, CATALOG_CACHE_FILENAME)
+
+def load_tool_catalog_cache():
+    global CATALOG_CACHE
+    CATALOG_CACHE = {"version": CATALOG_CACHE_VERSION, "servers": {}}
+    cache_path = get_catalog_cache_path()
+    if not os.path.exists(cache_path):
+        return CATALOG_CACHE
     try:
-        # print_debug(f"Attempting to parse XML: {xml_string}")
-        # Sanitize common problematic characters if any (though ET should handle most standard XML)
-        # xml_string = xml_string.replace('&', '&amp;') # ET usually handles this. Be careful not to double-escape.
-
-        root = ET.fromstring(xml_string)
-
-        invoke_elements = []
-        if root.tag == 'function_calls':
-            invoke_elements = root.findall('invoke')
-            if not invoke_elements: # Check if root itself might be a mis-nested invoke
-                 sys.stderr.write(f"Warning: <function_calls> root found, but no <invoke> children. XML: {xml_string}\n"); sys.stderr.flush() # Keep warning
-        elif root.tag == 'invoke':
-            invoke_elements.append(root)
+        with open(cache_path, 'r') as f: data = json.load(f)
+        if isinstance(data, dict) and data.get("version") == CATALOG_CACHE_VERSION and isinstance(data.get("servers"), dict):
+            CATALOG_CACHE = data
         else:
-            sys.stderr.write(f"Error: XML root is neither <function_calls> nor <invoke>. Root tag: {root.tag}. XML: {xml_string}\n"); sys.stderr.flush() # Keep error
-            return [{"error": f"XML root is not <function_calls> or <invoke>, got <{root.tag}>", "raw_xml": xml_string, "call_id": received_call_id_attr}]
+            LOGGER.warning(f"Tool catalog cache at {cache_path} has an unknown format. Ignoring it.")
+    except Exception as e:
+        LOGGER.warning(f"Could not read tool catalog cache {cache_path}: {e}")
+    return CATALOG_CACHE
 
-        if not invoke_elements:
-            # print_debug(f"Warning: No <invoke> elements found after parsing. XML: {xml_string}") # Can be noisy if non-tool XML is common
-            # Return an error if received_call_id_attr was present, as an invocation was expected.
-            if received_call_id_attr: # This implies it was a TOOL_CALL_DETECTED message type
-                 return [{"error": "No <invoke> elements found in XML", "raw_xml": xml_string, "call_id": received_call_id_attr}]
-            return []
+def save_tool_catalog_cache():
+    cache_path = get_catalog_cache_path()
+    CATALOG_CACHE["formatted_tool_list_md"] = FORMATTED_TOOL_LIST_MD
+    CATALOG_CACHE["server_order"] = [sc.get('id') for sc in SERVER_CONFIGURATIONS if sc.get('enabled', True)]
+    try:
+        temp_path = cache_path + ".tmp"
+        with open(temp_path, 'w') as f: json.dump(CATALOG_CACHE, f)
+        os.replace(temp_path, cache_path) # Atomic, so a concurrently starting host never reads a partial file
+    except Exception as e:
+        LOGGER.warning(f"Could not write tool catalog cache {cache_path}: {e}")
+
+def update_catalog_cache_entry(server_config, tools_from_server, save=True):
+    """Records one server's discovered tools; save=False leaves writing the file to the caller (e.g. once per discovery)."""
+    CATALOG_CACHE["servers"][server_config.get('id')] = {
+        "config_hash": compute_server_config_hash(server_config),
+        "discovered_at": time.time(),
+        "tools": tools_from_server,
+    }
+    if save: save_tool_catalog_cache()
 
+def invalidate_catalog_cache_entry(server_id):
+    if CATALOG_CACHE["servers"].pop(server_id, None) is not None:
+        save_tool_catalog_cache()
 
-        for invoke_element in invoke_elements:
-            tool_name = invoke_element.get('name')
-            call_id_from_xml = invoke_element.get('call_id')
+def catalog_cache_entry_is_current(server_config):
+    """True if the catalog cache holds tools for this exact server configuration."""
+    entry = CATALOG_CACHE["servers"].get(server_config.get('id'))
+    return bool(entry) and entry.get("config_hash") == compute_server_config_hash(server_config)
 
-            final_call_id = call_id_from_xml # Prefer call_id from XML content
-            if not final_call_id and received_call_id_attr:
-                final_call_id = received_call_id_attr
-                # print_debug(f"Used call_id ('{received_call_id_attr}') from content_script attribute as XML was missing one for tool '{tool_name}'.")
-            elif call_id_from_xml and received_call_id_attr and call_id_from_xml != received_call_id_attr:
-                sys.stderr.write(f"Warning: call_id from XML ('{call_id_from_xml}') differs from content_script attribute ('{received_call_id_attr}') for tool '{tool_name}'. Using XML value.\n"); sys.stderr.flush() # Keep warning
+def apply_cached_catalog():
+    """
+    Registers cached tools for every enabled server whose config hash still matches.
+    Returns True if the cache covered every enabled server, i.e. the prompt can be served right away.
+    """
+    global FORMATTED_TOOL_LIST_MD, CATALOG_PARTLY_CACHED
+    load_tool_catalog_cache()
+    enabled_servers = [sc for sc in SERVER_CONFIGURATIONS if sc.get('enabled', True)]
+    served_from_cache = []
+    for server_config in enabled_servers:
+        server_id = server_config.get('id')
+        if not catalog_cache_entry_is_current(server_config):
+            continue # Missing, or the server's config changed since it was cached
+        register_discovered_tools(server_id, CATALOG_CACHE["servers"][server_id].get("tools", []), refresh_prompt=False)
+        served_from_cache.append(server_id)
+    fully_cached = len(served_from_cache) == len(enabled_servers)
+    CATALOG_PARTLY_CACHED = bool(served_from_cache) and not fully_cached
+    if fully_cached and CATALOG_CACHE.get("server_order") == served_from_cache and CATALOG_CACHE.get("formatted_tool_list_md"):
+        FORMATTED_TOOL_LIST_MD = CATALOG_CACHE["formatted_tool_list_md"] # Reuse the rendered list as-is
+    else:
+        refresh_formatted_tool_list()
+    if served_from_cache:
+        LOGGER.info(f"Tool catalog cache: Serving {len(TOOL_REGISTRY.tools)} cached tools from {len(served_from_cache)} of {len(enabled_servers)} servers while revalidating.")
+    return fully_cached
 
-            if not tool_name:
-                sys.stderr.write(f"Warning: <invoke> element missing 'name' attribute. Skipping. XML: {ET.tostring(invoke_element, encoding='unicode')}\n"); sys.stderr.flush() # Keep warning
-                # Optionally, could append an error object to tool_calls here
-                continue
-            if not final_call_id:
-                sys.stderr.write(f"Warning: <invoke> element for tool '{tool_name}' missing 'call_id' (both in XML and from attribute). Skipping. XML: {ET.tostring(invoke_element, encoding='unicode')}\n"); sys.stderr.flush() # Keep warning
-                # Optionally, could append an error object
+def schedule_tool_list_refresh(server_id):
+    """
+    Handles an MCP notifications/tools/list_changed from a server: drops its cache entry and
+    rediscovers just that server in the background.
+    """
+    if server_id in TOOL_REFRESH_TASKS and not TOOL_REFRESH_TASKS[server_id].done():
+        return # A refresh for this server is already running
+    LOGGER.info(f"Server '{server_id}' reported a tool list change. Refreshing its tools.")
+    invalidate_catalog_cache_entry(server_id)
+    TOOL_REFRESH_TASKS[server_id] = asyncio.create_task(refresh_server_tools(server_id), name=f"mcp-refresh-{server_id}")
+
+async def refresh_server_tools(server_id):
+    server_config = next((sc for sc in SERVER_CONFIGURATIONS if sc.get('id') == server_id), None)
+    if not server_config or not server_config.get('enabled', True):
+        return
+    _, discovered_list = await _discover_server_with_timeout(server_config)
+    if discovered_list is not None:
+        register_discovered_tools(server_id, discovered_list)
+        update_catalog_cache_entry(server_config, discovered_list)
+
+def _signal_discovery_progress():
+    # Wake everything waiting for more tools, then arm a fresh event for the next server
+    global DISCOVERY_PROGRESS
+    DISCOVERY_PROGRESS.set()
+    DISCOVERY_PROGRESS = asyncio.Event()
+
+# --- Circuit breakers ---
+# A server that keeps failing (connection errors, timeouts) is failed fast instead of being retried by every
+# call; after a backoff a single probe call is let through to find out whether it has recovered.
+
+class CircuitBreaker:
+    """
+    Per-server circuit breaker. Closed: calls go through. After circuitBreakerFailureThreshold
+    consecutive failures it opens and calls are rejected until the backoff has elapsed; it then
+    lets one probe call through (half-open). A successful probe closes it again, a failed one
+    reopens it with the backoff doubled, up to circuitBreakerMaxResetSeconds.
+    """
+    CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+    def __init__(self, server_id, failure_threshold=5, reset_seconds=30, max_reset_seconds=300):
+        self.server_id = server_id
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.max_reset_seconds = max(reset_seconds, max_reset_seconds)
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.backoff_seconds = reset_seconds
+        self.open_until = 0.0
+        self.last_error = None
+        self.trips = 0 # Times the circuit has opened
+        self.rejected_calls = 0 # Calls failed fast while open
+        self._probe_in_flight = False
+
+    def allow_request(self):
+        """Returns True if a call may go to the server now (claiming the probe slot when half-open)."""
+        if self.state == self.CLOSED or not self.failure_threshold:
+            return True
+        if self.state == self.OPEN and time.monotonic() >= self.open_until:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        if self.state == self.HALF_OPEN and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        self.rejected_calls += 1
+        return False
+
+    def record_success(self):
+        if self.state != self.CLOSED:
+            LOGGER.info(f"Circuit breaker: Server '{self.server_id}' recovered. Closing circuit.")
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.backoff_seconds = self.reset_seconds
+        self._probe_in_flight = False
+
+    def record_failure(self, error):
+        """Counts a server-level failure. Returns True if this failure opened the circuit."""
+        self.consecutive_failures += 1
+        self.last_error = str(error)[:200]
+        if not self.failure_threshold:
+            return False
+        if self.state == self.HALF_OPEN:
+            self.backoff_seconds = min(self.backoff_seconds * 2, self.max_reset_seconds)
+        elif self.state == self.OPEN or self.consecutive_failures < self.failure_threshold:
+            return False
+        self.state = self.OPEN
+        self.open_until = time.monotonic() + self.backoff_seconds
+        self._probe_in_flight = False
+        self.trips += 1
+        LOGGER.warning(f"Circuit breaker: Server '{self.server_id}' failed {self.consecutive_failures} times in a row ({self.last_error}). Failing calls fast for {self.backoff_seconds:g}s.")
+        return True
+
+    def release_probe(self):
+        """Frees the half-open probe slot when the probe call ended without an outcome (e.g. cancelled)."""
+        self._probe_in_flight = False
+
+    def retry_after(self):
+        return max(0.0, self.open_until - time.monotonic()) if self.state == self.OPEN else 0.0
+
+    def snapshot(self):
+        return {"state": self.state, "consecutive_failures": self.consecutive_failures,
+                "retry_after_seconds": round(self.retry_after(), 1), "backoff_seconds": self.backoff_seconds,
+                "trips": self.trips, "rejected_calls": self.rejected_calls, "last_error": self.last_error}
+
+def get_circuit_breaker(server_config):
+    """Returns the server's CircuitBreaker, creating it from its settings on first use."""
+    server_id = server_config.get('id')
+    breaker = CIRCUIT_BREAKERS.get(server_id)
+    if breaker is None:
+        breaker = CircuitBreaker(server_id,
+                                 failure_threshold=int(get_server_setting(server_config, "circuitBreakerFailureThreshold") or 0),
+                                 reset_seconds=float(get_server_setting(server_config, "circuitBreakerResetSeconds")),
+                                 max_reset_seconds=float(get_server_setting(server_config, "circuitBreakerMaxResetSeconds")))
+        CIRCUIT_BREAKERS[server_id] = breaker
+    return breaker
+
+MCP_CONNECTION_CLOSED = -32000 # JSON-RPC error code the MCP client raises itself when the connection or process is gone
+
+def is_connection_closed(error):
+    """True for the McpError a client raises when its server process exited or its connection dropped."""
+    error_data = getattr(error, 'error', None)
+    # Servers may use the same code for errors of their own, so the client's message is checked too
+    return getattr(error_data, 'code', None) == MCP_CONNECTION_CLOSED and getattr(error_data, 'message', None) == "Connection closed"
+
+def is_server_failure(error):
+    """
+    True for errors that say the server is unreachable or unresponsive (connection failures,
+    timeouts). Errors the server itself returned, such as a tool failing, show it is alive.
+    """
+    if fastmcp is not None: # Until fastmcp is imported, nothing can have raised one of its errors
+        from fastmcp.exceptions import McpError, ToolError
+        if isinstance(error, (ToolError, McpError)): return is_connection_closed(error)
+    return not isinstance(error, ValueError)
+
+def record_server_outcome(server_config, error=None):
+    """Feeds a call or discovery outcome to the server's breaker; an opening circuit drops its pooled session."""
+    breaker = get_circuit_breaker(server_config)
+    if error is None or not is_server_failure(error):
+        breaker.record_success()
+    elif breaker.record_failure(error):
+        # The session may be wedged (e.g. a hung stdio server); the probe call will reconnect
+        spawn_task(SESSION_POOL.close(server_config.get('id')), name=f"close-session-{server_config.get('id')}")
+
+async def _discover_server_with_timeout(server_config):
+    """
+    Discovers one server's tools, bounded by its 'discoveryTimeoutSeconds', and logs how long it took.
+    Returns (server_id, tools), with tools None if discovery failed or timed out.
+    """
+    server_id = server_config.get('id')
+    timeout = get_server_setting(server_config, "discoveryTimeoutSeconds")
+    started = time.perf_counter()
+    try:
+        fastmcp_module = await import_fastmcp() # Not counted against the server's timeout
+        started = time.perf_counter()
+        discovered_list = await asyncio.wait_for(_discover_tools_for_server_async(server_config, fastmcp_module), timeout=timeout or None)
+    except asyncio.TimeoutError as e:
+        LOGGER.warning(f"Discovery: Server '{server_id}' timed out after {time.perf_counter() - started:.2f}s (limit {timeout}s).")
+        STARTUP_PROFILE.record(f"discover '{server_id}' (timed out)", started)
+        record_server_outcome(server_config, e)
+        return server_id, None
+    except Exception as e:
+        # This catches errors if _discover_tools_for_server_async re-raised an exception
+        LOGGER.error(f"Failed to discover tools from server '{server_id}' due to an error after {time.perf_counter() - started:.2f}s: {e}")
+        STARTUP_PROFILE.record(f"discover '{server_id}' (failed)", started)
+        record_server_outcome(server_config, e)
+        return server_id, None
+    record_server_outcome(server_config)
+    LOGGER.info(f"Discovery: Server '{server_id}' returned {len(discovered_list)} tools in {time.perf_counter() - started:.2f}s.")
+    STARTUP_PROFILE.record(f"discover '{server_id}' ({len(discovered_list)} tools)", started)
+    return server_id, discovered_list
+
+async def discover_all_tools(server_configs=None):
+    """
+    Discovers tools from every enabled server (or just server_configs, after a config reload)
+    concurrently, registering each server's tools as soon as it answers. Sets DISCOVERY_COMPLETE
+    once every server has answered or timed out. A server that fails keeps any tools already
+    served from the catalog cache.
+    """
+    LOGGER.info("Starting tool discovery...")
+    started = time.perf_counter()
+    pending = []
+    configs_by_id = {}
+    for server_config in (SERVER_CONFIGURATIONS if server_configs is None else server_configs):
+        if not server_config.get('enabled', True): # Default to True if missing
+            LOGGER.info(f"Skipping disabled server: '{server_config.get('id')}'")
+            continue
+        if get_server_setting(server_config, "startup") == "on-demand" and catalog_cache_entry_is_current(server_config):
+            LOGGER.info(f"Skipping on-demand server '{server_config.get('id')}': its tools are in the catalog cache.")
+            continue
+        configs_by_id[server_config.get('id')] = server_config
+        pending.append(_discover_server_with_timeout(server_config))
+
+    cache_updated = False
+    try:
+        for next_finished in asyncio.as_completed(pending):
+            server_id, discovered_list = await next_finished
+            if discovered_list is not None:
+                register_discovered_tools(server_id, discovered_list)
+                update_catalog_cache_entry(configs_by_id[server_id], discovered_list, save=False)
+                cache_updated = True
+    finally:
+        if cache_updated: save_tool_catalog_cache() # One write for the whole discovery, not one per server
+        DISCOVERY_COMPLETE.set()
+        CATALOG_READY.set()
+        _signal_discovery_progress()
+
+    LOGGER.info(f"Discovery finished in {time.perf_counter() - started:.2f}s.")
+    registry = TOOL_REGISTRY
+    if registry.tools:
+        LOGGER.info(f"--- Total tools discovered across all servers: {len(registry.tools)} ---")
+        for tool_name, server_ids in registry.conflicts.items():
+            namespaced = ", ".join(f"'{sid}{TOOL_NAMESPACE_SEPARATOR}{tool_name}'" for sid in server_ids)
+            LOGGER.warning(f"    WARNING: Duplicate tool_name '{tool_name}' on servers {server_ids}. Exposing as {namespaced}; bare name routes to '{server_ids[0]}'.")
+    else:
+        LOGGER.info("No tools were discovered from any active server.")
+
+# --- Server supervision ---
+# Servers with "startup": "eager" are connected as soon as the host starts, so the first tool call never
+# waits for a server process to boot, and are then kept running by a supervisor task each. The supervisor
+# pings the server every healthCheckIntervalSeconds, which catches a hung server as well as a stdio process
+# that has exited, and notices at once when the session itself ends. Either failure closes the session, waits
+# out an exponential backoff, and reconnects, which starts a fresh process. Outcomes feed the server's
+# circuit breaker like tool calls do.
+
+SERVER_STARTUP_POLICIES = ("eager", "lazy", "on-demand")
+SERVER_SUPERVISORS = {} # server_id -> (config hash, task supervising that server)
+
+async def supervise_server(server_config):
+    """Keeps one "eager" server connected and healthy until cancelled."""
+    server_id = server_config.get('id')
+    consecutive_failures = 0
+    while True:
+        failure = None
+        try:
+            fastmcp_module = await import_fastmcp()
+            async with SESSION_POOL.session(server_config, fastmcp_module) as client:
+                timeout = float(get_server_setting(server_config, "healthCheckTimeoutSeconds") or 0)
+                await asyncio.wait_for(client.ping(), timeout=timeout or None)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            if is_server_failure(e):
+                failure = "health_check"
+                record_server_outcome(server_config, e)
+                LOGGER.warning(f"Supervisor: Server '{server_id}' failed a health check: {str(e) or type(e).__name__}")
+            # Otherwise the server answered the ping with an error (e.g. it does not implement ping), so it is alive
+        if failure is None:
+            METRICS.inc("mcp_host_health_checks_total", server=server_id, status="ok")
+            record_server_outcome(server_config)
+            if consecutive_failures:
+                LOGGER.info(f"Supervisor: Server '{server_id}' is healthy again.")
+            interval = float(get_server_setting(server_config, "healthCheckIntervalSeconds") or 0)
+            if not await SESSION_POOL.wait_ended(server_id, timeout=interval or None):
+                consecutive_failures = 0 # Healthy for a whole interval
                 continue
+            failure = "session_ended"
+            LOGGER.warning(f"Supervisor: Session for server '{server_id}' ended unexpectedly.")
+        else:
+            METRICS.inc("mcp_host_health_checks_total", server=server_id, status="error")
+
+        consecutive_failures += 1
+        await SESSION_POOL.close(server_id) # Stops a hung process; a dead one is already gone
+        delay = min(float(get_server_setting(server_config, "restartMaxBackoffSeconds")),
+                    float(get_server_setting(server_config, "restartBackoffSeconds")) * 2 ** (consecutive_failures - 1))
+        LOGGER.info(f"Supervisor: Restarting server '{server_id}' in {delay:.1f}s (failure {consecutive_failures}).")
+        METRICS.inc("mcp_host_server_restarts_total", server=server_id, reason=failure)
+        await asyncio.sleep(delay)
+
+def reconcile_supervisors():
+    """Starts a supervisor for each enabled "eager" server, and stops those whose server is gone, disabled, no longer eager or changed."""
+    wanted = {sc.get('id'): sc for sc in SERVER_CONFIGURATIONS
+              if sc.get('enabled', True) and get_server_setting(sc, "startup") == "eager"}
+    for server_id, (config_hash, task) in list(SERVER_SUPERVISORS.items()):
+        if server_id not in wanted or compute_server_config_hash(wanted[server_id]) != config_hash or task.done():
+            task.cancel()
+            del SERVER_SUPERVISORS[server_id]
+    for server_id, server_config in wanted.items():
+        if server_id not in SERVER_SUPERVISORS:
+            task = asyncio.create_task(supervise_server(server_config), name=f"mcp-supervisor-{server_id}")
+            SERVER_SUPERVISORS[server_id] = (compute_server_config_hash(server_config), task)
+
+async def stop_supervisors():
+    tasks = [task for _, task in SERVER_SUPERVISORS.values()]
+    SERVER_SUPERVISORS.clear()
+    for task in tasks: task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+METRICS.describe("mcp_host_health_checks_total", "counter", "Health check pings of supervised servers, by server and outcome.")
+METRICS.describe("mcp_host_server_restarts_total", "counter", "Restarts of supervised servers, by server and reason (health_check or session_ended).")
+
+# --- Config hot reload ---
+# mcp_servers_config.json is watched while the host runs and each edit is applied as a per-server diff:
+# added and changed servers are rediscovered, removed ones dropped, and every other server keeps its
+# session, tools, circuit breaker and cached results. A file that fails to parse leaves the running config alone.
+
+CONFIG_RELOAD_LOCK = asyncio.Lock() # Serializes reloads, including the rediscovery they start
+CONFIG_RELOAD_DEBOUNCE_MS = 500 # Editors often write a file in several steps; wait for them to settle
+LOG_SETTING_KEYS = ("logLevel", "logFile", "logFileMaxBytes", "logFileBackupCount", "logMaxFieldChars")
+STARTUP_ONLY_SETTING_KEYS = ("maxConcurrentToolCalls", "callIdTtlSeconds", "maxTrackedCallIds", "resultCacheMaxBytes",
+                             "metricsLogIntervalSeconds", "configHotReload", "configReloadPollSeconds", "jsonBackend",
+                             "httpMaxConnections", "httpMaxKeepaliveConnections", "httpKeepaliveExpirySeconds", "httpEnableHttp2")
+
+def diff_server_configurations(old_configs, new_configs):
+    """
+    Compares two server lists by id and config hash, counting enabled servers only (so enabling
+    a server adds it and disabling one removes it). Returns (added, changed, removed) server ids.
+    """
+    old_hashes = {sc.get('id'): compute_server_config_hash(sc) for sc in old_configs if sc.get('enabled', True)}
+    new_hashes = {sc.get('id'): compute_server_config_hash(sc) for sc in new_configs if sc.get('enabled', True)}
+    added = [sid for sid in new_hashes if sid not in old_hashes]
+    changed = [sid for sid in new_hashes if sid in old_hashes and new_hashes[sid] != old_hashes[sid]]
+    removed = [sid for sid in old_hashes if sid not in new_hashes]
+    return added, changed, removed
+
+async def reload_server_configurations():
+    """
+    Re-reads mcp_servers_config.json and applies it without restarting the host. The server list,
+    host settings and tool registry are swapped in together; calls already running keep the registry,
+    server config and pooled session they started with. Returns False if the file could not be used.
+    """
+    global SERVER_CONFIGURATIONS, HOST_SETTINGS, TOOL_REGISTRY
+    async with CONFIG_RELOAD_LOCK:
+        # Startup discovery registers tools for the config it started with; let it finish first
+        if DISCOVERY_TASK and not DISCOVERY_TASK.done():
+            await asyncio.gather(DISCOVERY_TASK, return_exceptions=True)
+        loaded = read_server_configurations(CONFIG_PATH)
+        if loaded is None:
+            LOGGER.error(f"Config reload: Could not use {CONFIG_PATH}. Keeping the current configuration.")
+            METRICS.inc("mcp_host_config_reloads_total", status="error")
+            return False
+        new_configs, new_settings = loaded
+        if new_configs == SERVER_CONFIGURATIONS and new_settings == HOST_SETTINGS:
+            LOGGER.debug("Config reload: No changes.")
+            return True
+        added, changed, removed = diff_server_configurations(SERVER_CONFIGURATIONS, new_configs)
+        changed_settings = sorted(k for k in set(HOST_SETTINGS) | set(new_settings) if HOST_SETTINGS.get(k) != new_settings.get(k))
+
+        for server_id in changed + removed:
+            refresh_task = TOOL_REFRESH_TASKS.pop(server_id, None)
+            if refresh_task and not refresh_task.done(): refresh_task.cancel() # Would register tools for the old config
+
+        # The swap. Removed servers' tools disappear at once; changed servers keep their current tools
+        # until rediscovery replaces them, so the prompt never loses tools that are about to come back.
+        SERVER_CONFIGURATIONS, HOST_SETTINGS = new_configs, new_settings
+        TOOL_REGISTRY = TOOL_REGISTRY.with_servers(new_configs)
+        refresh_formatted_tool_list()
+        _signal_discovery_progress()
+        reconcile_supervisors() # Before retiring sessions, so a stopped supervisor does not reconnect a removed server
+
+        if any(k.startswith("circuitBreaker") for k in changed_settings): CIRCUIT_BREAKERS.clear()
+        if "maxConcurrentCalls" in changed_settings: SERVER_SEMAPHORES.clear()
+        for server_id in changed + removed:
+            # Recreated from the new settings on next use; calls in flight hold on to the old ones
+            CIRCUIT_BREAKERS.pop(server_id, None)
+            SERVER_SEMAPHORES.pop(server_id, None)
+            if RESULT_CACHE is not None: RESULT_CACHE.invalidate_server(server_id)
+        for server_id in removed:
+            SESSION_POOL.retire(server_id) # Closed once the calls using it have finished
+            CATALOG_CACHE["servers"].pop(server_id, None)
+        save_tool_catalog_cache()
+        # A changed server whose command/url changed gets a fresh session on its next acquire(); the old one drains
+
+        if any(k in LOG_SETTING_KEYS for k in changed_settings): configure_logging(HOST_SETTINGS)
+        restart_required = [k for k in changed_settings if k in STARTUP_ONLY_SETTING_KEYS]
+        if restart_required:
+            LOGGER.warning(f"Config reload: Host settings {restart_required} only take effect when the host restarts.")
+        LOGGER.info(f"Config reload: Applied {CONFIG_PATH}.", extra={"added": added, "changed": changed, "removed": removed,
+                                                                    "host_settings_changed": changed_settings})
+        METRICS.inc("mcp_host_config_reloads_total", status="applied")
+
+        if added or changed:
+            # Calls naming a tool that is not registered yet wait for these servers, as they do at startup
+            DISCOVERY_COMPLETE.clear()
+            rediscover = set(added + changed)
+            await discover_all_tools([sc for sc in new_configs if sc.get('id') in rediscover and sc.get('enabled', True)])
+        return True
+
+def _config_file_signature(path):
+    try:
+        st = os.stat(path)
+        return (st.st_mtime_ns, st.st_size, st.st_ino)
+    except OSError:
+        return None # Missing for a moment while an editor replaces it
 
-            parameters = {}
-            for param_element in invoke_element.findall('parameter'):
-                param_name = param_element.get('name')
-                if param_name:
-                    parameters[param_name] = param_element.text.strip() if param_element.text else ""
-                else:
-                    sys.stderr.write(f"Warning: <parameter> tag missing 'name' attribute in tool '{tool_name}'. Skipping parameter. XML: {ET.tostring(param_element, encoding='unicode')}\n"); sys.stderr.flush() # Keep warning
+async def watch_config_file(config_path):
+    """
+    Reloads the configuration whenever config_path changes. Uses file system notifications (inotify,
+    FSEvents, ReadDirectoryChangesW) through the optional 'watchfiles' package when it is installed,
+    otherwise polls the file's mtime every 'configReloadPollSeconds'.
+    """
+    try:
+        import watchfiles
+    except ImportError:
+        watchfiles = None
+    config_dir, config_name = os.path.split(config_path)
+    if watchfiles is not None:
+        LOGGER.info(f"Config reload: Watching {config_path} for changes.")
+        try:
+            # The directory is watched rather than the file, since editors often save by replacing it
+            async for _ in watchfiles.awatch(config_dir, watch_filter=lambda change, path: os.path.basename(path) == config_name,
+                                             debounce=CONFIG_RELOAD_DEBOUNCE_MS, recursive=False):
+                await reload_server_configurations()
+            return
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            LOGGER.warning(f"Config reload: File notifications are unavailable ({e}). Falling back to polling.")
 
-            tool_calls.append({
-                "tool_name": tool_name,
-                "parameters": parameters,
-                "call_id": final_call_id,
-                "raw_xml_invoke": ET.tostring(invoke_element, encoding='unicode') # XML for this specific invoke
-            })
+    poll_seconds = max(0.1, float(HOST_SETTINGS.get("configReloadPollSeconds") or DEFAULT_HOST_SETTINGS["configReloadPollSeconds"]))
+    LOGGER.info(f"Config reload: Polling {config_path} for changes every {poll_seconds}s.")
+    signature = _config_file_signature(config_path)
+    while True:
+        await asyncio.sleep(poll_seconds)
+        current = _config_file_signature(config_path)
+        if current is None or current == signature:
+            continue
+        await asyncio.sleep(CONFIG_RELOAD_DEBOUNCE_MS / 1000)
+        signature = _config_file_signature(config_path)
+        await reload_server_configurations()
+
+# --- function_calls parsing ---
+# Gemini's output is "XML-like" rather than XML: parameter values routinely contain bare '&' or '<'
+# (code, nested XML, comparisons). The parser below therefore locates tags with small regexes instead
+# of building a DOM, treats each parameter body as raw text, and works incrementally so each <invoke>
+# is available as soon as the next <invoke> or the end of the block has been seen. Closing tags are
+# matched against those boundaries (the last </invoke> or </parameter> before them), so a value may
+# itself contain a literal </invoke> or </parameter>.
+
+_INVOKE_OPEN_RE = re.compile(r'<invoke(?=[\s/>])')
+_PARAMETER_OPEN_RE = re.compile(r'<parameter(?=[\s/>])')
+_TAG_END_RE = re.compile(r'''(?:[^>"']|"[^"]*"|'[^']*')*>''') # Rest of a start tag, honoring quoted '>'
+_XML_ATTR_RE = re.compile(r'''([A-Za-z_][\w:.-]*)\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+_XML_ENTITY_RE = re.compile(r'&(#x[0-9a-fA-F]+|#[0-9]+|amp|lt|gt|quot|apos);')
+_XML_ENTITIES = {'amp': '&', 'lt': '<', 'gt': '>', 'quot': '"', 'apos': "'"}
+_INVOKE_CLOSE = '</invoke>'
+_FUNCTION_CALLS_CLOSE = '</function_calls>'
+_PARAMETER_CLOSE = '</parameter>'
+
+def _unescape_xml_text(text):
+    """Decodes XML entity and character references, leaving anything else (e.g. a bare '&') untouched."""
+    if '&' not in text:
+        return text
+    def _replace(match):
+        ref = match.group(1)
+        if ref[0] == '#':
+            try: return chr(int(ref[2:], 16) if ref[1] == 'x' else int(ref[1:]))
+            except (ValueError, OverflowError): return match.group(0)
+        return _XML_ENTITIES[ref]
+    return _XML_ENTITY_RE.sub(_replace, text)
+
+def _parse_xml_attributes(text, start, end):
+    return {name: _unescape_xml_text(double or single) for name, double, single in _XML_ATTR_RE.findall(text, start, end)}
+
+class FunctionCallsParser:
+    """
+    Incremental, error-tolerant parser for <function_calls>/<invoke> blocks.
 
+    feed() text as it arrives and iterate the tool calls it yields; each <invoke> is yielded as soon
+    as the next <invoke> or </function_calls> is seen. close() flushes whatever is left, recovering an unterminated final
+    <invoke> where possible. Yielded dicts have the same shape parse_tool_call_xml() has always
+    returned; 'raw_xml_invoke' is the invoke's original text rather than a re-serialization.
+    """
+    def __init__(self, received_call_id_attr=None):
+        self.received_call_id_attr = received_call_id_attr
+        self.invokes_seen = 0
+        self._buffer = ""
+        self._pos = 0
+
+    def feed(self, chunk):
+        self._buffer += chunk
+        yield from self._drain(final=False)
+
+    def close(self):
+        yield from self._drain(final=True)
+        self._buffer = ""; self._pos = 0
+
+    def _drain(self, final):
+        buf = self._buffer
+        while True:
+            match = _INVOKE_OPEN_RE.search(buf, self._pos)
+            if not match:
+                # Keep a short tail in case a '<invoke' is split across chunks
+                self._pos = max(self._pos, len(buf) - len('<invoke'))
+                break
+            start = match.start()
+            tag = _TAG_END_RE.match(buf, match.end())
+            if not tag:
+                if not final:
+                    self._pos = start # Wait for the rest of the start tag
+                    break
+                self.invokes_seen += 1
+                self._pos = len(buf)
+                yield {"error": "Unterminated <invoke> start tag", "call_id": self.received_call_id_attr, "raw_xml_invoke": buf[start:]}
+                break
+            attributes = _parse_xml_attributes(buf, match.end(), tag.end() - 1)
+            if buf[tag.end() - 2] == '/': # <invoke ... />
+                body, end = "", tag.end()
+            else:
+                # The invoke ends at the last </invoke> before the next <invoke> or </function_calls>
+                next_invoke = _INVOKE_OPEN_RE.search(buf, tag.end())
+                block_close = buf.find(_FUNCTION_CALLS_CLOSE, tag.end(), next_invoke.start() if next_invoke else len(buf))
+                boundary = block_close if block_close != -1 else next_invoke.start() if next_invoke else -1
+                if boundary == -1:
+                    if not final:
+                        self._pos = start # Wait for what follows this invoke
+                        break
+                    boundary = len(buf)
+                close_index = buf.rfind(_INVOKE_CLOSE, tag.end(), boundary)
+                if close_index == -1:
+                    # Recover an unterminated invoke: its parameters run to the next invoke or the end of the block
+                    body, end = buf[tag.end():boundary], boundary
+                    LOGGER.warning(f"Warning: <invoke> for tool '{attributes.get('name')}' has no closing tag. Parsing it up to the next invoke or the end of the block.")
+                else:
+                    body, end = buf[tag.end():close_index], close_index + len(_INVOKE_CLOSE)
+            self.invokes_seen += 1
+            self._pos = end
+            tool_call = self._build_tool_call(attributes, body, buf[start:end])
+            if tool_call is not None:
+                yield tool_call
+        if self._pos:
+            self._buffer = buf[self._pos:]; self._pos = 0
+
+    def _build_tool_call(self, attributes, body, raw_invoke):
+        tool_name = attributes.get('name')
+        call_id_from_xml = attributes.get('call_id')
+        received_call_id_attr = self.received_call_id_attr
+
+        final_call_id = call_id_from_xml # Prefer call_id from XML content
+        if not final_call_id and received_call_id_attr:
+            final_call_id = received_call_id_attr
+            # print_debug(f"Used call_id ('{received_call_id_attr}') from content_script attribute as XML was missing one for tool '{tool_name}'.")
+        elif call_id_from_xml and received_call_id_attr and call_id_from_xml != received_call_id_attr:
+            # content_script sends one call_id for the whole block (the first invoke's), so later invokes differ by design
+            log = LOGGER.warning if self.invokes_seen == 1 else LOGGER.debug
+            log(f"Warning: call_id from XML ('{call_id_from_xml}') differs from content_script attribute ('{received_call_id_attr}') for tool '{tool_name}'. Using XML value.")
+
+        if not tool_name:
+            LOGGER.warning(f"Warning: <invoke> element missing 'name' attribute. Skipping. XML: {raw_invoke[:200]}")
+            return None
+        if not final_call_id:
+            LOGGER.warning(f"Warning: <invoke> element for tool '{tool_name}' missing 'call_id' (both in XML and from attribute). Skipping. XML: {raw_invoke[:200]}")
+            return None
+
+        return {
+            "tool_name": tool_name,
+            "parameters": self._parse_parameters(body, tool_name),
+            "call_id": final_call_id,
+            "depends_on": [d for d in re.split(r'[\s,]+', attributes.get('depends_on') or '') if d], # call_ids to run after
+            "raw_xml_invoke": raw_invoke # Original text of this specific invoke
+        }
+
+    def _parse_parameters(self, body, tool_name):
+        parameters = {}
+        pos = 0
+        while True:
+            match = _PARAMETER_OPEN_RE.search(body, pos)
+            if not match:
+                break
+            tag = _TAG_END_RE.match(body, match.end())
+            if not tag:
+                LOGGER.warning(f"Warning: Unterminated <parameter> tag in tool '{tool_name}'. Ignoring the rest of its parameters.")
+                break
+            param_name = _parse_xml_attributes(body, match.end(), tag.end() - 1).get('name')
+            if body[tag.end() - 2] == '/': # <parameter ... />
+                raw_value, pos = "", tag.end()
+            else:
+                next_open = _PARAMETER_OPEN_RE.search(body, tag.end())
+                value_end = next_open.start() if next_open else len(body)
+                # The closing tag is the last </parameter> before the next parameter (or the end of the invoke),
+                # so a value that itself contains a literal </parameter> is kept whole
+                close_index = body.rfind(_PARAMETER_CLOSE, tag.end(), value_end)
+                if close_index == -1:
+                    # Missing </parameter>: the value runs up to the next parameter (or the end of the invoke)
+                    LOGGER.warning(f"Warning: <parameter> '{param_name}' in tool '{tool_name}' has no closing tag. Recovered its value.")
+                    raw_value, pos = body[tag.end():value_end], value_end
+                else:
+                    raw_value, pos = body[tag.end():close_index], value_end
+                    trailing = body[close_index + len(_PARAMETER_CLOSE):value_end].strip()
+                    if trailing:
+                        LOGGER.warning(f"Warning: Ignoring text after <parameter> '{param_name}' in tool '{tool_name}': {trailing[:100]}")
+            if not param_name:
+                LOGGER.warning(f"Warning: <parameter> tag missing 'name' attribute in tool '{tool_name}'. Skipping parameter. XML: {body[match.start():pos][:200]}")
+                continue
+            value = raw_value.strip()
+            if value.startswith('<![CDATA[') and value.endswith(']]>'):
+                value = value[len('<![CDATA['):-len(']]>')].strip()
+            else:
+                value = _unescape_xml_text(value)
+            parameters[param_name] = value
+        return parameters
+
+def parse_tool_call_xml(xml_string, received_call_id_attr=None):
+    """
+    Parses an XML string containing tool calls.
+    Returns a list of dictionaries, each representing a tool call.
+    """
+    try:
+        # print_debug(f"Attempting to parse XML: {xml_string}")
+        parser = FunctionCallsParser(received_call_id_attr)
+        tool_calls = list(parser.feed(xml_string)) + list(parser.close())
+        if not parser.invokes_seen:
+            # print_debug(f"Warning: No <invoke> elements found after parsing. XML: {xml_string}") # Can be noisy if non-tool XML is common
+            # Return an error if received_call_id_attr was present, as an invocation was expected.
+            if received_call_id_attr: # This implies it was a TOOL_CALL_DETECTED message type
+                 return [{"error": "No <invoke> elements found in XML", "raw_xml": xml_string, "call_id": received_call_id_attr}]
+            return []
         # print_debug(f"Successfully parsed {len(tool_calls)} tool call(s) from XML.")
         return tool_calls
-
-    except ET.ParseError as e:
-        sys.stderr.write(f"XML parsing error: {e}. XML string: {xml_string}\n"); sys.stderr.flush() # Keep error
-        return [{"error": f"XML parsing error: {e}", "raw_xml": xml_string, "call_id": received_call_id_attr}]
     except Exception as e:
-        sys.stderr.write(f"Unexpected error in parse_tool_call_xml: {e}. XML string: {xml_string}\n"); sys.stderr.flush() # Keep error
+        LOGGER.error(f"Unexpected error in parse_tool_call_xml: {e}. XML string: {xml_string[:500]}")
         return [{"error": f"Unexpected error during XML parsing: {e}", "raw_xml": xml_string, "call_id": received_call_id_attr}]
 
+# --- Tool result cache ---
+# Gemini often repeats an identical call to a read-only tool within a conversation. When resultCacheTtlSeconds
+# is set, results of tools that are safe to repeat are kept for a short time and reused within that
+# conversation, skipping the MCP round-trip entirely. Any other call to the server drops its cached results,
+# since it may have changed what they describe (e.g. read_file after write_file).
 
-def main():
-    global DISCOVERED_TOOLS
-    
-    # Log API status
-    if API_ENABLED:
-        sys.stderr.write(f"API interface is enabled on port {API_PORT}\n")
-        sys.stderr.flush()
+class ToolResultCache:
+    """
+    LRU cache of rendered tool results with a per-entry TTL and a total size budget in bytes.
+    Keys are (server_id, server tools digest, tab_id, conversation_id, tool_name, normalized parameters).
+    """
+    def __init__(self, max_bytes):
+        self.max_bytes = max(0, max_bytes)
+        self._entries = OrderedDict() # key -> (expires_at monotonic, size in bytes, rendered result)
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] <= time.monotonic():
+            self._remove(key) # Expired
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[2]
+
+    def put(self, key, value, ttl_seconds, max_entry_bytes):
+        """Stores a rendered result unless it is larger than max_entry_bytes or the whole budget."""
+        size = len(value.encode('utf-8'))
+        if size > max_entry_bytes or size > self.max_bytes:
+            return False
+        if key in self._entries:
+            self._remove(key)
+        while self._entries and self.total_bytes + size > self.max_bytes:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+        self._entries[key] = (time.monotonic() + ttl_seconds, size, value)
+        self.total_bytes += size
+        return True
+
+    def _remove(self, key):
+        self.total_bytes -= self._entries.pop(key)[1]
+
+    def invalidate_server(self, server_id):
+        """Drops every cached result from one server (e.g. its config changed, or it ran a mutating tool). Returns how many were dropped."""
+        keys = [key for key in self._entries if key[0] == server_id]
+        for key in keys: self._remove(key)
+        return len(keys)
+
+    def stats(self):
+        return {"entries": len(self._entries), "bytes": self.total_bytes, "max_bytes": self.max_bytes,
+                "hits": self.hits, "misses": self.misses, "evictions": self.evictions}
+
+def is_tool_result_cacheable(tool_def, server_config):
+    """
+    A tool's results are cached if "cacheResults" is set for it (in "toolSettings" or on its server),
+    otherwise only if its MCP annotations mark it read-only or idempotent.
+    """
+    configured = get_tool_setting(server_config, tool_def['name'], "cacheResults")
+    if configured is not None:
+        return bool(configured)
+    annotations = tool_def.get('annotations') or {}
+    return bool(annotations.get('readOnlyHint') or annotations.get('idempotentHint'))
+
+def make_result_cache_key(registry, tool_def, parameters, tab_id=None, conversation_id=None):
+    server_id = tool_def['mcp_server_id']
+    normalized_parameters = json.dumps(parameters or {}, sort_keys=True, separators=(',', ':'), default=str)
+    # The tools digest makes results from before a server's tools changed unreachable
+    return (server_id, registry.server_digests.get(server_id), tab_id, conversation_id or None, tool_def['name'], normalized_parameters)
+
+# --- Tool result rendering ---
+# Every content block of a result is rendered. Binary content (images, audio, blob resources) cannot be pasted
+# into Gemini, so it is written once to a content-addressed blob store and referenced by its sha256 hash.
+
+_MIME_EXTENSIONS = {'image/png': '.png', 'image/jpeg': '.jpg', 'image/gif': '.gif', 'image/webp': '.webp',
+                    'image/svg+xml': '.svg', 'audio/wav': '.wav', 'audio/mpeg': '.mp3', 'application/pdf': '.pdf',
+                    'application/json': '.json', 'text/plain': '.txt'}
+
+class ContentBlobStore:
+    """
+    Content-addressed store for binary result content, in a directory next to mcp_servers_config.json.
+    Files are named by the sha256 of their bytes, so a screenshot or file returned again is recognised
+    and referenced without being written a second time.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self._paths = {} # sha256 hex -> path of blobs known to exist
+        self.writes = 0
+        self.reuses = 0
+
+    def put(self, data, mime_type=None):
+        """Stores bytes (if not already stored) and returns (sha256 hex, path)."""
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._paths.get(digest)
+        if path is None:
+            path = os.path.join(self.directory, digest + _MIME_EXTENSIONS.get((mime_type or '').split(';')[0].strip(), '.bin'))
+            if not os.path.exists(path):
+                os.makedirs(self.directory, exist_ok=True)
+                temp_path = f"{path}.{os.getpid()}.tmp"
+                with open(temp_path, 'wb') as f: f.write(data)
+                os.replace(temp_path, path)
+                self.writes += 1
+            else:
+                self.reuses += 1
+            self._paths[digest] = path
+        else:
+            self.reuses += 1
+        return digest, path
+
+def get_blob_store():
+    global BLOB_STORE
+    if BLOB_STORE is None:
+        base_dir = os.path.dirname(CONFIG_PATH) if CONFIG_PATH else os.path.dirname(os.path.abspath(__file__))
+        BLOB_STORE = ContentBlobStore(os.path.join(base_dir, HOST_SETTINGS.get("blobStoreDir") or DEFAULT_HOST_SETTINGS["blobStoreDir"]))
+    return BLOB_STORE
+
+def _field(obj, *names):
+    """Reads the first present attribute or key, for content given as MCP objects or plain dicts."""
+    for name in names:
+        value = obj.get(name) if isinstance(obj, dict) else getattr(obj, name, None)
+        if value is not None:
+            return value
+    return None
+
+def _render_blob_reference(kind, base64_data, mime_type, label=None):
+    try:
+        data = base64.b64decode(base64_data, validate=False)
+    except (ValueError, TypeError) as e:
+        return f"[{kind} ({mime_type or 'unknown type'}) could not be decoded: {e}]"
+    try:
+        digest, path = get_blob_store().put(data, mime_type)
+    except OSError as e:
+        LOGGER.error(f"Error writing {kind} to the blob store: {e}")
+        return f"[{kind} ({mime_type or 'unknown type'}, {len(data)} bytes) could not be stored: {e}]"
+    described = f"{kind} {label}" if label else kind
+    return f"[{described} ({mime_type or 'unknown type'}, {len(data)} bytes) sha256:{digest} file://{path}]"
+
+def render_content_block(block):
+    """Renders one MCP content block (text, image, audio, resource or resource link) as text."""
+    if isinstance(block, str):
+        return block
+    block_type = _field(block, 'type')
+    text = _field(block, 'text')
+    if block_type in (None, 'text') and text is not None:
+        return str(text)
+    if block_type in ('image', 'audio'):
+        return _render_blob_reference(block_type, _field(block, 'data') or '', _field(block, 'mime_type', 'mimeType'))
+    if block_type == 'resource':
+        resource = _field(block, 'resource') or {}
+        uri = _field(resource, 'uri')
+        mime_type = _field(resource, 'mime_type', 'mimeType')
+        resource_text = _field(resource, 'text')
+        if resource_text is not None: # Text resources are readable as they are
+            return f"[resource {uri} ({mime_type or 'text'})]\n{resource_text}"
+        return _render_blob_reference('resource', _field(resource, 'blob') or '', mime_type, label=uri)
+    if block_type == 'resource_link':
+        name = _field(block, 'name')
+        return f"[resource link {_field(block, 'uri')}{f' ({name})' if name else ''}]"
+    return str(block)
+
+def _structured_content_repeats_text(structured_content, texts):
+    """True if the structured content is already present as (JSON) text, as the MCP spec recommends."""
+    if len(texts) != 1:
+        return False
+    try: parsed_text = json.loads(texts[0])
+    except (ValueError, TypeError): parsed_text = texts[0]
+    if parsed_text == structured_content:
+        return True
+    # FastMCP wraps non-object return values as {"result": value}
+    return isinstance(structured_content, dict) and list(structured_content) == ['result'] and structured_content['result'] in (parsed_text, texts[0])
+
+def render_tool_result_text(tool_result):
+    """
+    Renders every content block of a tool result (a CallToolResult or a plain list of blocks) as
+    text: text blocks joined, binary content referenced from the blob store, and structured
+    content appended as compact JSON unless it just repeats the text.
+    """
+    if tool_result is None:
+        return ""
+    content = _field(tool_result, 'content')
+    blocks = content if content is not None else (tool_result if isinstance(tool_result, (list, tuple)) else [tool_result])
+    rendered_blocks = [render_content_block(block) for block in blocks]
+    texts = [_field(block, 'text') for block in blocks if _field(block, 'type') in (None, 'text') and _field(block, 'text') is not None]
+    structured_content = _field(tool_result, 'structured_content', 'structuredContent') if content is not None else None
+    if structured_content is not None and not _structured_content_repeats_text(structured_content, texts):
+        rendered_blocks.append(json.dumps(structured_content, separators=(',', ':'), ensure_ascii=False, default=str))
+    return "\n".join(block for block in rendered_blocks if block)
+
+_XML_ESCAPE_TABLE = str.maketrans({'&': '&amp;', '<': '&lt;', '>': '&gt;'})
+
+def escape_xml_text(text):
+    """Escapes text for an XML element body in a single pass."""
+    return text.translate(_XML_ESCAPE_TABLE)
+
+def apply_result_size_policy(text, max_chars, policy):
+    """Shortens a result longer than max_chars according to the oversizeResultPolicy setting."""
+    if not max_chars or len(text) <= max_chars or policy == "none":
+        return text
+    if policy == "head_and_tail":
+        head, tail = text[:max_chars // 2], text[-(max_chars - max_chars // 2):]
+        omitted_lines = text.count('\n', len(head), len(text) - len(tail))
+        return f"{head}\n[... {len(text) - max_chars} characters ({omitted_lines} lines) omitted from the middle of this result ...]\n{tail}"
+    return f"{text[:max_chars]}\n[... result truncated: showing the first {max_chars} of {len(text)} characters ...]"
+
+def format_tool_result_content(tool_result, max_chars=None, oversize_policy="truncate"):
+    """Renders a tool result as escaped text for the <result> element of a <tool_result>."""
+    actual_result_content = render_tool_result_text(tool_result)
+
+    # If we still have no content, provide a default message
+    if not actual_result_content:
+        actual_result_content = "(No data returned by tool)"
+
+    actual_result_content = apply_result_size_policy(actual_result_content, max_chars, oversize_policy)
+    return escape_xml_text(actual_result_content)
+
+def count_tool_call(server_id, tool_name, status):
+    METRICS.inc("mcp_host_tool_calls_total", server=server_id or "", tool=tool_name or "", status=status)
+
+async def execute_tool_call(tab_id, tool_call_data, conversation_id=None):
+    """
+    Runs one parsed tool call end to end and sends the outcome to the extension. Runs as its own
+    task so slow tools never block the message loop.
+    """
+    payload, _ = await run_tool_call_request(tab_id, tool_call_data, conversation_id)
+    if not tab_id:
+        LOGGER.warning(f"Warning: No tabId, cannot send formatted XML result for call_id '{payload.get('call_id')}'.")
+    elif payload.get("status") == "tool_executed_and_result_ready":
+        send_tool_result(tab_id, payload)
     else:
-        sys.stderr.write("API interface is disabled. Use --enable-api to enable it.\n")
-        sys.stderr.flush()
+        send_message({"tabId": tab_id, "payload": payload})
 
-    if load_server_configurations():
-        if SERVER_CONFIGURATIONS: sys.stderr.write(f"Loaded {len(SERVER_CONFIGURATIONS)} MCP server configurations.\n"); sys.stderr.flush() # Keep summary
-        else: sys.stderr.write("No valid server configurations found.\n"); sys.stderr.flush() # Keep summary
-    else: sys.stderr.write("Failed to load MCP server configurations.\n"); sys.stderr.flush() # Keep summary
+async def run_tool_call_request(tab_id, tool_call_data, conversation_id=None):
+    """
+    The one execution path for a tool call, whether Gemini asked for it (TOOL_CALL_DETECTED) or an
+    API client did: registry lookup, parameter coercion, result cache, execution and formatting.
+    Cached results are only reused within the same tab and conversation_id.
+    Returns (payload for the extension, rendered result content or None on error).
+    """
+    # This is the call_id from Python parsing (XML content preferred, then CS attribute)
+    parsed_call_id = tool_call_data.get("call_id")
+    tool_name = tool_call_data.get("tool_name")
+    parameters = tool_call_data.get("parameters")
 
-    DISCOVERED_TOOLS = []
-    sys.stderr.write("Starting tool discovery...\n"); sys.stderr.flush() # Keep status
+    # --- BEGIN TOOL EXECUTION LOGIC ---
+    # 1. Find Tool and Server Configuration (one registry snapshot for the whole call)
+    while True:
+        registry = TOOL_REGISTRY
+        started = time.perf_counter()
+        discovered_tool_config = registry.resolve(tool_name) if tool_name else None
+        METRICS.observe("mcp_host_registry_lookup_seconds", time.perf_counter() - started)
+        if discovered_tool_config or DISCOVERY_COMPLETE.is_set():
+            break
+        # The tool's server may simply not have answered discovery yet
+        await DISCOVERY_PROGRESS.wait()
+
+    if not discovered_tool_config:
+        LOGGER.error(f"Error: Tool '{tool_name}' (ID: {parsed_call_id}) not found in the tool registry.",
+                     extra={"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "status": "tool_not_found"})
+        count_tool_call(None, tool_name, "tool_not_found")
+        return {
+            "status": "tool_not_found",
+            "tool_name": tool_name,
+            "call_id": parsed_call_id,
+            "message": f"Python host: Tool '{tool_name}' (ID: {parsed_call_id}) not found in discovered tools during execution phase.",
+            "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: Tool '{tool_name}' not found.</result></tool_result>"
+        }, None
+
+    mcp_server_id = discovered_tool_config.get("mcp_server_id")
+    server_config = registry.servers.get(mcp_server_id)
+
+    if not server_config:
+        LOGGER.error(f"Error: Server configuration for mcp_server_id '{mcp_server_id}' not found for tool '{tool_name}'.")
+        count_tool_call(mcp_server_id, tool_name, "error_executing_tool")
+        return {
+            "status": "error_executing_tool",
+            "tool_name": tool_name,
+            "call_id": parsed_call_id,
+            "message": f"Python host: Server configuration for '{mcp_server_id}' not found while trying to execute tool '{tool_name}'.",
+            "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: Server configuration for '{mcp_server_id}' not found for tool '{tool_name}'.</result></tool_result>"
+        }, None
+
+    # 2. Convert the string parameters to the schema's types and check required ones before any network call
+    coercer = registry.coercers.get((mcp_server_id, discovered_tool_config['name']))
+    if coercer is not None:
+        parameters, parameter_errors = coercer.coerce(parameters)
+        if parameter_errors:
+            error_text = " ".join(parameter_errors)
+            LOGGER.error(f"Error: Invalid parameters for tool '{tool_name}' (ID: {parsed_call_id}): {error_text}",
+                         extra={"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "server_id": mcp_server_id,
+                                "status": "error_invalid_parameters", "parameters": parameters})
+            count_tool_call(mcp_server_id, discovered_tool_config['name'], "error_invalid_parameters")
+            escaped_error_text = escape_xml_text(error_text)
+            return {
+                "status": "error_invalid_parameters",
+                "tool_name": tool_name,
+                "call_id": parsed_call_id,
+                "message": f"Python host: Invalid parameters for tool '{tool_name}': {error_text}",
+                "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: Invalid parameters for tool '{tool_name}': {escaped_error_text}</result></tool_result>"
+            }, None
+
+    # 3. Identical calls to cacheable tools in the same conversation are answered from the result cache
+    cache_key = None
+    actual_result_content = None
+    cacheable = is_tool_result_cacheable(discovered_tool_config, server_config)
+    cache_ttl = float(get_tool_setting(server_config, discovered_tool_config['name'], "resultCacheTtlSeconds") or 0)
+    if RESULT_CACHE is not None and cache_ttl > 0 and cacheable:
+        cache_key = make_result_cache_key(registry, discovered_tool_config, parameters, tab_id, conversation_id)
+        actual_result_content = RESULT_CACHE.get(cache_key)
+    cache_hit = actual_result_content is not None
+    if cache_hit:
+        LOGGER.info(f"Result cache hit for tool '{tool_name}' (ID: {parsed_call_id}).",
+                    extra={"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "server_id": mcp_server_id})
+    else:
+        actual_result_content, error_payload = await _run_tool_call(tab_id, tool_name, parameters, discovered_tool_config, server_config, parsed_call_id)
+        if RESULT_CACHE is not None and not cacheable:
+            # A tool that may change state ran (even if it failed part-way), so this server's cached results may be stale
+            dropped = RESULT_CACHE.invalidate_server(mcp_server_id)
+            if dropped: LOGGER.debug(f"Dropped {dropped} cached results from server '{mcp_server_id}' after '{tool_name}' (ID: {parsed_call_id}).")
+        if error_payload is not None:
+            return error_payload, None
+        if cache_key is not None:
+            RESULT_CACHE.put(cache_key, actual_result_content, cache_ttl,
+                             int(get_tool_setting(server_config, discovered_tool_config['name'], "resultCacheMaxEntryBytes")))
+
+    formatted_xml_result = f"""<tool_result>
+  <call_id>{parsed_call_id}</call_id>
+  <tool_name>{tool_name}</tool_name>
+  <result>{actual_result_content}</result>
+</tool_result>"""
+    LOGGER.debug(f"Formatted XML result for '{tool_name}' (ID: {parsed_call_id})",
+                 extra={"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "result": formatted_xml_result})
+    count_tool_call(mcp_server_id, discovered_tool_config['name'], "cache_hit" if cache_hit else "tool_executed_and_result_ready")
+
+    response_payload_to_extension = {
+        "status": "tool_executed_and_result_ready",
+        "tool_name": tool_name,
+        "call_id": parsed_call_id,
+        "cache_hit": cache_hit,
+        "text_response": formatted_xml_result
+    }
+    return response_payload_to_extension, actual_result_content
+    # --- END TOOL EXECUTION LOGIC ---
 
-    for server_config in SERVER_CONFIGURATIONS:
-        server_id = server_config.get('id') # Get server_id for logging outside try block
-        is_enabled = server_config.get('enabled', True) # Default to True if missing
+async def _run_tool_call(tab_id, tool_name, parameters, discovered_tool_config, server_config, parsed_call_id):
+    """
+    Executes a tool call on its server within the concurrency limits. Returns (rendered result
+    content, None) on success, or (None, error payload for the extension).
+    """
+    # Instantiating the MCP Client and executing the Tool Call are handled by _execute_tool_call_async
+    tool_result = None
+    execution_error = None
+    mcp_server_id = server_config.get('id')
+    tool_key_name = discovered_tool_config['name']
+
+    # A server that keeps failing is failed fast until its breaker lets a probe call through
+    breaker = get_circuit_breaker(server_config)
+    if not breaker.allow_request():
+        retry_after = breaker.retry_after()
+        LOGGER.warning(f"Circuit breaker: Rejecting tool '{tool_name}' (Call ID: {parsed_call_id}); server '{mcp_server_id}' is unavailable.",
+                       extra={"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "server_id": mcp_server_id,
+                              "status": "error_server_unavailable"})
+        count_tool_call(mcp_server_id, tool_key_name, "error_server_unavailable")
+        return None, {
+            "status": "error_server_unavailable",
+            "tool_name": tool_name,
+            "call_id": parsed_call_id,
+            "retry_after_seconds": round(retry_after, 1),
+            "message": f"Python host: Server '{mcp_server_id}' is unavailable after repeated failures ({breaker.last_error}).",
+            "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: Server '{mcp_server_id}' for tool '{tool_name}' is currently unavailable after repeated failures. Try again in about {max(1, round(retry_after))} seconds.</result></tool_result>"
+        }
+
+    timeout = float(get_tool_setting(server_config, tool_key_name, "toolCallTimeoutSeconds") or 0)
+    log_fields = {"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "server_id": mcp_server_id}
+    LOGGER.debug(f"Calling tool '{tool_name}' (Call ID: {parsed_call_id}) on server '{mcp_server_id}'.",
+                 extra=dict(log_fields, parameters=parameters))
+    started = time.perf_counter()
+    try:
+        fastmcp_module = await import_fastmcp() # Normally long done by discovery
+        # print_debug(f"Awaiting tool '{tool_name}' (Call ID: {parsed_call_id}) on server '{mcp_server_id}'.")
+        # Global and per-server concurrency limits; calls beyond them queue here without blocking other work
+        async with TOOL_CALL_SEMAPHORE, get_server_semaphore(server_config):
+            # Pass `parsed_call_id` for logging purposes within the async helper
+            # The server knows the tool by its original name, not the namespaced one Gemini may have used
+            # The timeout starts once the call has a slot, and covers connecting as well as the call itself
+            tool_result = await asyncio.wait_for(_execute_tool_call_async(tool_key_name, parameters, server_config, fastmcp_module, parsed_call_id),
+                                                 timeout=timeout or None)
+        # If _execute_tool_call_async completes without raising an exception, tool_result is set.
+        # If it raises, execution_error will be set in the except block below.
+        # print_debug(f"Tool '{tool_name}' (Call ID: {parsed_call_id}) async task completed. Raw Result: {str(tool_result)[:200]}...")
+        record_server_outcome(server_config)
+        LOGGER.info(f"Tool '{tool_name}' (Call ID: {parsed_call_id}) completed on server '{mcp_server_id}'.",
+                    extra=dict(log_fields, status="ok", duration_ms=round((time.perf_counter() - started) * 1000, 1)))
+
+    except asyncio.TimeoutError:
+        LOGGER.error(f"Error: Tool '{tool_name}' (Call ID: {parsed_call_id}) on server '{mcp_server_id}' timed out after {timeout:g}s.",
+                     extra=dict(log_fields, status="error_timeout", duration_ms=round((time.perf_counter() - started) * 1000, 1)))
+        execution_error = TimeoutError(f"timed out after {timeout:g} seconds")
+        record_server_outcome(server_config, execution_error)
+    except asyncio.CancelledError:
+        breaker.release_probe() # No outcome; let another call probe the server
+        raise
+    except Exception as e_async_call:
+        # This catches errors raised by _execute_tool_call_async.
+        LOGGER.error(f"Error calling async execution helper for tool '{tool_name}' (Call ID: {parsed_call_id}): {e_async_call}",
+                     extra=dict(log_fields, status="error_executing_tool", duration_ms=round((time.perf_counter() - started) * 1000, 1)))
+        execution_error = e_async_call # Store the exception
+        record_server_outcome(server_config, e_async_call)
+
+    # Process result or error
+    if execution_error:
+        timed_out = isinstance(execution_error, TimeoutError)
+        count_tool_call(mcp_server_id, tool_key_name, "error_timeout" if timed_out else "error_executing_tool")
+        # Handle error (e.g., send error message to extension)
+        return None, {
+            "status": "error_executing_tool",
+            "tool_name": tool_name,
+            "call_id": parsed_call_id,
+            "timed_out": timed_out,
+            "message": f"Python host: Error during execution of tool '{tool_name}': {str(execution_error)}",
+            "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: During execution of tool '{tool_name}': {str(execution_error)}</result></tool_result>"
+        }
+
+    # Process successful tool_result
+    started = time.perf_counter()
+    actual_result_content = format_tool_result_content(tool_result,
+                                                       int(get_tool_setting(server_config, tool_key_name, "maxResultChars") or 0),
+                                                       get_tool_setting(server_config, tool_key_name, "oversizeResultPolicy"))
+    METRICS.observe("mcp_host_result_format_seconds", time.perf_counter() - started, server=mcp_server_id, tool=tool_key_name)
+    return actual_result_content, None
+
+# --- call_id deduplication ---
+# The prompt has Gemini number call_ids from 1 in every chat, so a call_id is only unique within one
+# conversation in one tab. Seen call_ids are remembered per (tabId, conversation) for a limited time.
+
+class CallIdDedupStore:
+    """
+    Bounded record of call_ids already dispatched, scoped by (tab_id, conversation_id).
 
-        if not is_enabled:
-            sys.stderr.write(f"Skipping disabled server: '{server_id}'\n"); sys.stderr.flush() # Keep info
-            continue
+    Entries expire ttl_seconds after they were last seen, and the least recently seen
+    entry is evicted once max_entries is reached, so memory stays flat over long browser sessions.
+    Entries are kept in last-seen order, which makes both expiry and eviction O(1) per entry.
+    """
+    def __init__(self, ttl_seconds=3600, max_entries=10000):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max(1, max_entries)
+        self._entries = OrderedDict() # (tab_id, conversation_id, call_id) -> time last seen (monotonic)
+        self.hits = 0 # Duplicates detected
+        self.misses = 0 # New call_ids recorded
+        self.evictions = 0 # Entries dropped because the store was full
+        self.expirations = 0 # Entries dropped because their TTL ran out
+
+    def check_and_add(self, tab_id, conversation_id, call_id):
+        """Returns True if this call_id was already seen in this tab and conversation; records it otherwise."""
+        now = time.monotonic()
+        self._expire(now)
+        key = (tab_id, conversation_id or None, call_id)
+        if key in self._entries:
+            self.hits += 1
+            self._entries[key] = now
+            self._entries.move_to_end(key)
+            return True
+        self.misses += 1
+        while len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+        self._entries[key] = now
+        return False
+
+    def _expire(self, now):
+        if not self.ttl_seconds:
+            return # 0 disables expiry; the size cap still applies
+        deadline = now - self.ttl_seconds
+        entries = self._entries
+        while entries:
+            oldest_key = next(iter(entries))
+            if entries[oldest_key] > deadline:
+                break
+            del entries[oldest_key]
+            self.expirations += 1
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        return {"size": len(self._entries), "max_entries": self.max_entries, "hits": self.hits,
+                "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations}
+
+def handle_tool_call_detected(tab_id, payload):
+    """
+    Parses a TOOL_CALL_DETECTED payload, reports parse errors and duplicates, and dispatches each
+    valid call as its own task. Returns without waiting for any tool to finish.
+    """
+    if not payload or "raw_xml" not in payload:
+        LOGGER.error("Error: TOOL_CALL_DETECTED message missing payload or raw_xml.")
+        if tab_id: # Try to send error back if tab_id is known
+             send_message({"tabId": tab_id, "payload": {"status": "error", "message": "Python host received empty/invalid tool call payload."}})
+        return
+
+    raw_xml_from_cs = payload.get("raw_xml")
+    call_id_from_cs_attr = payload.get("call_id") # This is the call_id extracted from DOM attribute by content_script
+    conversation_id = payload.get("conversation_id") # Gemini chat the call came from; call_ids restart at 1 in each
+
+    # print_debug(f"Processing TOOL_CALL_DETECTED. XML: {raw_xml_from_cs[:200]}... CS CallID Attr: {call_id_from_cs_attr}")
+
+    # Each <invoke> is dispatched as soon as the parser yields it; a malformed invoke only
+    # affects itself, not the rest of the block. In multi-call mode the invokes are collected
+    # and, if there are several, run and answered together as one batch.
+    parser = FunctionCallsParser(call_id_from_cs_attr)
+    multi_call = bool(HOST_SETTINGS.get("multiToolCalls"))
+    collected_calls = []
+    parse_seconds = 0.0 # Parsing time only; dispatching each call as it is yielded is not counted
+    try:
+        started = time.perf_counter()
+        for tool_calls in (parser.feed(raw_xml_from_cs), parser.close()):
+            for tool_call_data in tool_calls:
+                parse_seconds += time.perf_counter() - started
+                if multi_call: collected_calls.append(tool_call_data)
+                else: dispatch_parsed_tool_call(tab_id, tool_call_data, conversation_id)
+                started = time.perf_counter()
+        parse_seconds += time.perf_counter() - started
+        METRICS.observe("mcp_host_xml_parse_seconds", parse_seconds)
+        if len(collected_calls) > 1:
+            dispatch_tool_call_batch(tab_id, collected_calls, conversation_id)
+        elif collected_calls:
+            dispatch_parsed_tool_call(tab_id, collected_calls[0], conversation_id)
+    except Exception as e:
+        LOGGER.error(f"Unexpected error while parsing tool call XML: {e}", extra={"tab_id": tab_id, "raw_xml": raw_xml_from_cs})
+        if tab_id:
+            send_message({
+                "tabId": tab_id,
+                "payload": {
+                    "status": "error_parsing_xml", # More specific status
+                    "message": f"Python host: Unexpected error during XML parsing: {e}",
+                    "call_id": call_id_from_cs_attr,
+                    "raw_xml_snippet": raw_xml_from_cs[:200]
+                }
+            })
+        return
+
+    if not parser.invokes_seen:
+        if call_id_from_cs_attr:
+            # An invocation was expected (content_script saw a call_id), so report it
+            LOGGER.error("XML parsing found no <invoke> elements in a tool call block.")
+            if tab_id:
+                send_message({
+                    "tabId": tab_id,
+                    "payload": {
+                        "status": "error_parsing_xml", # More specific status
+                        "message": "Python host: No <invoke> elements found in XML",
+                        "call_id": call_id_from_cs_attr,
+                        "raw_xml_snippet": raw_xml_from_cs[:200]
+                    }
+                })
+        # Otherwise there were no invokable tools in this XML. DO NOT send a message back to the extension. Silently ignore.
+        # print_debug(f"No <invoke> elements found in: {raw_xml_from_cs[:100]}... Silently ignoring.") # Can be noisy
 
-        # print_debug(f"Attempting discovery for server: '{server_id}' (Type: {server_config.get('type')})")
+def check_parsed_tool_call(tab_id, tool_call_data, conversation_id=None):
+    """
+    Screens one parsed invoke before it runs. Returns the payload reporting a parse error, a missing
+    call_id or a duplicate call_id, or None if the call should be executed (and records its call_id).
+    """
+    if "error" in tool_call_data:
+        LOGGER.error(f"Individual tool call data contained an error: {tool_call_data['error']}")
+        return {
+            "status": "error_processing_tool_data", # Specific error for this tool
+            "message": f"Python host: {tool_call_data.get('error', 'Error in specific tool data.')}",
+            "call_id": tool_call_data.get("call_id"),
+            "tool_name": tool_call_data.get("tool_name", "Unknown tool"),
+            "raw_xml_snippet": tool_call_data.get("raw_xml_invoke", "")[:200]
+        }
+
+    # This is the call_id from Python parsing (XML content preferred, then CS attribute)
+    parsed_call_id = tool_call_data.get("call_id")
+    tool_name = tool_call_data.get("tool_name")
+
+    if not parsed_call_id:
+        LOGGER.critical(f"Critical: Parsed tool '{tool_name}' is missing a call_id after parsing. This should not happen if parse_tool_call_xml is correct. Skipping.")
+        return {
+            "status": "error_internal",
+            "tool_name": tool_name,
+            "message": f"Python host: Internal error - parsed tool '{tool_name}' is missing call_id."
+        }
+
+    # print_debug(f"Parsed Tool Call: Name='{tool_name}', Call_ID='{parsed_call_id}', Params='{tool_call_data.get('parameters')}'")
+
+    # Duplicate Check using the call_id from Python parsing, scoped to this tab and conversation. Done here,
+    # before dispatch, so a duplicate arriving while the original is still running is still caught.
+    if PROCESSED_CALL_IDS.check_and_add(tab_id, conversation_id, parsed_call_id):
+        LOGGER.info(f"Duplicate call_id '{parsed_call_id}' (from Python parsing) detected in tab {tab_id}, conversation '{conversation_id}'. Skipping tool '{tool_name}'.",
+                    extra={"tab_id": tab_id, "call_id": parsed_call_id, "tool": tool_name, "conversation_id": conversation_id, "status": "duplicate"})
+        return {
+            "status": "skipped_duplicate",
+            "tool_name": tool_name,
+            "call_id": parsed_call_id,
+            "message": f"Python host: Tool call '{tool_name}' (ID: {parsed_call_id}) skipped as duplicate."
+        }
+    # print_debug(f"Recorded call_id '{parsed_call_id}'. Dedup store size: {len(PROCESSED_CALL_IDS)}")
+    return None
+
+def track_in_flight_call(tab_id, call_id, task):
+    """Registers a running call for CANCEL_TOOL_CALL until its task finishes."""
+    in_flight_key = (tab_id, call_id)
+    IN_FLIGHT_TOOL_CALLS[in_flight_key] = task
+    task.add_done_callback(lambda t: IN_FLIGHT_TOOL_CALLS.pop(in_flight_key, None) if IN_FLIGHT_TOOL_CALLS.get(in_flight_key) is t else None)
+
+def dispatch_parsed_tool_call(tab_id, tool_call_data, conversation_id=None):
+    """Reports a per-invoke parse error or duplicate, or starts executing the call as its own task."""
+    rejection = check_parsed_tool_call(tab_id, tool_call_data, conversation_id)
+    if rejection is not None:
+        if tab_id: # Inform extension about the error or the skipped duplicate
+            send_message({"tabId": tab_id, "payload": rejection})
+        return
+
+    parsed_call_id = tool_call_data.get("call_id")
+    task = spawn_task(execute_tool_call(tab_id, tool_call_data, conversation_id), name=f"tool-call-{parsed_call_id}", tab_id=tab_id)
+    track_in_flight_call(tab_id, parsed_call_id, task)
+
+# --- Multi-call blocks ---
+# With hostSettings.multiToolCalls on, a function_calls block holding several invokes runs as one batch:
+# independent calls concurrently, an invoke with depends_on="1,2" only after those calls succeeded, and
+# every outcome returned to the tab in a single tool_batch_results message in call_id order.
+
+def _call_id_sort_key(call_id):
+    call_id = str(call_id)
+    return (0, int(call_id), "") if call_id.isdigit() else (1, 0, call_id) # Gemini numbers its calls 1, 2, 3...
+
+def _batch_error_payload(status, tool_call_data, message):
+    call_id, tool_name = tool_call_data.get("call_id"), tool_call_data.get("tool_name")
+    return {
+        "status": status,
+        "tool_name": tool_name,
+        "call_id": call_id,
+        "message": f"Python host: {message}",
+        "text_response": f"<tool_result><call_id>{call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: {escape_xml_text(message)}</result></tool_result>"
+    }
 
-        try:
-            discovered_list = run_async_task(
-                _discover_tools_for_server_async(server_config, fastmcp)
-            )
-
-            # _discover_tools_for_server_async is expected to return a list (empty if errors or no tools)
-            if discovered_list: # If the list is not None and not empty
-                # print_debug(f"Successfully discovered {len(discovered_list)} tools from server '{server_id}'.")
-                DISCOVERED_TOOLS.extend(discovered_list)
-            # else: # Includes None or empty list
-                # print_debug(f"No tools discovered from server '{server_id}'.") # Can be noisy
-        except Exception as e:
-            # This catches errors from run_async_task or if _discover_tools_for_server_async re-raised an exception
-            sys.stderr.write(f"Failed to discover tools from server '{server_id}' due to an error: {e}\n"); sys.stderr.flush() # Keep error
-            # Loop continues to the next server
-
-    if DISCOVERED_TOOLS:
-        sys.stderr.write(f"--- Total tools discovered across all servers: {len(DISCOVERED_TOOLS)} ---\n"); sys.stderr.flush() # Keep summary
-        tool_names_seen = {}
-        for tool in DISCOVERED_TOOLS:
-            tool_name = tool.get('name'); origin_server = tool.get('mcp_server_id')
-            # print_debug(f"  - Found tool: '{tool_name}' from server: '{origin_server}'") # Verbose
-            if tool_name in tool_names_seen: sys.stderr.write(f"    WARNING: Duplicate tool_name '{tool_name}' also on server '{tool_names_seen[tool_name]}'.\n"); sys.stderr.flush() # Keep warning
-            tool_names_seen[tool_name] = origin_server
+def find_dependency_cycles(dependencies):
+    """Returns the call_ids that are part of, or wait on, a depends_on cycle."""
+    state, cyclic = {}, set() # call_id -> 1 while being visited, 2 when done
+    def visit(call_id):
+        if state.get(call_id) == 2: return call_id in cyclic
+        if state.get(call_id) == 1: return True
+        state[call_id] = 1
+        in_cycle = False
+        for dependency in dependencies.get(call_id, ()):
+            in_cycle = visit(dependency) or in_cycle
+        state[call_id] = 2
+        if in_cycle: cyclic.add(call_id)
+        return in_cycle
+    for call_id in dependencies: visit(call_id)
+    return cyclic
+
+def dispatch_tool_call_batch(tab_id, tool_calls, conversation_id=None):
+    """
+    Screens the invokes of one multi-call block (parse errors, duplicates, depends_on cycles) and
+    starts running the rest as a batch task. Like dispatch_parsed_tool_call, returns straight away.
+    """
+    outcomes = {} # call_id -> result payload
+    runnable = {} # call_id -> tool_call_data
+    unlisted = [] # Rejections without a call_id of their own (missing, or repeated within the block)
+    for tool_call_data in tool_calls:
+        rejection = check_parsed_tool_call(tab_id, tool_call_data, conversation_id)
+        call_id = tool_call_data.get("call_id")
+        if rejection is None:
+            runnable[call_id] = tool_call_data
+        elif not call_id or call_id in runnable or call_id in outcomes:
+            unlisted.append(rejection)
+        else:
+            if rejection["status"] != "skipped_duplicate": # A duplicate was answered in an earlier turn; nothing to tell Gemini
+                rejection.setdefault("text_response", f"<tool_result><call_id>{call_id}</call_id><tool_name>{rejection.get('tool_name')}</tool_name><result>ERROR: {escape_xml_text(rejection['message'])}</result></tool_result>")
+            outcomes[call_id] = rejection
+
+    # Dependencies on call_ids outside this block refer to calls that already finished in earlier turns
+    dependencies = {call_id: [d for d in data.get("depends_on", ()) if d in runnable or d in outcomes]
+                    for call_id, data in runnable.items()}
+    for call_id in find_dependency_cycles(dependencies):
+        outcomes[call_id] = _batch_error_payload("error_dependency_cycle", runnable.pop(call_id),
+                                                 f"depends_on of call {call_id} forms a cycle; the call was not run.")
+    batch_name = f"tool-batch-{min(outcomes.keys() | runnable.keys(), key=_call_id_sort_key, default='empty')}"
+    return spawn_task(execute_tool_call_batch(tab_id, runnable, dependencies, outcomes, unlisted, conversation_id), name=batch_name, tab_id=tab_id)
+
+async def execute_tool_call_batch(tab_id, runnable, dependencies, outcomes, unlisted=(), conversation_id=None):
+    """
+    Runs the screened calls of a multi-call block, each as soon as the calls it depends on have
+    succeeded, and sends every outcome to the tab as one tool_batch_results payload.
+    """
+    tasks = {}
+    async def run_when_ready(call_id, tool_call_data):
+        for dependency in dependencies[call_id]:
+            if dependency in tasks:
+                await asyncio.wait([tasks[dependency]])
+                if tasks[dependency].cancelled():
+                    outcomes.setdefault(dependency, {"status": "tool_call_cancelled"})
+            dependency_status = outcomes.get(dependency, {}).get("status")
+            # A skipped duplicate already ran in an earlier turn, like a dependency outside the block
+            if dependency_status not in ("tool_executed_and_result_ready", "skipped_duplicate"):
+                outcomes[call_id] = _batch_error_payload("skipped_dependency_failed", tool_call_data,
+                                                         f"Call {call_id} was not run because call {dependency} it depends on did not succeed ({dependency_status}).")
+                return
+        payload, _ = await run_tool_call_request(tab_id, tool_call_data, conversation_id)
+        outcomes[call_id] = payload
+
+    started = time.perf_counter()
+    for call_id, tool_call_data in runnable.items():
+        task = asyncio.create_task(run_when_ready(call_id, tool_call_data), name=f"tool-call-{call_id}")
+        tasks[call_id] = task
+        BATCHED_TOOL_CALLS.add((tab_id, call_id))
+        track_in_flight_call(tab_id, call_id, task)
+    try:
+        if tasks:
+            await asyncio.wait(tasks.values())
+    finally:
+        for call_id, task in tasks.items():
+            BATCHED_TOOL_CALLS.discard((tab_id, call_id))
+            if not task.done(): task.cancel() # The batch itself was cancelled (e.g. the host is exiting)
+    for call_id, task in tasks.items():
+        if task.cancelled():
+            outcomes[call_id] = _batch_error_payload("tool_call_cancelled", runnable[call_id], f"Tool call {call_id} was cancelled.")
+        elif task.exception() is not None:
+            outcomes[call_id] = _batch_error_payload("error_executing_tool", runnable[call_id], f"Tool call {call_id} failed: {task.exception()}")
+
+    ordered_ids = sorted(outcomes, key=_call_id_sort_key)
+    results = [{key: outcomes[call_id].get(key) for key in ("call_id", "tool_name", "status", "message", "cache_hit")
+                if outcomes[call_id].get(key) is not None} for call_id in ordered_ids]
+    results += [{key: p.get(key) for key in ("call_id", "tool_name", "status", "message") if p.get(key) is not None} for p in unlisted]
+    succeeded = sum(1 for r in results if r["status"] == "tool_executed_and_result_ready")
+    elapsed = time.perf_counter() - started
+    LOGGER.info(f"Tool call batch of {len(results)} calls finished: {succeeded} succeeded.",
+                extra={"tab_id": tab_id, "call_ids": ordered_ids, "duration_ms": round(elapsed * 1000, 3)})
+    METRICS.inc("mcp_host_tool_batches_total")
+    METRICS.inc("mcp_host_tool_batch_calls_total", len(results))
+    METRICS.observe("mcp_host_tool_batch_seconds", elapsed)
+    batch_payload = {
+        "status": "tool_batch_results",
+        "batch_id": f"{ordered_ids[0]}..{ordered_ids[-1]}" if ordered_ids else "empty",
+        "call_ids": ordered_ids,
+        "results": results
+    }
+    result_blocks = [outcomes[call_id]["text_response"] for call_id in ordered_ids if outcomes[call_id].get("text_response")]
+    if result_blocks: # Absent when every call was a duplicate, so the tab does not paste anything
+        batch_payload["text_response"] = "<tool_results>\n" + "\n".join(result_blocks) + "\n</tool_results>"
+    if tab_id:
+        send_tool_result(tab_id, batch_payload)
     else:
-        sys.stderr.write("No tools were discovered from any active server.\n"); sys.stderr.flush() # Keep status
+        LOGGER.warning(f"Warning: No tabId, cannot send results of tool call batch {batch_payload['batch_id']}.")
+    return batch_payload
 
-    # Format the discovered tools into a markdown string
-    global FORMATTED_TOOL_LIST_MD
-    md_parts = []
-    if DISCOVERED_TOOLS:
-        # print_debug(f"Formatting {len(DISCOVERED_TOOLS)} discovered tools for system prompt...")
-        for tool_info in DISCOVERED_TOOLS:
-            tool_md = []
-            tool_md.append(f" - {tool_info.get('name', 'Unnamed Tool')}")
-            tool_md.append(f"   **Description**: {tool_info['tool'].description}")
-            tool_md.append(f"   **Parameters**:")
-
-            params_schema = tool_info['tool'].inputSchema
-            properties = None
-            if isinstance(params_schema, dict):
-                properties = params_schema.get('properties')
-
-            if properties and isinstance(properties, dict) and len(properties) > 0:
-                required_params = params_schema.get('required', [])
-                for param_name, param_details in properties.items():
-                    if not isinstance(param_details, dict):
-                        sys.stderr.write(f"Warning: Parameter '{param_name}' for tool '{tool_info.get('name')}' has invalid details format. Skipping.\n"); sys.stderr.flush() # Keep warning
-                        continue
-                    param_desc = param_details.get('description', '')
-                    param_type = param_details.get('type', 'any')
-                    is_req = 'required' if param_name in required_params else 'optional'
-                    tool_md.append(f"     - `{param_name}`: {param_desc} ({param_type}) ({is_req})")
-            else:
-                tool_md.append(f"     - No parameters defined.")
+def handle_cancel_tool_call(tab_id, payload):
+    """
+    Cancels an in-flight tool call (CANCEL_TOOL_CALL) and tells the tab, so Gemini is not left
+    waiting for a result. Without a tabId (e.g. from the API) any tab's call with that call_id matches.
+    """
+    call_id = (payload or {}).get("call_id")
+    if not call_id:
+        LOGGER.error("Error: CANCEL_TOOL_CALL message missing call_id.")
+        return False
+    matches = [key for key in IN_FLIGHT_TOOL_CALLS if key[1] == call_id and (tab_id is None or key[0] == tab_id)]
+    if not matches:
+        LOGGER.info(f"CANCEL_TOOL_CALL: No in-flight tool call with call_id '{call_id}'.")
+        if tab_id:
+            send_message({"tabId": tab_id, "payload": {"status": "cancel_failed", "call_id": call_id,
+                                                       "message": f"Python host: No running tool call with ID {call_id} to cancel."}})
+        return False
+    for key in matches:
+        IN_FLIGHT_TOOL_CALLS.pop(key).cancel()
+        count_tool_call(None, None, "tool_call_cancelled")
+        LOGGER.info(f"CANCEL_TOOL_CALL: Cancelled tool call '{call_id}' in tab {key[0]}.")
+        if key in BATCHED_TOOL_CALLS:
+            continue # Reported with the rest of its batch
+        if key[0]:
+            send_message({
+                "tabId": key[0],
+                "payload": {
+                    "status": "tool_call_cancelled",
+                    "call_id": call_id,
+                    "message": f"Python host: Tool call {call_id} was cancelled.",
+                    "text_response": f"<tool_result><call_id>{call_id}</call_id><result>ERROR: Tool call was cancelled by the user before it completed.</result></tool_result>"
+                }
+            })
+    return True
+
+async def handle_request_prompt(tab_id, payload=None):
+    # print_debug(f"Received REQUEST_PROMPT message. Tab ID: {tab_id}")
+    # Wait until the tool list is complete: immediate when the catalog cache covered every server,
+    # otherwise once discovery finishes. Only when the cache covered some servers is the wait capped at
+    # promptDiscoveryWaitSeconds, answering with the cached tools plus those found so far. Without any
+    # cache the wait is unbounded (discovery has its own per-server timeouts): the extension never asks
+    # again, so a partial prompt would leave the chat without the slower servers' tools for good.
+    wait_seconds = float(HOST_SETTINGS.get("promptDiscoveryWaitSeconds") or 0) if CATALOG_PARTLY_CACHED else 0
+    try:
+        await asyncio.wait_for(CATALOG_READY.wait(), timeout=wait_seconds or None)
+    except asyncio.TimeoutError:
+        LOGGER.warning(f"Discovery still running after {wait_seconds}s; answering tabId {tab_id} with the {len(TOOL_REGISTRY.tools)} tools discovered so far.")
+    # Optional 'servers'/'tags' in the payload restrict the prompt to a subset of tools
+    prompt_filter = normalize_prompt_filter(payload)
+    render_started = time.perf_counter()
+    final_prompt, tool_count, from_cache = render_system_prompt(prompt_filter)
+    if not from_cache: STARTUP_PROFILE.record(f"render prompt ({tool_count} tools)", render_started)
+    prompt_bytes = len(final_prompt.encode('utf-8'))
+    filter_description = "all tools" if prompt_filter == (None, None) else f"servers={list(prompt_filter[0] or [])} tags={list(prompt_filter[1] or [])}"
+    LOGGER.info(f"System prompt for tabId {tab_id}: {prompt_bytes} bytes, {tool_count} tools ({filter_description}){' [cached]' if from_cache else ''}.")
+
+    # Debug log for the final prompt (snippet)
+    # snippet_length = 200
+    # prompt_snippet_start = final_prompt[:snippet_length]
+    # prompt_snippet_end = final_prompt[-snippet_length:] if len(final_prompt) > snippet_length * 2 else ""
+    # ellipsis = " ... " if len(final_prompt) > snippet_length * 2 else ""
+    # print_debug(f"Final prompt snippet being sent to tabId {tab_id}: {prompt_snippet_start}{ellipsis}{prompt_snippet_end}")
+
+    response_message = {
+        "tabId": tab_id,
+        "payload": {
+            "type": "PROMPT_RESPONSE",
+            "prompt": final_prompt,
+            "prompt_bytes": prompt_bytes,
+            "tool_count": tool_count,
+            "discovery_complete": CATALOG_READY.is_set() # False if discovery was still running
+        }
+    }
+    send_message(response_message)
+    # print_debug(f"Sent PROMPT_RESPONSE with dynamically generated prompt to tabId: {tab_id}")
 
-            md_parts.append("\n".join(tool_md) + "\n") # Add extra newline after each tool block
+def get_server_semaphore(server_config):
+    """Returns the semaphore enforcing a server's 'maxConcurrentCalls' limit, creating it on first use."""
+    server_id = server_config.get('id')
+    semaphore = SERVER_SEMAPHORES.get(server_id)
+    if semaphore is None:
+        semaphore = asyncio.Semaphore(max(1, int(get_server_setting(server_config, "maxConcurrentCalls"))))
+        SERVER_SEMAPHORES[server_id] = semaphore
+    return semaphore
 
-        FORMATTED_TOOL_LIST_MD = "\n".join(md_parts) # Join all tool blocks
-        # Remove last extra newline if string is not empty, to avoid triple newline before </SYSTEM>
-        if FORMATTED_TOOL_LIST_MD.endswith("\n\n"):
-             FORMATTED_TOOL_LIST_MD = FORMATTED_TOOL_LIST_MD[:-1]
-        # print_debug(f"Formatted tool list MD:\n{FORMATTED_TOOL_LIST_MD}") # Can be very verbose
+def spawn_task(coro, name=None, tab_id=None):
+    """
+    Runs a message handler as a background task. The task is kept referenced until it finishes,
+    and an unexpected exception is logged and reported to the originating tab.
+    """
+    task = asyncio.create_task(coro, name=name)
+    ACTIVE_TASKS.add(task)
+    def _on_done(finished_task):
+        ACTIVE_TASKS.discard(finished_task)
+        if finished_task.cancelled(): return
+        e = finished_task.exception()
+        if e is None: return
+        LOGGER.error(f"Error in task '{finished_task.get_name()}': {e}")
+        if tab_id:
+            try: send_message({"tabId": tab_id, "payload": {"status": "error_processing_loop", "message": f"Python host error: {str(e)}"}})
+            except Exception as e_send: LOGGER.error(f"Failed to send error message to extension: {e_send}")
+    task.add_done_callback(_on_done)
+    return task
+
+def _host_gauges():
+    """Point-in-time values for /metrics and the periodic summary, read when scraped."""
+    gauges = [("mcp_host_in_flight_tool_calls", {}, len(IN_FLIGHT_TOOL_CALLS)),
+              ("mcp_host_active_tasks", {}, len(ACTIVE_TASKS)),
+              ("mcp_host_registered_tools", {}, len(TOOL_REGISTRY.tools) if TOOL_REGISTRY else 0)]
+    if STARTUP_PROFILE.first_response_seconds is not None:
+        gauges.append(("mcp_host_time_to_first_response_seconds", {}, round(STARTUP_PROFILE.first_response_seconds, 6)))
+    if RESULT_CACHE is not None:
+        for key, value in RESULT_CACHE.stats().items(): gauges.append((f"mcp_host_result_cache_{key}", {}, value))
+    if PROCESSED_CALL_IDS is not None:
+        for key, value in PROCESSED_CALL_IDS.stats().items(): gauges.append((f"mcp_host_call_id_dedup_{key}", {}, value))
+    http_pool = HTTP_CONNECTION_POOL.stats()
+    for key in ("connections", "idle_connections", "http2_connections"):
+        if key in http_pool: gauges.append((f"mcp_host_http_pool_{key}", {}, http_pool[key]))
+    breaker_states = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
+    for server_id, breaker in list(CIRCUIT_BREAKERS.items()):
+        gauges.append(("mcp_host_circuit_breaker_state", {"server": server_id}, breaker_states[breaker.state]))
+    return gauges
+
+METRICS.add_gauge_callback(_host_gauges)
+METRICS.describe("mcp_host_in_flight_tool_calls", "gauge", "Tool calls currently running or queued.")
+METRICS.describe("mcp_host_active_tasks", "gauge", "Message handler tasks currently running.")
+METRICS.describe("mcp_host_registered_tools", "gauge", "Tools in the current tool registry.")
+METRICS.describe("mcp_host_time_to_first_response_seconds", "gauge", "Time from the host script starting to its first message to the extension.")
+METRICS.describe("mcp_host_circuit_breaker_state", "gauge", "Circuit breaker state by server: 0 closed, 1 half-open, 2 open.")
+METRICS.describe("mcp_host_http_pool_connections", "gauge", "Open connections in the shared HTTP pool.")
+METRICS.describe("mcp_host_http_pool_idle_connections", "gauge", "Of those, connections idle and kept alive for reuse.")
+METRICS.describe("mcp_host_http_pool_http2_connections", "gauge", "Of those, HTTP/2 connections.")
+
+async def log_metrics_periodically(interval_seconds):
+    """Logs a metrics summary record every interval_seconds."""
+    while True:
+        await asyncio.sleep(interval_seconds)
+        LOGGER.info("Metrics", extra={"metrics": METRICS.summary()})
 
+async def main_async():
+    global TOOL_REGISTRY, TOOL_CALL_SEMAPHORE, PROCESSED_CALL_IDS, RESULT_CACHE
+    
+    # Log API status
+    if API_ENABLED:
+        LOGGER.info(f"API interface is enabled on port {API_PORT}")
     else:
-        FORMATTED_TOOL_LIST_MD = "No tools available." # Placeholder if no tools are discovered
-        # print_debug("No tools discovered, FORMATTED_TOOL_LIST_MD set to 'No tools available.'.")
-
-
-    sys.stderr.write(f"MCP Native Host script initialized. Waiting for messages...\n"); sys.stderr.flush() # Keep status
+        LOGGER.info("API interface is disabled. Use --enable-api to enable it.")
+
+    config_started = time.perf_counter()
+    if load_server_configurations(CONFIG_FILENAME):
+        if SERVER_CONFIGURATIONS: LOGGER.info(f"Loaded {len(SERVER_CONFIGURATIONS)} MCP server configurations.")
+        else: LOGGER.info("No valid server configurations found.")
+    else: LOGGER.error("Failed to load MCP server configurations.")
+    configure_logging(HOST_SETTINGS) # Apply logLevel / logFile from hostSettings
+    LOGGER.info(f"Native messaging JSON backend: {set_json_backend(HOST_SETTINGS.get('jsonBackend'))}")
+    STARTUP_PROFILE.record("load config", config_started)
+    if API_ENABLED:
+        await start_api_server(API_PORT)
+
+    TOOL_CALL_SEMAPHORE = asyncio.Semaphore(max(1, int(HOST_SETTINGS.get("maxConcurrentToolCalls"))))
+    SERVER_SEMAPHORES.clear()
+    PROCESSED_CALL_IDS = CallIdDedupStore(ttl_seconds=float(HOST_SETTINGS.get("callIdTtlSeconds") or 0),
+                                          max_entries=int(HOST_SETTINGS.get("maxTrackedCallIds")))
+    RESULT_CACHE = ToolResultCache(max_bytes=int(HOST_SETTINGS.get("resultCacheMaxBytes")))
+
+    if resource is None and any(get_server_setting(sc, key) for sc in SERVER_CONFIGURATIONS for key in ("processMaxMemoryMB", "processMaxCpuSeconds")):
+        LOGGER.warning("Warning: processMaxMemoryMB and processMaxCpuSeconds need POSIX resource limits. Ignoring them on this platform.")
+
+    TOOL_REGISTRY = ToolRegistry(server_configs=SERVER_CONFIGURATIONS)
+    cache_started = time.perf_counter()
+    if apply_cached_catalog():
+        CATALOG_READY.set()
+    STARTUP_PROFILE.record("tool catalog cache", cache_started)
+    reconcile_supervisors() # Connects "eager" servers right away, alongside discovery
+    # Discovery runs concurrently in the background (revalidating any cached catalog); the message loop
+    # starts straight away and tools from each server become callable as soon as that server has answered.
+    global DISCOVERY_TASK
+    discovery_started = time.perf_counter()
+    DISCOVERY_TASK = asyncio.create_task(discover_all_tools(), name="mcp-discovery")
+    def _on_discovery_done(task):
+        if task.cancelled(): return # Shutting down before discovery finished
+        STARTUP_PROFILE.record("discovery (all servers)", discovery_started)
+        STARTUP_PROFILE.record_discovery_finished()
+    DISCOVERY_TASK.add_done_callback(_on_discovery_done)
+    metrics_interval = float(HOST_SETTINGS.get("metricsLogIntervalSeconds") or 0)
+    metrics_task = asyncio.create_task(log_metrics_periodically(metrics_interval), name="mcp-metrics-log") if metrics_interval > 0 else None
+    config_watch_task = asyncio.create_task(watch_config_file(CONFIG_PATH), name="mcp-config-watch") if HOST_SETTINGS.get("configHotReload") else None
+
+    LOGGER.info(f"MCP Native Host script initialized. Waiting for messages...")
     while True:
         try:
-            received_message = get_message()
-            if received_message is None: sys.stderr.write("No message from extension. Browser might have closed.\n"); sys.stderr.flush(); break # Keep status
+            received_message = await read_message()
+            if received_message is None: LOGGER.info("No message from extension. Browser might have closed."); break
 
             message_type = received_message.get("type")
             tab_id = received_message.get("tabId") # Ensure tabId is captured for responses
+            METRICS.inc("mcp_host_messages_received_total", type=str(message_type))
             payload = received_message.get("payload")
 
             # print_debug(f"Received message of type '{message_type}': {json.dumps(payload if payload else received_message)}") # Very verbose
 
+            # Handlers that may wait (tool execution, prompt rendering during discovery) run as tasks,
+            # so the loop goes straight back to reading the next message.
             if message_type == "TOOL_CALL_DETECTED":
-                if not payload or "raw_xml" not in payload:
-                    sys.stderr.write("Error: TOOL_CALL_DETECTED message missing payload or raw_xml.\n"); sys.stderr.flush() # Keep error
-                    if tab_id: # Try to send error back if tab_id is known
-                         send_message({"tabId": tab_id, "payload": {"status": "error", "message": "Python host received empty/invalid tool call payload."}})
-                    continue
-
-                raw_xml_from_cs = payload.get("raw_xml")
-                call_id_from_cs_attr = payload.get("call_id") # This is the call_id extracted from DOM attribute by content_script
-
-                # print_debug(f"Processing TOOL_CALL_DETECTED. XML: {raw_xml_from_cs[:200]}... CS CallID Attr: {call_id_from_cs_attr}")
-
-                parsed_tool_calls = parse_tool_call_xml(raw_xml_from_cs, call_id_from_cs_attr)
-
-                # Case 1: parse_tool_call_xml itself returned an error structure (e.g., XML syntax error)
-                # This is usually a single-item list with an "error" key.
-                if parsed_tool_calls and isinstance(parsed_tool_calls, list) and "error" in parsed_tool_calls[0]:
-                    error_data = parsed_tool_calls[0]
-                    sys.stderr.write(f"XML parsing directly returned an error: {error_data.get('error')}\n"); sys.stderr.flush() # Keep error
-                    if tab_id:
-                        send_message({
-                            "tabId": tab_id,
-                            "payload": {
-                                "status": "error_parsing_xml", # More specific status
-                                "message": f"Python host: {error_data.get('error', 'Unknown XML parsing error.')}",
-                                "call_id": error_data.get("call_id", call_id_from_cs_attr), # Use original call_id if available
-                                "raw_xml_snippet": error_data.get("raw_xml", raw_xml_from_cs)[:200]
-                            }
-                        })
-                    continue # Skip further processing for this message
-
-                # Case 2: XML was valid, but no <invoke> elements were found.
-                # parse_tool_call_xml returns an empty list in this scenario (unless it's an error like root tag mismatch, handled above).
-                if not parsed_tool_calls: # This now specifically means no invokable tools found in otherwise valid XML structure
-                    # print_debug(f"Valid XML received, but no <invoke> elements found or no tools parsed from: {raw_xml_from_cs[:100]}... Silently ignoring as per new logic.") # Can be noisy
-                    # DO NOT send a message back to the extension. Silently ignore.
-                    continue
-
-                # Case 3: Valid tool calls were parsed.
-                # Iterate through potentially multiple tool calls within one <function_calls> block.
-                for tool_call_data in parsed_tool_calls:
-                    # It's possible that parse_tool_call_xml could be extended to return per-tool errors
-                    # even within a list of otherwise valid calls. This handles that defensively.
-                    if "error" in tool_call_data: # Should ideally be caught by Case 1 if it's a global XML error.
-                        sys.stderr.write(f"Individual tool call data contained an error: {tool_call_data['error']}\n"); sys.stderr.flush() # Keep error
-                        if tab_id:
-                            send_message({
-                                "tabId": tab_id,
-                                "payload": {
-                                    "status": "error_processing_tool_data", # Specific error for this tool
-                                    "message": f"Python host: {tool_call_data.get('error', 'Error in specific tool data.')}",
-                                    "call_id": tool_call_data.get("call_id"),
-                                    "tool_name": tool_call_data.get("tool_name", "Unknown tool"),
-                                    "raw_xml_snippet": tool_call_data.get("raw_xml_invoke", "")[:200]
-                                }
-                            })
-                        continue # Move to the next tool call in the list
-
-                    # This is the call_id from Python parsing (XML content preferred, then CS attribute)
-                    parsed_call_id = tool_call_data.get("call_id")
-                    tool_name = tool_call_data.get("tool_name")
-                    parameters = tool_call_data.get("parameters")
-
-                    if not parsed_call_id:
-                        sys.stderr.write(f"Critical: Parsed tool '{tool_name}' is missing a call_id after parsing. This should not happen if parse_tool_call_xml is correct. Skipping.\n"); sys.stderr.flush() # Keep critical error
-                        if tab_id:
-                             send_message({
-                                 "tabId": tab_id,
-                                 "payload": {
-                                     "status": "error_internal",
-                                     "tool_name": tool_name,
-                                     "message": f"Python host: Internal error - parsed tool '{tool_name}' is missing call_id."
-                                 }
-                             })
-                        continue
-
-                    # print_debug(f"Parsed Tool Call: Name='{tool_name}', Call_ID='{parsed_call_id}', Params='{parameters}'")
-
-                    # Duplicate Check using the call_id from Python parsing
-                    if parsed_call_id in PROCESSED_CALL_IDS:
-                        sys.stderr.write(f"Duplicate call_id '{parsed_call_id}' (from Python parsing) detected. Skipping tool '{tool_name}'.\n"); sys.stderr.flush() # Keep info
-                        if tab_id: # Inform extension about skipping duplicate
-                            send_message({
-                                "tabId": tab_id,
-                                "payload": {
-                                    "status": "skipped_duplicate",
-                                    "tool_name": tool_name,
-                                    "call_id": parsed_call_id,
-                                    "message": f"Python host: Tool call '{tool_name}' (ID: {parsed_call_id}) skipped as duplicate."
-                                }
-                            })
-                        continue
-                    PROCESSED_CALL_IDS.add(parsed_call_id)
-                    # print_debug(f"Added call_id '{parsed_call_id}' to processed set. Set size: {len(PROCESSED_CALL_IDS)}")
-
-                    # --- BEGIN TOOL EXECUTION LOGIC ---
-                    # 1. Find Tool and Server Configuration
-                    discovered_tool_config = None
-                    for dt in DISCOVERED_TOOLS:
-                        if dt.get("name") == tool_name:
-                            discovered_tool_config = dt
-                            break
-
-                    if not discovered_tool_config:
-                        sys.stderr.write(f"Error: Tool '{tool_name}' (ID: {parsed_call_id}) not found in DISCOVERED_TOOLS list after initial check.\n"); sys.stderr.flush() # Keep error
-                        if tab_id:
-                            send_message({
-                                "tabId": tab_id,
-                                "payload": {
-                                    "status": "tool_not_found",
-                                    "tool_name": tool_name,
-                                    "call_id": parsed_call_id,
-                                    "message": f"Python host: Tool '{tool_name}' (ID: {parsed_call_id}) not found in discovered tools during execution phase.",
-                                    "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: Tool '{tool_name}' not found.</result></tool_result>"
-                                }
-                            })
-                        continue
-
-                    mcp_server_id = discovered_tool_config.get("mcp_server_id")
-                    server_config = None
-                    for sc in SERVER_CONFIGURATIONS:
-                        if sc.get("id") == mcp_server_id:
-                            server_config = sc
-                            break
-
-                    if not server_config:
-                        sys.stderr.write(f"Error: Server configuration for mcp_server_id '{mcp_server_id}' not found for tool '{tool_name}'.\n"); sys.stderr.flush() # Keep error
-                        if tab_id:
-                            send_message({
-                                "tabId": tab_id,
-                                "payload": {
-                                    "status": "error_executing_tool",
-                                    "tool_name": tool_name,
-                                    "call_id": parsed_call_id,
-                                    "message": f"Python host: Server configuration for '{mcp_server_id}' not found while trying to execute tool '{tool_name}'.",
-                                    "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: Server configuration for '{mcp_server_id}' not found for tool '{tool_name}'.</result></tool_result>"
-                                }
-                            })
-                        continue
-
-                    # 2. & 3. Instantiate MCP Client and Execute Tool Call are now handled by _execute_tool_call_async
-                    tool_result = None
-                    execution_error = None
-
-                    try:
-                        # print_debug(f"Main Loop: Calling run_async_task for tool '{tool_name}' (Call ID: {parsed_call_id}) on server '{mcp_server_id}'.")
-                        # Pass `parsed_call_id` for logging purposes within the async helper
-                        tool_result = run_async_task(
-                            _execute_tool_call_async(tool_name, parameters, server_config, fastmcp, parsed_call_id)
-                        )
-                        # If _execute_tool_call_async completes without raising an exception, tool_result is set.
-                        # If it raises, execution_error will be set in the except block below.
-                        # print_debug(f"Main Loop: Tool '{tool_name}' (Call ID: {parsed_call_id}) async task completed. Raw Result: {str(tool_result)[:200]}...")
-
-                    except Exception as e_async_call:
-                        # This catches errors from run_async_task or if _execute_tool_call_async raised an exception.
-                        sys.stderr.write(f"Main Loop: Error calling async execution helper for tool '{tool_name}' (Call ID: {parsed_call_id}): {e_async_call}\n"); sys.stderr.flush() # Keep error
-                        execution_error = e_async_call # Store the exception
-
-                    # Process result or error
-                    if execution_error:
-                        # Handle error (e.g., send error message to extension)
-                        if tab_id:
-                            send_message({
-                                "tabId": tab_id,
-                                "payload": {
-                                    "status": "error_executing_tool",
-                                    "tool_name": tool_name,
-                                    "call_id": parsed_call_id,
-                                    "message": f"Python host: Error during execution of tool '{tool_name}': {str(execution_error)}",
-                                    "text_response": f"<tool_result><call_id>{parsed_call_id}</call_id><tool_name>{tool_name}</tool_name><result>ERROR: During execution of tool '{tool_name}': {str(execution_error)}</result></tool_result>"
-                                }
-                            })
-                        continue # Continue to next tool call in the parsed_tool_calls list
-                    else:
-                        # Process successful tool_result
-                        # Handle cases where tool_result might be None, empty list, or doesn't have expected structure
-                        actual_result_content = ""
-                        if tool_result:
-                            if isinstance(tool_result, list) and len(tool_result) > 0:
-                                if hasattr(tool_result[0], 'text'):
-                                    actual_result_content = tool_result[0].text
-                                elif isinstance(tool_result[0], dict) and 'text' in tool_result[0]:
-                                    actual_result_content = tool_result[0]['text']
-                                else:
-                                    # If we can't find a .text attribute or 'text' key, convert the whole result to string
-                                    actual_result_content = str(tool_result[0])
-                            else:
-                                # If tool_result is not a list or is empty, convert the whole result to string
-                                actual_result_content = str(tool_result)
-                        
-                        # If we still have no content, provide a default message
-                        if not actual_result_content:
-                            actual_result_content = "(No data returned by tool)"
-                            
-                        actual_result_content = actual_result_content.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-                        formatted_xml_result = f"""<tool_result>
-  <call_id>{parsed_call_id}</call_id>
-  <tool_name>{tool_name}</tool_name>
-  <result>{actual_result_content}</result>
-</tool_result>"""
-                        # print_debug(f"Formatted XML result for '{tool_name}' (ID: {parsed_call_id}): {formatted_xml_result}") # Can be verbose
-
-                        response_payload_to_extension = {
-                            "status": "tool_executed_and_result_ready",
-                            "tool_name": tool_name,
-                            "call_id": parsed_call_id,
-                            "text_response": formatted_xml_result
-                        }
-                        if tab_id:
-                            send_message({"tabId": tab_id, "payload": response_payload_to_extension})
-                            # print_debug(f"Sent formatted XML result to extension for tool '{tool_name}', call_id '{parsed_call_id}'.")
-                        else:
-                            sys.stderr.write(f"Warning: No tabId, cannot send formatted XML result for call_id '{parsed_call_id}'.\n"); sys.stderr.flush() # Keep warning
-                    # --- END TOOL EXECUTION LOGIC (Refactored) ---
+                handle_tool_call_detected(tab_id, payload)
 
             elif message_type == "PING": # Example of handling other message types
                 # print_debug("Received PING from extension.")
                 if tab_id:
                     send_message({"tabId": tab_id, "payload": {"type": "PONG", "message": "Python host says PONG!"}})
 
+            elif message_type == "CANCEL_TOOL_CALL":
+                handle_cancel_tool_call(tab_id, payload)
+
+            elif message_type == "PROMPT_REPLY": # Gemini's answer to a prompt sent through /api/send_prompt
+                handle_prompt_reply(tab_id, payload)
+
             elif message_type == "REQUEST_PROMPT":
-                # print_debug(f"Received REQUEST_PROMPT message. Tab ID: {tab_id}")
                 # Ensure tab_id is present, though background.js should always send it
                 if tab_id is None:
-                    sys.stderr.write("Error: REQUEST_PROMPT received without a tabId. Cannot respond.\n"); sys.stderr.flush() # Keep error
+                    LOGGER.error("Error: REQUEST_PROMPT received without a tabId. Cannot respond.")
                 else:
-                    # Access global BASE_SYSTEM_PROMPT and FORMATTED_TOOL_LIST_MD
-                    # Ensure FORMATTED_TOOL_LIST_MD is not None, though it's initialized to "" or "No tools available."
-                    tool_list_for_prompt = FORMATTED_TOOL_LIST_MD if FORMATTED_TOOL_LIST_MD else ""
-
-                    final_prompt = BASE_SYSTEM_PROMPT.replace("{dynamic_tool_list_placeholder}", tool_list_for_prompt)
-
-                    # Debug log for the final prompt (snippet)
-                    # snippet_length = 200
-                    # prompt_snippet_start = final_prompt[:snippet_length]
-                    # prompt_snippet_end = final_prompt[-snippet_length:] if len(final_prompt) > snippet_length * 2 else ""
-                    # ellipsis = " ... " if len(final_prompt) > snippet_length * 2 else ""
-                    # print_debug(f"Final prompt snippet being sent to tabId {tab_id}: {prompt_snippet_start}{ellipsis}{prompt_snippet_end}")
-
-                    response_message = {
-                        "tabId": tab_id,
-                        "payload": {
-                            "type": "PROMPT_RESPONSE",
-                            "prompt": final_prompt
-                        }
-                    }
-                    send_message(response_message)
-                    # print_debug(f"Sent PROMPT_RESPONSE with dynamically generated prompt to tabId: {tab_id}")
+                    spawn_task(handle_request_prompt(tab_id, payload), name=f"request-prompt-{tab_id}", tab_id=tab_id)
 
-        except EOFError: sys.stderr.write("EOF encountered, stdin closed. Exiting.\n"); sys.stderr.flush(); break # Keep status
+        except EOFError: LOGGER.info("EOF encountered, stdin closed. Exiting."); break
         except Exception as e:
-            sys.stderr.write(f"Error processing message loop: {e}\n"); sys.stderr.flush() # Keep error
+            LOGGER.error(f"Error processing message loop: {e}")
             # Attempt to send an error message back to the extension if a tabId is available
             # This is a general error catch, might not always have tab_id if error is in get_message() itself
             try:
@@ -761,149 +3264,515 @@ def main():
                 if current_tab_id:
                      send_message({"tabId": current_tab_id, "payload": {"status": "error_processing_loop", "message": f"Python host error: {str(e)}"}})
             except Exception as e_send:
-                sys.stderr.write(f"Failed to send error message to extension during exception handling: {e_send}\n"); sys.stderr.flush() # Keep error
+                LOGGER.error(f"Failed to send error message to extension during exception handling: {e_send}")
 
-            if isinstance(e, struct.error): sys.stderr.write("Struct error, likely malformed message length. Exiting.\n"); sys.stderr.flush(); break # Keep critical error
+            if isinstance(e, (struct.error, NativeMessagingError)): LOGGER.error(f"Malformed native messaging frame ({e}). Exiting."); break
     
     # Clean up resources before exiting
+    # The browser side is gone, so there is nobody left to deliver in-flight results to
+    pending_tasks = list(ACTIVE_TASKS) + [t for t in TOOL_REFRESH_TASKS.values() if not t.done()]
+    if metrics_task: pending_tasks.append(metrics_task)
+    if config_watch_task: pending_tasks.append(config_watch_task)
+    for task in pending_tasks: task.cancel()
+    if pending_tasks: await asyncio.gather(*pending_tasks, return_exceptions=True)
+    if DISCOVERY_TASK and not DISCOVERY_TASK.done():
+        DISCOVERY_TASK.cancel()
+        await asyncio.gather(DISCOVERY_TASK, return_exceptions=True)
+    await stop_supervisors() # Or they would restart the sessions being closed
+    try: await SESSION_POOL.close_all()
+    except Exception as e: LOGGER.error(f"Error closing MCP sessions: {e}")
+    try: await HTTP_CONNECTION_POOL.close()
+    except Exception as e: LOGGER.error(f"Error closing the HTTP connection pool: {e}")
     if API_ENABLED:
-        stop_api_server()
+        await stop_api_server()
+    LOGGER.info("call_id dedup store", extra={"stats": PROCESSED_CALL_IDS.stats()})
+    LOGGER.info("Tool result cache", extra={"stats": RESULT_CACHE.stats()})
+    STARTUP_PROFILE.finish() # Reports a startup cut short, e.g. by the browser closing first
+    STDIN_EXECUTOR.shutdown(wait=False)
+
+def main():
+    """Runs the native host on a single long-lived asyncio event loop."""
+    try:
+        asyncio.run(main_async())
+    finally:
+        shutdown_logging()
 
 # API Server implementation
-class MCPAPIHandler(BaseHTTPRequestHandler):
-    def _set_response(self, status_code=200, content_type='application/json'):
-        self.send_response(status_code)
-        self.send_header('Content-type', content_type)
-        self.send_header('Access-Control-Allow-Origin', '*')
-        self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
-        self.send_header('Access-Control-Allow-Headers', 'Content-Type')
-        self.end_headers()
-    
-    def do_OPTIONS(self):
-        self._set_response()
-        
-    def do_GET(self):
-        self._set_response()
-        response = {'status': 'error', 'message': 'Method not supported'}
-        self.wfile.write(json.dumps(response).encode('utf-8'))
-    
-    def do_POST(self):
-        content_length = int(self.headers['Content-Length'])
-        post_data = self.rfile.read(content_length).decode('utf-8')
-        
+# The API runs on the host's own event loop (asyncio.start_server), so handlers call into the host
+# directly: no threads, no locks around stdout, and a send_prompt waiting minutes for Gemini's reply
+# is just a suspended task. Each connection is served by its own MCPAPIHandler with HTTP/1.1 keep-alive.
+
+API_KEEPALIVE_TIMEOUT_SECONDS = 15 # Close an idle keep-alive connection after this long
+API_MAX_BODY_BYTES = 1024 * 1024 # Larger request bodies are refused with 413
+API_CONNECTIONS = set() # Tasks serving open API connections, cancelled when the server stops
+PENDING_PROMPT_REPLIES = {} # request_id -> asyncio.Queue of PROMPT_REPLY payloads for a waiting send_prompt
+API_ENDPOINTS = {'/metrics', '/api/circuit_breakers', '/api/http_pool', '/api/log_level', '/api/send_prompt', '/api/cancel_tool_call',
+                 '/api/tools', '/api/tools/batch'}
+API_MAX_BATCH_CALLS = 100 # Most calls accepted in one POST /api/tools/batch
+TOOL_CATALOG_RESPONSE = None # ((registry version, discovery complete), ETag, encoded GET /api/tools body)
+HTTP_REASONS = {200: "OK", 204: "No Content", 304: "Not Modified", 400: "Bad Request", 403: "Forbidden", 404: "Not Found",
+                405: "Method Not Allowed", 409: "Conflict", 411: "Length Required", 413: "Payload Too Large", 415: "Unsupported Media Type",
+                500: "Internal Server Error", 502: "Bad Gateway", 503: "Service Unavailable", 504: "Gateway Timeout"}
+# HTTP status for each tool call outcome returned by the /api/tools endpoints
+TOOL_STATUS_HTTP_CODES = {"tool_executed_and_result_ready": 200, "tool_not_found": 404, "error_invalid_parameters": 400,
+                          "error_server_unavailable": 503, "error_executing_tool": 502, "tool_call_cancelled": 409}
+
+METRICS.describe("mcp_host_api_requests_total", "counter", "API requests served, by endpoint and HTTP status.")
+
+class MCPAPIHandler:
+    """
+    Serves one API connection. Requests on the connection are handled in turn until the client closes
+    it, sends "Connection: close" or stays idle for API_KEEPALIVE_TIMEOUT_SECONDS. Every request gets a
+    correlation id (the client's X-Request-Id, or a new one) that is echoed in the response headers and
+    carried with a prompt through the extension and back.
+    """
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.close_connection = False
+
+    async def handle(self):
         try:
-            parsed_url = urlparse(self.path)
-            endpoint = parsed_url.path
-            
-            if endpoint == '/api/send_prompt':
-                data = json.loads(post_data)
-                prompt = data.get('prompt')
-                
-                if not prompt:
-                    self._set_response(400)
-                    response = {'status': 'error', 'message': 'Missing prompt parameter'}
-                else:
-                    # Process the prompt through the MCP system
-                    sys.stderr.write(f"API: Received prompt request: {prompt[:50]}...\n")
-                    sys.stderr.flush()
-                    
-                    # We need to find a tab to send the prompt to
-                    # The browser extension background script will handle finding the active tab
-                    try:
-                        # We'll use a special tab ID that signals to the background script
-                        # that it should find the active tab
-                        tab_id = None  # The background script will find the active tab
-                            
-                        # Send the prompt to the browser extension
-                        # This is similar to how the system prompt is injected
-                        # We'll use the same message structure as REQUEST_PROMPT
-                        # but we'll include the custom prompt instead of the system prompt
-                        
-                        # Create a message to send to the content script
-                        message_to_send = {
-                            "type": "REQUEST_PROMPT",
-                            "tabId": tab_id,  # The background script will find the active tab
-                            "payload": {
-                                "type": "CUSTOM_PROMPT",
-                                "prompt": prompt
-                            }
-                        }
-                        
-                        # Send the message
-                        send_message(message_to_send)
-                        
-                        response = {
-                            'status': 'success',
-                            'message': 'Prompt sent to browser extension',
-                            'prompt': prompt,
-                            'response': "Prompt successfully sent to browser extension"
-                        }
-                    except Exception as e:
-                        sys.stderr.write(f"API: Error sending prompt: {str(e)}\n")
-                        sys.stderr.flush()
-                        self._set_response(500)
-                        response = {
-                            'status': 'error',
-                            'message': f'Error sending prompt: {str(e)}',
-                            'prompt': prompt
-                        }
-                        return
-                    self._set_response()
+            while not self.close_connection:
+                if not await self._read_request():
+                    break
+                await self._dispatch()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass # Client went away or sent garbage; nothing more to say on this connection
+        finally:
+            self.writer.close()
+
+    async def _read_request(self):
+        try:
+            request_line = await asyncio.wait_for(self.reader.readline(), timeout=API_KEEPALIVE_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            return False
+        if not request_line.strip():
+            return False
+        self.method, target, self.request_version = request_line.decode('latin-1').split(None, 2)
+        self.request_version = self.request_version.strip()
+        parsed_url = urlparse(target)
+        self.path = parsed_url.path
+        self.query = parse_qs(parsed_url.query)
+        self.headers = {}
+        while True:
+            line = await self.reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode('latin-1').partition(":")
+            self.headers[name.strip().lower()] = value.strip()
+        self.request_id = self.headers.get('x-request-id') or os.urandom(8).hex()
+        connection = self.headers.get('connection', '').lower()
+        if self.request_version == "HTTP/1.1":
+            self.close_connection = connection == "close"
+        else:
+            self.close_connection = connection != "keep-alive"
+        self.body = b""
+        if 'transfer-encoding' in self.headers:
+            self.close_connection = True
+            await self._send_json(411, {'status': 'error', 'message': 'Send the request body with a Content-Length'})
+            return False
+        try:
+            content_length = int(self.headers.get('content-length') or 0)
+            if content_length < 0: raise ValueError(content_length)
+        except ValueError:
+            self.close_connection = True # The body's extent is unknown, so the connection cannot be reused
+            await self._send_json(400, {'status': 'error', 'message': 'Invalid Content-Length header'})
+            return False
+        if content_length > API_MAX_BODY_BYTES:
+            self.close_connection = True
+            await self._send_json(413, {'status': 'error', 'message': f'Request body exceeds {API_MAX_BODY_BYTES} bytes'})
+            return False
+        if content_length:
+            self.body = await self.reader.readexactly(content_length)
+        return True
+
+    def _allowed_origin(self):
+        """Returns the request's Origin if it is in hostSettings.apiAllowedOrigins, else None."""
+        origin = self.headers.get('origin')
+        return origin if origin and origin in (HOST_SETTINGS.get("apiAllowedOrigins") or ()) else None
+
+    async def _dispatch(self):
+        try:
+            # Browsers send Origin with every cross-origin request (and with same-origin POSTs). Scripts such as
+            # curl send none. A web page the user happens to visit must not be able to run tools or prompts.
+            if 'origin' in self.headers and self._allowed_origin() is None:
+                LOGGER.warning(f"API: Refused {self.method} {self.path} from origin '{self.headers['origin'][:100]}'.", extra={"request_id": self.request_id})
+                await self._send_json(403, {'status': 'error', 'message': 'Origin not allowed; add it to hostSettings.apiAllowedOrigins'})
+            elif self.method == 'OPTIONS':
+                await self._send(204, b"")
+            elif self.method == 'GET':
+                await self.do_GET()
+            elif self.method == 'POST':
+                await self.do_POST()
             else:
-                self._set_response(404)
-                response = {'status': 'error', 'message': f'Endpoint {endpoint} not found'}
+                await self._send_json(405, {'status': 'error', 'message': f'Method {self.method} not supported'})
+        except (ConnectionError, asyncio.CancelledError):
+            raise
         except Exception as e:
-            self._set_response(500)
-            response = {'status': 'error', 'message': f'Server error: {str(e)}'}
-        
-        self.wfile.write(json.dumps(response).encode('utf-8'))
+            LOGGER.error(f"API: Error handling {self.method} {self.path}: {e}", extra={"request_id": self.request_id})
+            await self._send_json(500, {'status': 'error', 'message': f'Server error: {str(e)}'})
+
+    def _response_headers(self, status_code, content_type, extra_headers=()):
+        headers = [f"HTTP/1.1 {status_code} {HTTP_REASONS.get(status_code, '')}",
+                   f"Content-Type: {content_type}",
+                   f"X-Request-Id: {self.request_id}",
+                   "Vary: Origin",
+                   "Connection: close" if self.close_connection else "Connection: keep-alive"]
+        origin = self._allowed_origin()
+        if origin is not None: # CORS headers only for allowlisted origins, never a wildcard
+            headers += [f"Access-Control-Allow-Origin: {origin}",
+                        "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+                        "Access-Control-Allow-Headers: Content-Type, X-Request-Id",
+                        "Access-Control-Expose-Headers: X-Request-Id"]
+        headers.extend(extra_headers)
+        endpoint = self.path if self.path in API_ENDPOINTS else "/api/tools/{name}/call" if self.path.startswith('/api/tools/') else "other"
+        METRICS.inc("mcp_host_api_requests_total", endpoint=endpoint, status=str(status_code))
+        return ("\r\n".join(headers) + "\r\n\r\n").encode('latin-1')
+
+    async def _send(self, status_code, body, content_type='application/json', extra_headers=()):
+        headers = [f"Content-Length: {len(body)}", *extra_headers]
+        self.writer.write(self._response_headers(status_code, content_type, headers) + body)
+        await self.writer.drain()
+
+    async def _send_json(self, status_code, response, extra_headers=()):
+        await self._send(status_code, json.dumps(response).encode('utf-8'), extra_headers=extra_headers)
+
+    async def _start_stream(self, content_type):
+        # Chunked transfer encoding keeps the connection reusable after the stream; HTTP/1.0 clients
+        # get a raw body terminated by closing the connection instead
+        if self.request_version == "HTTP/1.1":
+            self.chunked = True
+            extra = ["Transfer-Encoding: chunked", "Cache-Control: no-cache"]
+        else:
+            self.chunked = False
+            self.close_connection = True
+            extra = ["Cache-Control: no-cache"]
+        self.writer.write(self._response_headers(200, content_type, extra))
+        await self.writer.drain()
+
+    async def _write_stream(self, data):
+        if self.chunked:
+            data = f"{len(data):x}\r\n".encode('latin-1') + data + b"\r\n"
+        self.writer.write(data)
+        await self.writer.drain()
+
+    async def _end_stream(self):
+        if self.chunked:
+            self.writer.write(b"0\r\n\r\n")
+            await self.writer.drain()
+
+    async def _send_event(self, event, data):
+        await self._write_stream(f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8'))
+
+    def _json_body(self):
+        data = json.loads(self.body.decode('utf-8') or "{}")
+        if not isinstance(data, dict):
+            raise ValueError("Request body must be a JSON object")
+        return data
+
+    async def do_GET(self):
+        if self.path == '/metrics':
+            await self._send(200, METRICS.render_prometheus().encode('utf-8'), 'text/plain; version=0.0.4; charset=utf-8')
+        elif self.path == '/api/circuit_breakers':
+            await self._send_json(200, {'status': 'success', 'servers': get_circuit_breaker_states()})
+        elif self.path == '/api/http_pool':
+            await self._send_json(200, {'status': 'success', 'pool': HTTP_CONNECTION_POOL.stats()})
+        elif self.path == '/api/log_level':
+            await self._send_json(200, {'status': 'success', 'level': logging.getLevelName(LOGGER.level)})
+        elif self.path == '/api/tools':
+            etag, body = get_tool_catalog_response()
+            if_none_match = self.headers.get('if-none-match', '')
+            if etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*':
+                self.writer.write(self._response_headers(304, 'application/json', [f"ETag: {etag}", "Content-Length: 0"]))
+                await self.writer.drain()
+            else:
+                await self._send(200, body, extra_headers=[f"ETag: {etag}", "Cache-Control: no-cache"])
+        else:
+            await self._send_json(404, {'status': 'error', 'message': f'Endpoint {self.path} not found'})
+
+    async def do_POST(self):
+        # Requiring application/json means a cross-origin request always needs a CORS preflight; a text/plain
+        # or form POST from a web page would otherwise reach a tool without one
+        content_type = self.headers.get('content-type', '').split(';')[0].strip().lower()
+        if content_type != 'application/json':
+            await self._send_json(415, {'status': 'error', 'message': 'POST bodies must be sent with Content-Type: application/json'})
+            return
+        try:
+            data = self._json_body()
+        except ValueError as e: # json.JSONDecodeError and UnicodeDecodeError are both ValueErrors
+            await self._send_json(400, {'status': 'error', 'message': f'Invalid JSON body: {e}'})
+            return
+
+        if self.path == '/api/send_prompt':
+            await self._send_prompt(data)
+        elif self.path == '/api/cancel_tool_call':
+            call_id = data.get('call_id')
+            if not call_id:
+                await self._send_json(400, {'status': 'error', 'message': 'Missing call_id parameter'})
+                return
+            cancelled = handle_cancel_tool_call(data.get('tab_id'), {"call_id": str(call_id)})
+            await self._send_json(200 if cancelled else 404, {
+                'status': 'success' if cancelled else 'error', 'call_id': call_id,
+                'message': 'Tool call cancelled' if cancelled else 'No running tool call with that call_id'})
+        elif self.path == '/api/tools/batch':
+            await self._call_tools_batch(data)
+        elif self.path.startswith('/api/tools/') and self.path.endswith('/call'):
+            tool_name = unquote(self.path[len('/api/tools/'):-len('/call')])
+            arguments = data.get('arguments', {})
+            if not tool_name or not isinstance(arguments, dict):
+                await self._send_json(400, {'status': 'error', 'message': "Expected a tool name and an 'arguments' object"})
+                return
+            call_id = str(data.get('call_id') or f"api-{self.request_id}")
+            response = await call_tool_from_api(tool_name, arguments, call_id, self.request_id)
+            headers = [f"Retry-After: {max(1, round(response['retry_after_seconds']))}"] if 'retry_after_seconds' in response else []
+            await self._send_json(response.pop('http_status'), response, extra_headers=headers)
+        elif self.path == '/api/log_level':
+            try:
+                level = set_log_level(data.get('level'))
+            except ValueError as e:
+                await self._send_json(400, {'status': 'error', 'message': str(e)})
+                return
+            LOGGER.warning(f"API: Log level changed to {level}")
+            await self._send_json(200, {'status': 'success', 'level': level})
+        else:
+            await self._send_json(404, {'status': 'error', 'message': f'Endpoint {self.path} not found'})
+
+    async def _send_prompt(self, data):
+        prompt = data.get('prompt')
+        if not prompt:
+            await self._send_json(400, {'status': 'error', 'message': 'Missing prompt parameter'})
+            return
+        request_id = self.request_id
+        stream = bool(data.get('stream')) or 'text/event-stream' in self.headers.get('accept', '')
+        timeout = float(data.get('timeout') or HOST_SETTINGS.get("apiPromptTimeoutSeconds") or 0)
+        LOGGER.info(f"API: Received prompt request: {prompt[:50]}...", extra={"request_id": request_id, "stream": stream})
+
+        replies = asyncio.Queue()
+        PENDING_PROMPT_REPLIES[request_id] = replies
+        try:
+            # tabId None lets the background script pick the active Gemini tab
+            send_message({
+                "type": "REQUEST_PROMPT",
+                "tabId": data.get('tab_id'),
+                "payload": {"type": "CUSTOM_PROMPT", "prompt": prompt, "request_id": request_id}
+            })
+            if data.get('wait_for_reply') is False:
+                await self._send_json(200, {'status': 'success', 'request_id': request_id, 'prompt': prompt,
+                                            'message': 'Prompt sent to browser extension', 'response': None})
+            elif stream:
+                await self._stream_prompt_reply(replies, timeout)
+            else:
+                await self._await_prompt_reply(replies, timeout, prompt)
+        finally:
+            PENDING_PROMPT_REPLIES.pop(request_id, None)
 
-def start_api_server(port=API_PORT):
-    """Start the API server on the specified port"""
+    async def _await_prompt_reply(self, replies, timeout, prompt):
+        reply = {}
+        try:
+            async for reply in prompt_reply_updates(replies, timeout):
+                pass
+        except asyncio.TimeoutError:
+            await self._send_json(504, {'status': 'error', 'request_id': self.request_id, 'prompt': prompt,
+                                        'message': f'No complete reply from Gemini within {timeout:g}s',
+                                        'response': reply.get('text')})
+            return
+        if reply.get('error'):
+            await self._send_json(502, {'status': 'error', 'request_id': self.request_id, 'prompt': prompt,
+                                        'message': reply['error'], 'response': reply.get('text')})
+            return
+        await self._send_json(200, {'status': 'success', 'request_id': self.request_id, 'prompt': prompt,
+                                    'tab_id': reply.get('tab_id'), 'message': 'Reply received from Gemini',
+                                    'response': reply.get('text', '')})
+
+    async def _stream_prompt_reply(self, replies, timeout):
+        # Server-sent events: "delta" carries new text as Gemini writes it, "replace" the whole text when
+        # Gemini rewrote earlier parts, then one "done" or "error" event ends the stream
+        await self._start_stream('text/event-stream; charset=utf-8')
+        await self._send_event("accepted", {"request_id": self.request_id})
+        sent_text = ""
+        try:
+            async for reply in prompt_reply_updates(replies, timeout):
+                text = reply.get('text') or ""
+                if reply.get('error'):
+                    await self._send_event("error", {"request_id": self.request_id, "message": reply['error'], "response": text})
+                    break
+                if text.startswith(sent_text):
+                    if len(text) > len(sent_text):
+                        await self._send_event("delta", {"request_id": self.request_id, "text": text[len(sent_text):]})
+                else:
+                    await self._send_event("replace", {"request_id": self.request_id, "text": text})
+                sent_text = text
+                if reply.get('done'):
+                    await self._send_event("done", {"request_id": self.request_id, "tab_id": reply.get('tab_id'), "response": text})
+        except asyncio.TimeoutError:
+            await self._send_event("error", {"request_id": self.request_id, "response": sent_text,
+                                             "message": f"No complete reply from Gemini within {timeout:g}s"})
+        await self._end_stream()
+
+    async def _call_tools_batch(self, data):
+        calls = data.get('calls')
+        if not isinstance(calls, list) or not calls:
+            await self._send_json(400, {'status': 'error', 'message': "Expected a non-empty 'calls' list"})
+            return
+        if len(calls) > API_MAX_BATCH_CALLS:
+            await self._send_json(400, {'status': 'error', 'message': f'A batch may hold at most {API_MAX_BATCH_CALLS} calls'})
+            return
+        requests = []
+        for index, call in enumerate(calls):
+            if not isinstance(call, dict) or not call.get('name') or not isinstance(call.get('arguments', {}), dict):
+                await self._send_json(400, {'status': 'error', 'message': f"Call {index} needs a 'name' and an 'arguments' object"})
+                return
+            requests.append((call['name'], call.get('arguments', {}), str(call.get('call_id') or f"api-{self.request_id}-{index}")))
+        if len({call_id for _, _, call_id in requests}) != len(requests):
+            await self._send_json(400, {'status': 'error', 'message': 'call_id values in a batch must be unique'})
+            return
+        # All calls start together; the usual global and per-server limits decide how many run at once
+        results = await asyncio.gather(*(call_tool_from_api(name, arguments, call_id, self.request_id)
+                                         for name, arguments, call_id in requests))
+        for result in results:
+            result.pop('request_id', None)
+        succeeded = sum(1 for result in results if result['status'] == 'success')
+        await self._send_json(200, {'status': 'success' if succeeded == len(results) else 'partial' if succeeded else 'error',
+                                    'request_id': self.request_id, 'results': results})
+
+def get_tool_catalog_response():
+    """
+    The GET /api/tools body and its ETag. Serialized once per tool registry (and again when discovery
+    completes), so polling clients cost a comparison, and an If-None-Match hit costs nothing more.
+    """
+    global TOOL_CATALOG_RESPONSE
+    registry = TOOL_REGISTRY
+    key = (registry.version, DISCOVERY_COMPLETE.is_set())
+    if TOOL_CATALOG_RESPONSE is None or TOOL_CATALOG_RESPONSE[0] != key:
+        tools = [{"name": tool['exposed_name'], "tool_name": tool['name'], "server_id": tool['mcp_server_id'],
+                  "description": tool.get('description') or "", "inputSchema": tool.get('inputSchema') or {},
+                  "annotations": tool.get('annotations') or {}} for tool in registry.tools]
+        body = json.dumps({"status": "success", "version": registry.version, "discovery_complete": key[1],
+                           "tools": tools}).encode('utf-8')
+        etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+        TOOL_CATALOG_RESPONSE = (key, etag, body)
+    return TOOL_CATALOG_RESPONSE[1], TOOL_CATALOG_RESPONSE[2]
+
+async def call_tool_from_api(tool_name, arguments, call_id, request_id):
+    """
+    Runs a tool call for the API through the same path as TOOL_CALL_DETECTED (minus call_id dedup,
+    which exists for Gemini re-rendering a reply). The call is registered like any other, so
+    /api/cancel_tool_call can cancel it. Returns the API response dict, including its 'http_status'.
+    """
+    in_flight_key = (None, call_id)
+    if in_flight_key in IN_FLIGHT_TOOL_CALLS:
+        return {'status': 'error', 'http_status': 409, 'request_id': request_id, 'tool_name': tool_name, 'call_id': call_id,
+                'message': f'A tool call with call_id {call_id} is already running'}
+    LOGGER.info(f"API: Calling tool '{tool_name}' (Call ID: {call_id}).", extra={"request_id": request_id, "call_id": call_id, "tool": tool_name})
+    task = asyncio.create_task(run_tool_call_request(None, {"tool_name": tool_name, "parameters": arguments, "call_id": call_id}),
+                               name=f"api-tool-call-{call_id}")
+    IN_FLIGHT_TOOL_CALLS[in_flight_key] = task
+    try:
+        payload, result = await task
+    except asyncio.CancelledError:
+        if IN_FLIGHT_TOOL_CALLS.get(in_flight_key) is task:
+            task.cancel() # The API request itself was cancelled (server stopping), not the tool call
+            raise
+        payload, result = {"status": "tool_call_cancelled", "message": f"Python host: Tool call {call_id} was cancelled."}, None
+    finally:
+        if IN_FLIGHT_TOOL_CALLS.get(in_flight_key) is task:
+            del IN_FLIGHT_TOOL_CALLS[in_flight_key]
+
+    tool_status = payload.get("status")
+    http_status = TOOL_STATUS_HTTP_CODES.get(tool_status, 500)
+    if tool_status == "error_executing_tool" and payload.get("timed_out"):
+        http_status = 504
+    response = {'status': 'success' if http_status == 200 else 'error', 'http_status': http_status,
+                'request_id': request_id, 'tool_name': tool_name, 'call_id': call_id, 'tool_status': tool_status}
+    if result is not None:
+        response.update(cache_hit=payload.get("cache_hit", False), result=result)
+    else:
+        response['message'] = payload.get("message")
+    if "retry_after_seconds" in payload:
+        response['retry_after_seconds'] = payload["retry_after_seconds"]
+    return response
+
+async def prompt_reply_updates(replies, timeout):
+    """
+    Yields PROMPT_REPLY payloads for one prompt until one is marked done or carries an error.
+    Raises asyncio.TimeoutError if that has not happened within timeout seconds (0 waits forever).
+    """
+    deadline = time.monotonic() + timeout if timeout else None
+    while True:
+        remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+        reply = await asyncio.wait_for(replies.get(), timeout=remaining)
+        yield reply
+        if reply.get('done') or reply.get('error'):
+            return
+
+def handle_prompt_reply(tab_id, payload):
+    """Hands a PROMPT_REPLY from the content script to the API request waiting on its request_id."""
+    request_id = (payload or {}).get("request_id")
+    replies = PENDING_PROMPT_REPLIES.get(request_id)
+    if replies is None:
+        LOGGER.debug(f"PROMPT_REPLY for unknown or finished request '{request_id}'. Ignoring.")
+        return
+    replies.put_nowait(dict(payload, tab_id=tab_id))
+
+def get_circuit_breaker_states():
+    """Breaker state of every configured server (servers never called report as closed)."""
+    return {sc.get('id'): get_circuit_breaker(sc).snapshot() for sc in SERVER_CONFIGURATIONS}
+
+async def _serve_api_connection(reader, writer):
+    task = asyncio.current_task()
+    API_CONNECTIONS.add(task)
+    try:
+        await MCPAPIHandler(reader, writer).handle()
+    except asyncio.CancelledError:
+        pass # Server stopping; asyncio.streams reports a cancelled connection task as an error
+    finally:
+        API_CONNECTIONS.discard(task)
+
+async def start_api_server(port=API_PORT):
+    """Start the API server on the specified port, on the host event loop"""
     global API_SERVER
-    
-    server_address = ('localhost', port)
-    API_SERVER = HTTPServer(server_address, MCPAPIHandler)
-    
-    sys.stderr.write(f"Starting API server on http://localhost:{port}\n")
-    sys.stderr.flush()
-    
-    # Run the server in a separate thread
-    api_thread = threading.Thread(target=API_SERVER.serve_forever)
-    api_thread.daemon = True
-    api_thread.start()
+    try:
+        API_SERVER = await asyncio.start_server(_serve_api_connection, 'localhost', port)
+    except OSError as e:
+        LOGGER.error(f"Error: Could not start API server on port {port}: {e}")
+        return
+    LOGGER.info(f"Starting API server on http://localhost:{port}")
 
-def stop_api_server():
+async def stop_api_server():
     """Stop the API server if it's running"""
     global API_SERVER
     if API_SERVER:
-        API_SERVER.shutdown()
+        API_SERVER.close()
+        connections = list(API_CONNECTIONS) # Idle keep-alive connections would otherwise hold wait_closed()
+        for task in connections: task.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await API_SERVER.wait_closed()
         API_SERVER = None
-        sys.stderr.write("API server stopped\n")
-        sys.stderr.flush()
+        LOGGER.info("API server stopped")
 
 if __name__ == '__main__':
     # Parse command line arguments
     parser = argparse.ArgumentParser(description='MCP Native Host')
     parser.add_argument('--enable-api', action='store_true', help='Enable the API server')
     parser.add_argument('--api-port', type=int, default=API_PORT, help=f'Port for the API server (default: {API_PORT})')
+    parser.add_argument('--config', default=CONFIG_FILENAME, help=f'Server configuration file (default: {CONFIG_FILENAME} next to this script)')
+    parser.add_argument('--startup-profile', action='store_true', help='Print a timing breakdown of startup to stderr once it is over')
     
     args = parser.parse_args()
     
     # Set global variables based on command line arguments
     API_ENABLED = args.enable_api
     API_PORT = args.api_port
+    CONFIG_FILENAME = os.path.abspath(args.config) if args.config != CONFIG_FILENAME else args.config
+    STARTUP_PROFILE_REQUESTED = args.startup_profile
     
-    # Start the API server if enabled
-    if API_ENABLED:
-        start_api_server(API_PORT)
-    
+    configure_logging() # stderr at INFO until the config's hostSettings are read
+
     try: 
         main()
     except Exception as e: 
-        sys.stderr.write(f"Unhandled exception in main: {e}\n")
-        sys.stderr.flush()
-        # Stop the API server if it's running
-        if API_ENABLED:
-            stop_api_server()
-        sys.exit(1) # Keep critical error
+        configure_logging() # main() has already shut the listener down
+        LOGGER.critical(f"Unhandled exception in main: {e}", exc_info=True)
+        shutdown_logging()
+        sys.exit(1)
@@ -0,0 +1,70 @@
+"""Regression cases for FunctionCallsParser: literal closing tags, bare '&'/'<' and split-chunk feeding."""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import mcp_native_host as host # noqa: E402
+
+def parse(xml, call_id=None):
+    return host.parse_tool_call_xml(xml, call_id)
+
+def feed_in_chunks(xml, size):
+    parser = host.FunctionCallsParser()
+    calls = []
+    for offset in range(0, len(xml), size):
+        calls.extend(parser.feed(xml[offset:offset + size]))
+    calls.extend(parser.close())
+    return calls
+
+def test_literal_invoke_close_in_value_is_kept():
+    xml = ('<function_calls><invoke name="write_file" call_id="1">'
+           '<parameter name="content">see</invoke> more</parameter>'
+           '<parameter name="path">doc.md</parameter></invoke></function_calls>')
+    calls = parse(xml)
+    assert len(calls) == 1
+    assert calls[0]["parameters"] == {"content": "see</invoke> more", "path": "doc.md"}
+
+def test_literal_parameter_close_in_value_is_kept():
+    xml = ('<function_calls><invoke name="write_file" call_id="1">'
+           '<parameter name="content">a</parameter> b</parameter>'
+           '<parameter name="path">x.txt</parameter></invoke></function_calls>')
+    assert parse(xml)[0]["parameters"] == {"content": "a</parameter> b", "path": "x.txt"}
+
+def test_bare_ampersand_and_less_than_in_values():
+    xml = ('<function_calls><invoke name="run" call_id="1">'
+           '<parameter name="code">if a < b && c &amp; d: print("<ok>")</parameter></invoke></function_calls>')
+    assert parse(xml)[0]["parameters"] == {"code": 'if a < b && c & d: print("<ok>")'}
+
+def test_literal_invoke_close_with_several_invokes():
+    xml = ('<function_calls>'
+           '<invoke name="write_file" call_id="1"><parameter name="content">x</invoke>y</parameter></invoke>'
+           '<invoke name="read_file" call_id="2"><parameter name="path">a.txt</parameter></invoke>'
+           '</function_calls>')
+    calls = parse(xml)
+    assert [(c["tool_name"], c["parameters"]) for c in calls] == [
+        ("write_file", {"content": "x</invoke>y"}), ("read_file", {"path": "a.txt"})]
+
+def test_unterminated_invoke_does_not_swallow_the_next_one():
+    xml = ('<function_calls>'
+           '<invoke name="a" call_id="1"><parameter name="p">1</parameter>'
+           '<invoke name="b" call_id="2"><parameter name="p">2</parameter></invoke>'
+           '</function_calls>')
+    calls = parse(xml)
+    assert [(c["tool_name"], c["parameters"]) for c in calls] == [("a", {"p": "1"}), ("b", {"p": "2"})]
+
+@pytest.mark.parametrize("size", [1, 3, 7, 16, 64])
+def test_split_chunk_feeding_matches_whole_text(size):
+    xml = ('<function_calls>'
+           '<invoke name="write_file" call_id="1"><parameter name="content">see</invoke> &amp; a < b</parameter>'
+           '<parameter name="path">doc.md</parameter></invoke>'
+           '<invoke name="read_file" call_id="2" depends_on="1"><parameter name="path">doc.md</parameter></invoke>'
+           '</function_calls>')
+    whole = parse(xml)
+    chunked = feed_in_chunks(xml, size)
+    assert [(c["tool_name"], c["call_id"], c["parameters"]) for c in chunked] == \
+           [(c["tool_name"], c["call_id"], c["parameters"]) for c in whole]
+    assert whole[0]["parameters"]["content"] == "see</invoke> & a < b"
+    assert whole[1]["depends_on"] == ["1"]
@@ -24,6 +24,7 @@ module.exports = {
     '.git',
     '.github',
     'scripts',
+    'benchmarks',
     'web-ext-artifacts',
     '.gitignore',
     'README.md',